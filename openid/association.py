@@ -32,6 +32,7 @@ __all__ = [
     'Association',
 ]
 
+import hmac
 import time
 
 from openid import cryptutil, kvform, oidutil
@@ -254,11 +255,15 @@ class Association(object):
         'assoc_type',
     ]
 
-    _macs = {
-        'HMAC-SHA1': cryptutil.hmacSha1,
-        'HMAC-SHA256': cryptutil.hmacSha256,
+    _digests = {
+        'HMAC-SHA1': cryptutil.sha1_module,
+        'HMAC-SHA256': cryptutil.sha256_module,
     }
 
+    # The keyed HMAC object, copied for every signature, with the secret
+    # and association type it was made for.
+    _mac = None
+
     @classmethod
     def fromExpiresIn(cls, expires_in, handle, secret, assoc_type):
         """
@@ -380,7 +385,7 @@ class Association(object):
 
         @rtype: C{bool}
         """
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        return type(self) == type(other) and self.__getstate__() == other.__getstate__()
 
     def __ne__(self, other):
         """
@@ -395,6 +400,12 @@ class Association(object):
         """
         return not (self == other)
 
+    def __getstate__(self):
+        # The HMAC object can't be copied nor pickled, it's made again.
+        state = self.__dict__.copy()
+        state.pop('_mac', None)
+        return state
+
     def serialize(self):
         """
         Convert an association to KV form.
@@ -467,15 +478,47 @@ class Association(object):
 
         @rtype: str
         """
-        kv = kvform.seqToKV(pairs)
+        mac = self._getMac().copy()
+        mac.update(kvform.fastSeqToKV(pairs))
+        return mac.digest()
 
-        try:
-            mac = self._macs[self.assoc_type]
-        except KeyError:
-            raise ValueError(
-                'Unknown association type: %r' % (self.assoc_type,))
+    def signMany(self, pairs_list):
+        """
+        Generate signatures for several sequences of (key, value) pairs
+
+
+        @param pairs_list: The sequences of pairs to sign
 
-        return mac(self.secret, kv)
+        @type pairs_list: iterable of sequences of (str, str)
+
+
+        @return: The binary signatures of the sequences, in order
+
+        @rtype: [str]
+        """
+        template = self._getMac()
+        signatures = []
+        for pairs in pairs_list:
+            mac = template.copy()
+            mac.update(kvform.fastSeqToKV(pairs))
+            signatures.append(mac.digest())
+        return signatures
+
+    def _getMac(self):
+        """Return the HMAC object keyed with the secret.
+
+        It is made once per association, which saves computing the
+        padded keys for every signature.  Don't update it, sign copies.
+        """
+        cached = self._mac
+        if cached is None or cached[0] is not self.secret or cached[1] is not self.assoc_type:
+            try:
+                digest = self._digests[self.assoc_type]
+            except KeyError:
+                raise ValueError(
+                    'Unknown association type: %r' % (self.assoc_type,))
+            cached = self._mac = (self.secret, self.assoc_type, hmac.new(self.secret, digestmod=digest))
+        return cached[2]
 
     def getMessageSignature(self, message):
         """Return the signature of a message.
@@ -508,13 +551,18 @@ class Association(object):
 
         signed_message = message.copy()
         signed_message.setArg(OPENID_NS, 'assoc_handle', self.handle)
-        message_keys = signed_message.toPostArgs().keys()
-        signed_list = [k[7:] for k in message_keys
-                       if k.startswith('openid.')]
+
+        # The message is encoded once, both to find the fields to sign
+        # and to get their values.
+        data = signed_message.toPostArgs()
+        signed_list = [k[7:] for k in data if k.startswith('openid.')]
         signed_list.append('signed')
         signed_list.sort()
-        signed_message.setArg(OPENID_NS, 'signed', ','.join(signed_list))
-        sig = self.getMessageSignature(signed_message)
+        signed = ','.join(signed_list)
+        signed_message.setArg(OPENID_NS, 'signed', signed)
+        data['openid.signed'] = signed
+
+        sig = oidutil.toBase64(self.sign(self._pairsFromPostArgs(signed_list, data)))
         signed_message.setArg(OPENID_NS, 'sig', sig)
         return signed_message
 
@@ -525,23 +573,43 @@ class Association(object):
         @raises ValueError: if the message has no signature or no signature
             can be calculated for it.
         """
-        message_sig = message.getArg(OPENID_NS, 'sig')
-        if not message_sig:
-            raise ValueError("%s has no sig." % (message,))
-        calculated_sig = self.getMessageSignature(message)
-        return cryptutil.const_eq(calculated_sig, message_sig)
+        return self.checkMessageSignatures([message])[0]
+
+    def checkMessageSignatures(self, messages):
+        """Check the signatures of several messages signed with this
+        association.
+
+        @param messages: The signed messages
+        @type messages: iterable of L{openid.message.Message}
+
+        @return: Whether the signature of each message matches, in order
+        @rtype: [bool]
+
+        @raises ValueError: if any message has no signature or no signature
+            can be calculated for it.
+        """
+        message_sigs = []
+        pairs_list = []
+        for message in messages:
+            message_sig = message.getArg(OPENID_NS, 'sig')
+            if not message_sig:
+                raise ValueError("%s has no sig." % (message,))
+            message_sigs.append(message_sig)
+            pairs_list.append(self._makePairs(message))
+
+        calculated_sigs = self.signMany(pairs_list)
+        return [cryptutil.const_eq(oidutil.toBase64(calculated), expected)
+                for calculated, expected in zip(calculated_sigs, message_sigs)]
 
     def _makePairs(self, message):
         signed = message.getArg(OPENID_NS, 'signed')
         if not signed:
             raise ValueError('Message has no signed list: %s' % (message,))
 
-        signed_list = signed.split(',')
-        pairs = []
-        data = message.toPostArgs()
-        for field in signed_list:
-            pairs.append((field, data.get('openid.' + field, '')))
-        return pairs
+        return self._pairsFromPostArgs(signed.split(','), message.toPostArgs())
+
+    def _pairsFromPostArgs(self, signed_list, data):
+        return [(field, data.get('openid.' + field, '')) for field in signed_list]
 
     def __repr__(self):
         return "<%s.%s %s %s>" % (
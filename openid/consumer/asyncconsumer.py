@@ -0,0 +1,524 @@
+# -*- test-case-name: openid.test.test_asyncconsumer -*-
+"""
+This module contains an OpenID consumer that does not block while it
+talks to other servers, so that a single-threaded event loop can run
+many logins at once.
+
+OVERVIEW
+========
+
+    C{L{AsyncConsumer}} has the same methods as
+    C{L{Consumer<openid.consumer.consumer.Consumer>}}, but instead of
+    returning their results, they return coroutines.  A coroutine is a
+    generator which yields a C{L{Fetch}} whenever it needs an HTTP
+    request to be made, and it is run by C{L{runCoroutine}}, which
+    passes the requests to an
+    C{L{AsyncHTTPFetcher<openid.fetchers.AsyncHTTPFetcher>}} and
+    calls back when the coroutine is done::
+
+        def started(auth_request):
+            redirect(auth_request.redirectURL(realm, return_to))
+
+        consumer = AsyncConsumer(session, store)
+        runCoroutine(consumer.begin(user_url), fetcher, started, failed)
+
+    Coroutines may also yield other coroutines, which are run to
+    completion before the yielding coroutine is resumed with their
+    result, and they return their result by raising C{L{Return}}.
+    This is how web frameworks built on generator coroutines, such as
+    Tornado, can call the consumer directly from their handlers.
+
+    Apart from the HTTP requests, everything - the message processing,
+    signature and discovery verification, the store and the session -
+    is shared with the blocking consumer.  A store that blocks, for
+    example on a database, still blocks the event loop; use a store
+    that is fast enough for that, like
+    C{L{MemoryStore<openid.store.memstore.MemoryStore>}}.
+"""
+
+__all__ = [
+    'AsyncConsumer',
+    'AsyncGenericConsumer',
+    'Fetch',
+    'Return',
+    'discover',
+    'runCoroutine',
+]
+
+import copy
+import logging
+import sys
+import types
+
+from openid import fetchers
+from openid.consumer.consumer import (Consumer, FailureResponse, GenericConsumer, ProtocolError, ServerError,
+                                      SetupNeededError, SetupNeededResponse, _httpResponseToMessage,
+                                      getAssociationRefresher)
+from openid.consumer.discover import (DiscoveryFailure, OpenIDServiceEndpoint, _cacheDiscovery, _cacheDiscoveryFailure,
+                                      _getCachedDiscovery, _htmlServices, _normalizeURI, _xriServices, _yadisServices,
+                                      normalizeURL, normalizeXRI)
+from openid.message import OPENID_NS, LazyMessage
+from openid.yadis import xri, xrires
+from openid.yadis.constants import YADIS_ACCEPT_HEADER
+from openid.yadis.discover import DiscoveryResult, whereIsYadis
+from openid.yadis.etxrd import XRDSError
+from openid.yadis.manager import Discovery
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Fetch(object):
+    """An HTTP request yielded by a coroutine.  The coroutine is
+    resumed with the L{HTTPResponse<openid.fetchers.HTTPResponse>},
+    or the L{HTTPFetchingError<openid.fetchers.HTTPFetchingError>} is
+    raised in it."""
+
+    def __init__(self, url, body=None, headers=None):
+        self.url = url
+        self.body = body
+        self.headers = headers
+
+    def __repr__(self):
+        return '<%s.%s %s>' % (self.__class__.__module__, self.__class__.__name__, self.url)
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value, as generators can not
+    contain C{return} statements with a value."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class _CoroutineRunner(object):
+    """Drives a coroutine, and the coroutines it yields, one step
+    after another."""
+
+    def __init__(self, coroutine, fetcher, callback, errback):
+        self.stack = [coroutine]
+        self.fetcher = fetcher
+        self.callback = callback
+        self.errback = errback
+
+    def run(self, value=None, exc_info=None):
+        """Resume the innermost coroutine with a value or an exception
+        and run until it waits for a fetch or all coroutines are
+        finished."""
+        while True:
+            coroutine = self.stack[-1]
+            try:
+                if exc_info is None:
+                    yielded = coroutine.send(value)
+                else:
+                    yielded = coroutine.throw(*exc_info)
+            except Return as ret:
+                value, exc_info = ret.value, None
+            except StopIteration:
+                value, exc_info = None, None
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+            else:
+                value, exc_info = None, None
+                if isinstance(yielded, types.GeneratorType):
+                    self.stack.append(yielded)
+                elif isinstance(yielded, Fetch):
+                    self.fetch(yielded)
+                    return
+                else:
+                    try:
+                        raise TypeError('Coroutine yielded %r' % (yielded,))
+                    except TypeError:
+                        exc_info = sys.exc_info()
+                continue
+
+            # The innermost coroutine is finished.
+            self.stack.pop()
+            if not self.stack:
+                if exc_info is None:
+                    self.callback(value)
+                else:
+                    self.errback(exc_info[1])
+                return
+
+    def fetch(self, request):
+        def fetched(response):
+            self.run(response)
+
+        def failed(why):
+            # Errors are reported the same way as by the
+            # ExceptionWrappingFetcher the blocking consumer uses.
+            if not isinstance(why, fetchers.HTTPFetchingError):
+                why = fetchers.HTTPFetchingError(why=why)
+            self.run(exc_info=(type(why), why, None))
+
+        self.fetcher.fetch(request.url, request.body, request.headers, fetched, failed)
+
+
+def runCoroutine(coroutine, fetcher, callback, errback):
+    """Run a coroutine, making the HTTP requests it yields with an
+    asynchronous fetcher.
+
+    Returns as soon as the coroutine waits for the first response;
+    the rest of the coroutine runs in the callbacks of the fetcher.
+
+    @param coroutine: The generator to run.
+
+    @type fetcher: L{openid.fetchers.AsyncHTTPFetcher}
+
+    @param callback: Called with the value the coroutine returns.
+
+    @param errback: Called with the exception the coroutine raises.
+
+    @return: None
+    """
+    _CoroutineRunner(coroutine, fetcher, callback, errback).run()
+
+
+def _yadisDiscover(uri):
+    """Coroutine version of L{openid.yadis.discover.discover}."""
+    result = DiscoveryResult(uri)
+    resp = yield Fetch(uri, headers={'Accept': YADIS_ACCEPT_HEADER})
+    if resp.status not in (200, 206):
+        raise DiscoveryFailure(
+            'HTTP Response status from identity URL host is not 200. '
+            'Got status %r' % (resp.status,), resp)
+
+    # Note the URL after following redirects
+    result.normalized_uri = resp.final_url
+    result.content_type = resp.headers.get('content-type')
+    result.xrds_uri = whereIsYadis(resp)
+
+    if result.xrds_uri and result.usedYadisLocation():
+        resp = yield Fetch(result.xrds_uri)
+        if resp.status not in (200, 206):
+            exc = DiscoveryFailure(
+                'HTTP Response status from Yadis host is not 200. '
+                'Got status %r' % (resp.status,), resp)
+            exc.identity_url = result.normalized_uri
+            raise exc
+        result.content_type = resp.headers.get('content-type')
+
+    result.response_text = resp.body
+    result.headers = resp.headers
+    raise Return(result)
+
+
+def _discoverURI(uri):
+    response = yield _yadisDiscover(uri)
+    result = _yadisServices(response)
+    if result is None:
+        # The Yadis document has no OpenID services, so look for them
+        # in the HTML without following the Yadis header.
+        http_resp = yield Fetch(uri)
+        result = _htmlServices(http_resp)
+
+    claimed_id, openid_services, ttl = result
+    raise Return((normalizeURL(claimed_id), openid_services, ttl))
+
+
+def _discoverXRI(iname):
+    resolver = xrires.ProxyResolver()
+    responses = []
+    for service_type in OpenIDServiceEndpoint.openid_type_uris:
+        response = yield Fetch(resolver.queryURL(iname, service_type))
+        responses.append(response)
+
+    try:
+        canonicalID, services, expires = resolver.parseResponses(iname, responses)
+    except XRDSError:
+        _LOGGER.exception('xrds error on %s', iname)
+        raise Return((iname, [], None))
+    raise Return(_xriServices(iname, canonicalID, services, expires))
+
+
+def discover(identifier):
+    """Coroutine version of L{openid.consumer.discover.discover}.
+
+    The discovery cache set by
+    L{setDiscoveryCache<openid.consumer.discover.setDiscoveryCache>}
+    is used in the same way.
+
+    @return: (claimed_id, services)
+    """
+    if xri.identifierScheme(identifier) == "XRI":
+        key = normalizeXRI(identifier)
+        coroutine = _discoverXRI(key)
+    else:
+        key = _normalizeURI(identifier)
+        coroutine = _discoverURI(key)
+
+    cached = _getCachedDiscovery(key)
+    if cached is not None:
+        raise Return(cached)
+
+    try:
+        claimed_id, services, ttl = yield coroutine
+    except (DiscoveryFailure, fetchers.HTTPFetchingError) as why:
+        _cacheDiscoveryFailure(key, why)
+        raise
+
+    _cacheDiscovery(key, claimed_id, services, ttl)
+    raise Return((claimed_id, services))
+
+
+def makeKVPost(request_message, server_url):
+    """Coroutine version of L{openid.consumer.consumer.makeKVPost}."""
+    resp = yield Fetch(server_url, body=request_message.toURLEncoded())
+    raise Return(_httpResponseToMessage(resp, server_url))
+
+
+class _DiscoveryNeeded(Exception):
+    """Raised from the discovery verification of L{GenericConsumer}
+    when it has to perform discovery."""
+
+    def __init__(self, claimed_id, to_match_endpoints):
+        Exception.__init__(self, claimed_id)
+        self.claimed_id = claimed_id
+        self.to_match_endpoints = to_match_endpoints
+
+
+class AsyncGenericConsumer(GenericConsumer):
+    """A L{GenericConsumer<openid.consumer.consumer.GenericConsumer>}
+    whose C{begin} and C{complete} methods return coroutines, for use
+    with L{AsyncConsumer}.
+    """
+
+    _discover = staticmethod(discover)
+    _makeKVPost = staticmethod(makeKVPost)
+
+    def begin(self, service_endpoint):
+        """Coroutine version of L{GenericConsumer.begin}."""
+        if self.store is None:
+            assoc = None
+        else:
+            assoc = yield self._getAssociation(service_endpoint)
+
+        raise Return(self._createAuthRequest(service_endpoint, assoc))
+
+    def complete(self, message, endpoint, return_to):
+        """Coroutine version of L{GenericConsumer.complete}."""
+        response = GenericConsumer.complete(self, message, endpoint, return_to)
+        # Only id_res responses need to be checked with the server.
+        if isinstance(response, types.GeneratorType):
+            response = yield response
+        raise Return(response)
+
+    def _complete_id_res(self, message, endpoint, return_to):
+        try:
+            self._checkSetupNeeded(message)
+        except SetupNeededError as why:
+            raise Return(SetupNeededResponse(endpoint, why.user_setup_url))
+
+        try:
+            response = yield self._doIdRes(message, endpoint, return_to)
+        except (ProtocolError, DiscoveryFailure) as why:
+            response = FailureResponse(endpoint, why[0])
+        raise Return(response)
+
+    def _doIdRes(self, message, endpoint, return_to):
+        # Checks for presence of appropriate fields (and checks
+        # signed list fields)
+        self._idResCheckForFields(message)
+
+        if not self._checkReturnTo(message, return_to):
+            raise ProtocolError(
+                "return_to does not match return URL. Expected %r, got %r"
+                % (return_to, message.getArg(OPENID_NS, 'return_to')))
+
+        # Verify discovery information:
+        endpoint = yield self._verifyDiscoveryResults(message, endpoint)
+        _LOGGER.info("Received id_res response from %s using association %s",
+                     endpoint.server_url, message.getArg(OPENID_NS, 'assoc_handle'))
+
+        yield self._idResCheckSignature(message, endpoint.server_url)
+
+        # Will raise a ProtocolError if the nonce is bad
+        self._idResCheckNonce(message, endpoint)
+        raise Return(self._createSuccessResponse(message, endpoint))
+
+    def _verifyDiscoveryResults(self, resp_msg, endpoint=None):
+        # The verification logic of GenericConsumer is reused.  When it
+        # needs to perform discovery, _discoverAndVerify interrupts it
+        # and the discovery is done here.
+        try:
+            raise Return(GenericConsumer._verifyDiscoveryResults(self, resp_msg, endpoint))
+        except _DiscoveryNeeded as needed:
+            claimed_id = needed.claimed_id
+            to_match_endpoints = needed.to_match_endpoints
+
+        _LOGGER.info('Performing discovery on %s', claimed_id)
+        _, services = yield self._discover(claimed_id)
+        if not services:
+            raise DiscoveryFailure('No OpenID information found at %s' %
+                                   (claimed_id,), None)
+        endpoint = self._verifyDiscoveredServices(claimed_id, services, to_match_endpoints)
+
+        # As in GenericConsumer._verifyDiscoveryResultsOpenID2, the
+        # endpoint we return should have the claimed ID from the
+        # message we just verified, fragment and all.
+        if resp_msg.isOpenID2() and endpoint.claimed_id != claimed_id:
+            endpoint = copy.copy(endpoint)
+            endpoint.claimed_id = claimed_id
+        raise Return(endpoint)
+
+    def _discoverAndVerify(self, claimed_id, to_match_endpoints):
+        raise _DiscoveryNeeded(claimed_id, to_match_endpoints)
+
+    def _idResCheckSignature(self, message, server_url):
+        assoc_handle = message.getArg(OPENID_NS, 'assoc_handle')
+        if self.store is None:
+            assoc = None
+        else:
+            assoc = self.store.getAssociation(server_url, assoc_handle)
+
+        if assoc:
+            if assoc.getExpiresIn() <= 0:
+                raise ProtocolError(
+                    'Association with %s expired' % (server_url,))
+
+            if not assoc.checkMessageSignature(message):
+                raise ProtocolError('Bad signature')
+
+        else:
+            # It's not an association we know about.  Stateless mode is our
+            # only possible path for recovery.
+            is_valid = yield self._checkAuth(message, server_url)
+            if not is_valid:
+                raise ProtocolError('Server denied check_authentication')
+
+    def _checkAuth(self, message, server_url):
+        _LOGGER.info('Using OpenID check_authentication')
+        request = self._createCheckAuthRequest(message)
+        if request is None:
+            raise Return(False)
+        try:
+            response = yield self._makeKVPost(request, server_url)
+        except (fetchers.HTTPFetchingError, ServerError) as e:
+            _LOGGER.exception('check_authentication failed: %s', e)
+            raise Return(False)
+        raise Return(self._processCheckAuthResponse(response, server_url))
+
+    def _getAssociation(self, endpoint):
+        refresher = getAssociationRefresher()
+        if refresher is not None:
+            refresher.noteUse(self, endpoint)
+
+        assoc = self.store.getAssociation(endpoint.server_url)
+
+        if assoc is None or assoc.expiresIn <= 0:
+            assoc = yield self._negotiateAssociation(endpoint)
+            if assoc is not None:
+                self.store.storeAssociation(endpoint.server_url, assoc)
+
+        raise Return(assoc)
+
+    def _negotiateAssociation(self, endpoint):
+        # Get our preferred session/association type from the negotiatior.
+        assoc_type, session_type = self._getPreferredType(endpoint)
+
+        try:
+            assoc = yield self._requestAssociation(endpoint, assoc_type, session_type)
+        except ServerError as why:
+            supportedTypes = self._extractSupportedAssociationType(why, endpoint, assoc_type)
+            if supportedTypes is None:
+                raise Return(None)
+
+            assoc_type, session_type = supportedTypes
+            # Attempt to create an association from the assoc_type
+            # and session_type that the server told us it
+            # supported.
+            try:
+                assoc = yield self._requestAssociation(endpoint, assoc_type, session_type)
+            except ServerError:
+                # Do not keep trying, since it rejected the
+                # association type that it told us to use.
+                _LOGGER.error('Server %s refused its suggested association type: session_type=%s, assoc_type=%s',
+                              endpoint.server_url, session_type, assoc_type)
+                raise Return(None)
+            if assoc is not None:
+                self._rememberType(endpoint, assoc_type, session_type)
+        raise Return(assoc)
+
+    def _requestAssociation(self, endpoint, assoc_type, session_type):
+        assoc_session, args = self._createAssociateRequest(endpoint, assoc_type, session_type)
+
+        try:
+            response = yield self._makeKVPost(args, endpoint.server_url)
+        except fetchers.HTTPFetchingError as why:
+            _LOGGER.exception('openid.associate request failed: %s', why)
+            raise Return(None)
+
+        raise Return(self._processAssociateResponse(endpoint, response, assoc_session))
+
+
+class AsyncConsumer(Consumer):
+    """A L{Consumer<openid.consumer.consumer.Consumer>} whose
+    C{begin}, C{beginWithoutDiscovery} and C{complete} methods return
+    coroutines.  Run them with L{runCoroutine}, or yield them from
+    your own coroutines.
+    """
+
+    _discover = staticmethod(discover)
+
+    def __init__(self, session, store, consumer_class=None):
+        """Initialize an AsyncConsumer instance.
+
+        @param consumer_class: Defaults to L{AsyncGenericConsumer}.
+
+        @see: L{Consumer.__init__<openid.consumer.consumer.Consumer.__init__>}
+        """
+        if consumer_class is None:
+            consumer_class = AsyncGenericConsumer
+        Consumer.__init__(self, session, store, consumer_class)
+
+    def begin(self, user_url, anonymous=False):
+        """Coroutine version of L{Consumer.begin}.
+
+        @return: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+        """
+        disco = Discovery(self.session, user_url, self.session_key_prefix)
+
+        discover_func = None
+        # The manager of previously discovered services is used if
+        # there are any left; otherwise discovery is done first.
+        if not disco.getManager():
+            try:
+                result = yield self._discover(user_url)
+            except fetchers.HTTPFetchingError as why:
+                raise DiscoveryFailure(
+                    'Error fetching XRDS document: %s' % (why[0],), None)
+
+            def discover_func(url):
+                return result
+
+        service = disco.getNextService(discover_func)
+
+        if service is None:
+            raise DiscoveryFailure(
+                'No usable OpenID services found for %s' % (user_url,), None)
+
+        auth_req = yield self.beginWithoutDiscovery(service, anonymous)
+        raise Return(auth_req)
+
+    def beginWithoutDiscovery(self, service, anonymous=False):
+        """Coroutine version of L{Consumer.beginWithoutDiscovery}.
+
+        @return: L{AuthRequest<openid.consumer.consumer.AuthRequest>}
+        """
+        auth_req = yield self.consumer.begin(service)
+        raise Return(self._startAuthRequest(auth_req, anonymous))
+
+    def complete(self, query, current_url):
+        """Coroutine version of L{Consumer.complete}.
+
+        @return: L{Response<openid.consumer.consumer.Response>}
+        """
+        endpoint = self.session.get(self._token_key)
+
+        # Only positive assertions need all of the arguments parsed.
+        message = LazyMessage(query)
+        if message.getArg(OPENID_NS, 'mode') == 'id_res':
+            message.parse()
+        response = yield self.consumer.complete(message, endpoint, current_url)
+        raise Return(self._finishComplete(response))
@@ -187,8 +187,13 @@ USING THIS LIBRARY
     objects.
 """
 
+import base64
 import copy
 import logging
+import os
+import random
+import threading
+import time
 from urlparse import parse_qsl, urldefrag, urlparse
 
 from openid import cryptutil, fetchers, oidutil, urinorm
@@ -196,17 +201,28 @@ from openid.association import Association, SessionNegotiator, default_negotiato
 from openid.consumer.discover import (OPENID_1_0_TYPE, OPENID_1_1_TYPE, OPENID_2_0_TYPE, DiscoveryFailure,
                                       OpenIDServiceEndpoint, discover)
 from openid.dh import DiffieHellman
-from openid.message import BARE_NS, IDENTIFIER_SELECT, OPENID1_NS, OPENID2_NS, OPENID_NS, Message, no_default
+from openid.message import (BARE_NS, IDENTIFIER_SELECT, OPENID1_NS, OPENID2_NS, OPENID_NS, FrozenMessage, LazyMessage,
+                            Message, no_default)
 from openid.store.nonce import mkNonce, split as splitNonce
 from openid.yadis.manager import Discovery
 
 __all__ = ['AuthRequest', 'Consumer', 'SuccessResponse',
            'SetupNeededResponse', 'CancelResponse', 'FailureResponse',
            'SUCCESS', 'FAILURE', 'CANCEL', 'SETUP_NEEDED',
+           'AssociationRefresher', 'getAssociationRefresher', 'setAssociationRefresher',
            ]
 
 _LOGGER = logging.getLogger(__name__)
 
+_association_refresher = None
+
+# Maps the associations being negotiated to their _Negotiation
+_negotiations = {}
+_negotiations_lock = threading.Lock()
+
+# Held while an AssociationRefresher is reset in a forked process
+_fork_lock = threading.Lock()
+
 
 def makeKVPost(request_message, server_url):
     """Make a Direct Request to an OpenID Provider and return the
@@ -238,7 +254,7 @@ def _httpResponseToMessage(response, server_url):
     @raises ServerError: if the server returned an OpenID error.
     """
     # Should this function be named Message.fromHTTPResponse instead?
-    response_message = Message.fromKVForm(response.body)
+    response_message = FrozenMessage.fromKVForm(response.body)
     if response.status == 400:
         raise ServerError.fromMessage(response_message)
 
@@ -368,6 +384,11 @@ class Consumer(object):
         @see: openid.consumer.discover
         """
         auth_req = self.consumer.begin(service)
+        return self._startAuthRequest(auth_req, anonymous)
+
+    def _startAuthRequest(self, auth_req, anonymous):
+        """Remember the endpoint of a new AuthRequest in the session
+        and make it anonymous if requested."""
         self.session[self._token_key] = auth_req.endpoint
 
         try:
@@ -404,9 +425,16 @@ class Consumer(object):
 
         endpoint = self.session.get(self._token_key)
 
-        message = Message.fromPostArgs(query)
+        # Only positive assertions need all of the arguments parsed.
+        message = LazyMessage(query)
+        if message.getArg(OPENID_NS, 'mode') == 'id_res':
+            message.parse()
         response = self.consumer.complete(message, endpoint, current_url)
+        return self._finishComplete(response)
 
+    def _finishComplete(self, response):
+        """Clean up the session after the response to an OpenID request
+        was processed."""
         try:
             del self.session[self._token_key]
         except KeyError:
@@ -445,6 +473,23 @@ class Consumer(object):
         """
         self.consumer.negotiator = SessionNegotiator(association_preferences)
 
+    def setEndpointTokenKey(self, key):
+        """Add the endpoint of the requests to their return_to URLs, in
+        a token authenticated with the key, so the responses can be
+        verified without discovery even when the session is lost, or
+        there is none.
+
+        Use the same key for every consumer which may complete the
+        requests; they need it to check the tokens.
+
+        @param key: A random secret of at least 32 bytes, or None to
+            keep the endpoints in the session only.
+        @type key: str
+
+        @returns: None
+        """
+        self.consumer.endpoint_token_key = key
+
 
 class DiffieHellmanSHA1ConsumerSession(object):
     session_type = 'DH-SHA1'
@@ -575,6 +620,33 @@ class GenericConsumer(object):
     # identifier to do discovery when verifying the response.
     openid1_return_to_identifier_name = 'openid1_claimed_id'
 
+    # The key authenticating the endpoint tokens.  If it is set, the
+    # endpoint of the request is added to the return_to URL in a token,
+    # so the response can be verified without discovery even if the
+    # endpoint was not kept in the session.  See setEndpointTokenKey.
+    endpoint_token_key = None
+
+    # The query parameter holding the endpoint token in the return_to URL
+    endpoint_token_arg_name = 'endpoint_token'
+
+    # How many seconds the endpoint tokens are valid for
+    endpoint_token_lifetime = 60 * 60
+
+    # How many seconds to wait for an association with a server which
+    # is being negotiated by another thread, or with
+    # association_store_lock by another process, before negotiating one.
+    association_wait = 10
+
+    # Whether the processes sharing the store take turns negotiating the
+    # associations with a server.  The turns are taken by using nonces.
+    association_store_lock = False
+
+    # How many seconds to remember the association and session types a
+    # server suggested instead of the preferred ones, so the next
+    # association is requested with them right away.  They are kept in
+    # the store, to be shared by the processes using it.  0 disables it.
+    negotiation_memory = 24 * 60 * 60
+
     session_types = {
         'DH-SHA1': DiffieHellmanSHA1ConsumerSession,
         'DH-SHA256': DiffieHellmanSHA256ConsumerSession,
@@ -596,6 +668,11 @@ class GenericConsumer(object):
         else:
             assoc = self._getAssociation(service_endpoint)
 
+        return self._createAuthRequest(service_endpoint, assoc)
+
+    def _createAuthRequest(self, service_endpoint, assoc):
+        """Create an AuthRequest object for the specified
+        service_endpoint and association, which may be None."""
         request = AuthRequest(service_endpoint, assoc)
         request.return_to_args[self.openid1_nonce_query_arg_name] = mkNonce()
 
@@ -603,8 +680,61 @@ class GenericConsumer(object):
             request.return_to_args[self.openid1_return_to_identifier_name] = \
                 request.endpoint.claimed_id
 
+        if self.endpoint_token_key is not None:
+            try:
+                request.return_to_args[self.endpoint_token_arg_name] = self._makeEndpointToken(service_endpoint)
+            except ValueError as why:
+                # The endpoint is only kept in the session.
+                _LOGGER.warn('Cannot make an endpoint token for %r: %s', service_endpoint, why)
+
         return request
 
+    def _makeEndpointToken(self, endpoint):
+        """Encode the endpoint in a token authenticated with
+        endpoint_token_key, which expires after
+        endpoint_token_lifetime seconds.
+
+        @rtype: str
+        """
+        expires = int(time.time()) + self.endpoint_token_lifetime
+        payload = '%d:%s' % (expires, endpoint.toBytes())
+        tag = cryptutil.hmacSha256(self.endpoint_token_key, payload)[:16]
+        return base64.urlsafe_b64encode(payload) + '.' + base64.urlsafe_b64encode(tag)
+
+    def _parseEndpointToken(self, token):
+        """Decode an endpoint token made by L{_makeEndpointToken}.
+
+        @returns: The endpoint, or None if the token is not valid or has
+            expired.
+        @rtype: L{openid.consumer.discover.OpenIDServiceEndpoint} or NoneType
+        """
+        try:
+            payload, tag = token.split('.', 1)
+            payload = base64.urlsafe_b64decode(str(payload))
+            tag = base64.urlsafe_b64decode(str(tag))
+        except (ValueError, TypeError, UnicodeError):
+            _LOGGER.warn('Malformed endpoint token %r', token)
+            return None
+
+        if not cryptutil.const_eq(cryptutil.hmacSha256(self.endpoint_token_key, payload)[:16], tag):
+            _LOGGER.warn('Endpoint token %r is not authentic', token)
+            return None
+
+        try:
+            expires, data = payload.split(':', 1)
+            expires = int(expires)
+            endpoint = OpenIDServiceEndpoint.fromBytes(data)
+        except ValueError:
+            # Made in an encoding of another version
+            _LOGGER.warn('Malformed endpoint token %r', token)
+            return None
+
+        if expires <= time.time():
+            _LOGGER.info('Endpoint token %r has expired', token)
+            return None
+
+        return endpoint
+
     def complete(self, message, endpoint, return_to):
         """Process the OpenID message, using the specified endpoint
         and return_to URL as context. This method will handle any
@@ -612,6 +742,11 @@ class GenericConsumer(object):
         """
         mode = message.getArg(OPENID_NS, 'mode', '<No mode set>')
 
+        if endpoint is None and self.endpoint_token_key is not None:
+            token = message.getArg(BARE_NS, self.endpoint_token_arg_name)
+            if token is not None:
+                endpoint = self._parseEndpointToken(token)
+
         modeMethod = getattr(self, '_complete_' + mode,
                              self._completeInvalid)
 
@@ -733,7 +868,10 @@ class GenericConsumer(object):
 
         # Will raise a ProtocolError if the nonce is bad
         self._idResCheckNonce(message, endpoint)
+        return self._createSuccessResponse(message, endpoint)
 
+    def _createSuccessResponse(self, message, endpoint):
+        """Create the response to a verified id_res message."""
         signed_list_str = message.getArg(OPENID_NS, 'signed', no_default)
         signed_list = signed_list_str.split(',')
         signed_fields = ["openid." + s for s in signed_list]
@@ -794,8 +932,8 @@ class GenericConsumer(object):
         else:
             # It's not an association we know about.  Stateless mode is our
             # only possible path for recovery.
-            # XXX - async framework will not want to block on this call to
-            # _checkAuth.
+            # AsyncGenericConsumer overrides this method not to block on
+            # this call to _checkAuth.
             if not self._checkAuth(message, server_url):
                 raise ProtocolError('Server denied check_authentication')
 
@@ -1130,22 +1268,88 @@ class GenericConsumer(object):
 
         First try seeing if we have a good association in the
         store. If we do not, then attempt to negotiate an association
-        with the server.
+        with the server.  If another thread is already negotiating
+        one, wait for it instead.
 
         If we negotiate a good association, it will get stored.
 
         @returns: A valid association for the endpoint's server_url or None
         @rtype: openid.association.Association or NoneType
         """
+        if _association_refresher is not None:
+            _association_refresher.noteUse(self, endpoint)
+
         assoc = self.store.getAssociation(endpoint.server_url)
 
         if assoc is None or assoc.expiresIn <= 0:
-            assoc = self._negotiateAssociation(endpoint)
-            if assoc is not None:
-                self.store.storeAssociation(endpoint.server_url, assoc)
+            assoc = self._coalesceNegotiation(endpoint)
 
         return assoc
 
+    def _coalesceNegotiation(self, endpoint, min_expires_in=0):
+        """Negotiate an association with the endpoint's server, unless
+        another thread sharing the store and the allowed association
+        types is negotiating one.  Then wait for its association.
+
+        @param min_expires_in: The association in the store is only
+            used instead if it expires in more seconds than this.
+        @type min_expires_in: C{int}
+
+        @returns: A valid association for the endpoint's server_url or None
+        @rtype: openid.association.Association or NoneType
+        """
+        key = (id(self.store), endpoint.server_url, tuple(self.negotiator.allowed_types))
+        with _negotiations_lock:
+            negotiation = _negotiations.get(key)
+            leader = negotiation is None
+            if leader:
+                negotiation = _negotiations[key] = _Negotiation()
+
+        if not leader:
+            if negotiation.done.wait(self.association_wait):
+                return negotiation.assoc
+            _LOGGER.warn('Timed out waiting for the association with %s', endpoint.server_url)
+            return self._negotiateAndStore(endpoint)
+
+        try:
+            negotiation.assoc = self._negotiateInTurn(endpoint, min_expires_in)
+        finally:
+            with _negotiations_lock:
+                del _negotiations[key]
+            negotiation.done.set()
+        return negotiation.assoc
+
+    def _negotiateInTurn(self, endpoint, min_expires_in=0):
+        """Negotiate an association with the endpoint's server, unless
+        one expiring in more than min_expires_in seconds was stored
+        meanwhile.  With association_store_lock, wait for the
+        association if another process is negotiating it."""
+        server_url = endpoint.server_url
+        if self.association_store_lock:
+            # Only one process uses the nonce for each period of
+            # association_wait seconds.
+            now = int(time.time())
+            period = max(int(self.association_wait), 1)
+            if not self.store.useNonce('associate:' + server_url, now - now % period, 'turn'):
+                deadline = time.time() + self.association_wait
+                while time.time() < deadline:
+                    time.sleep(0.1)
+                    assoc = self.store.getAssociation(server_url)
+                    if assoc is not None and assoc.expiresIn > min_expires_in:
+                        return assoc
+                _LOGGER.warn('Timed out waiting for another process to store the association with %s', server_url)
+
+        assoc = self.store.getAssociation(server_url)
+        if assoc is not None and assoc.expiresIn > min_expires_in:
+            return assoc
+        return self._negotiateAndStore(endpoint)
+
+    def _negotiateAndStore(self, endpoint):
+        assoc = self._negotiateAssociation(endpoint)
+        if assoc is not None:
+            self.store.storeAssociation(endpoint.server_url, assoc)
+        return assoc
+
     def _negotiateAssociation(self, endpoint):
         """Make association requests to the server, attempting to
         create a new association.
@@ -1155,7 +1359,7 @@ class GenericConsumer(object):
         @rtype: L{openid.association.Association}
         """
         # Get our preferred session/association type from the negotiatior.
-        assoc_type, session_type = self.negotiator.getAllowedType()
+        assoc_type, session_type = self._getPreferredType(endpoint)
 
         try:
             assoc = self._requestAssociation(
@@ -1179,10 +1383,41 @@ class GenericConsumer(object):
                                   endpoint.server_url, session_type, assoc_type)
                     return None
                 else:
+                    if assoc is not None:
+                        self._rememberType(endpoint, assoc_type, session_type)
                     return assoc
         else:
             return assoc
 
+    def _getNegotiationKey(self, endpoint):
+        return 'negotiation:' + endpoint.server_url
+
+    def _getPreferredType(self, endpoint):
+        """Return the association and session types to request first
+        from the endpoint's server: the ones it suggested last, if they
+        are remembered and allowed, or our preferred ones.
+
+        @rtype: (str, str)
+        """
+        if self.negotiation_memory and self.store is not None:
+            memory = self.store.getAssociation(self._getNegotiationKey(endpoint))
+            if memory is not None and memory.expiresIn > 0 and \
+                    self.negotiator.isAllowed(memory.assoc_type, memory.handle):
+                return memory.assoc_type, memory.handle
+        return self.negotiator.getAllowedType()
+
+    def _rememberType(self, endpoint, assoc_type, session_type):
+        """Remember the association and session types the endpoint's
+        server suggested.
+
+        They are stored as an association with no secret, with the
+        session type as its handle, which expires when they should be
+        forgotten.
+        """
+        if self.negotiation_memory and self.store is not None:
+            memory = Association.fromExpiresIn(self.negotiation_memory, session_type, '', assoc_type)
+            self.store.storeAssociation(self._getNegotiationKey(endpoint), memory)
+
     def _extractSupportedAssociationType(self, server_error, endpoint,
                                          assoc_type):
         """Handle ServerErrors resulting from association requests.
@@ -1237,6 +1472,15 @@ class GenericConsumer(object):
             _LOGGER.exception('openid.associate request failed: %s', why)
             return None
 
+        return self._processAssociateResponse(endpoint, response, assoc_session)
+
+    def _processAssociateResponse(self, endpoint, response, assoc_session):
+        """Extract the association from the response to an association
+        request.
+
+        @returns: An association object or None if the association
+            processing failed.
+        """
         try:
             assoc = self._extractAssociation(response, assoc_session)
         except KeyError as why:
@@ -1407,6 +1651,249 @@ class GenericConsumer(object):
             expires_in, assoc_handle, secret, assoc_type)
 
 
+class _Negotiation(object):
+    """An association negotiation other threads wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.assoc = None
+
+
+class AssociationRefresher(object):
+    """Renews the associations with the most used OpenID servers before
+    they expire, so that C{L{Consumer.begin}} finds them in the store
+    instead of making an association request while the user waits.
+
+    The consumers note every server they look up an association for.  A
+    background thread checks the associations of the most used servers
+    every C{interval} seconds and renews those expiring in less than
+    C{ahead} seconds, plus a random jitter, so the associations made at
+    the same time are not all renewed at once.  Associations with
+    shorter lifetimes are renewed when half of it is left.  The use
+    counts are halved at every check, so the servers no longer used
+    drop out.  The renewals are coalesced with the negotiations of the
+    consumers which share the store.
+
+    The new associations are requested with the store and negotiator of
+    the consumer which last used the server.  If an association request
+    fails, the server is left alone for C{retry_delay} seconds; the
+    consumers then negotiate inline as before.
+
+    A process forked from the one running the background thread starts
+    its own, with new locks in case another thread held them at the
+    fork.
+
+    @cvar consumer_class: The class making the association requests.
+    """
+
+    consumer_class = GenericConsumer
+
+    def __init__(self, servers=20, ahead=600, jitter=120, interval=60, concurrency=4, retry_delay=600):
+        """
+        @param servers: How many of the most used servers to keep
+            associated with.
+        @type servers: C{int}
+
+        @param ahead: How many seconds before the associations expire
+            to renew them.
+        @type ahead: C{int}
+
+        @param jitter: Up to how many more seconds ahead to renew them.
+        @type jitter: C{int}
+
+        @param interval: How many seconds to wait between the checks.
+        @type interval: C{int}
+
+        @param concurrency: How many association requests to make at
+            most at once.
+        @type concurrency: C{int}
+
+        @param retry_delay: How many seconds to wait before renewing an
+            association with a server again after a failure.
+        @type retry_delay: C{int}
+        """
+        self.servers = servers
+        self.ahead = ahead
+        self.jitter = jitter
+        self.interval = interval
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+
+        self.renewals = 0
+        self.failures = 0
+
+        # Maps server URLs to the number of uses since the last check
+        self._uses = {}
+        # Maps server URLs to the store, negotiator and endpoint to renew
+        # their associations with
+        self._sources = {}
+        # Maps server URLs to the time their associations may be renewed again
+        self._retry = {}
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._pid = os.getpid()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def getStats(self):
+        """Return usage statistics of the refresher.
+
+        @return: dictionary with the number of C{servers} tracked and
+            the numbers of C{renewals} and C{failures}
+        @rtype: C{dict}
+        """
+        self._checkFork()
+        with self._lock:
+            return {
+                'servers': len(self._uses),
+                'renewals': self.renewals,
+                'failures': self.failures,
+            }
+
+    def _checkFork(self):
+        # Must be called without the locks held.
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    # The thread was not forked with the process, and
+                    # the locks may have been held by another thread.
+                    stopped = self._stopped.is_set()
+                    self._lock = threading.Lock()
+                    self._refreshing = threading.Lock()
+                    self._stopped = threading.Event()
+                    if stopped:
+                        self._stopped.set()
+                    self._thread = None
+                    self._pid = os.getpid()
+
+    def _startThread(self):
+        # Must be called with the lock held.
+        if self._thread is None and not self._stopped.is_set():
+            self._thread = threading.Thread(target=self._run, name='AssociationRefresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                _LOGGER.exception('Error renewing associations')
+
+    def stop(self):
+        """Stop the background thread.  It finishes the renewals in
+        progress and is not started again."""
+        self._stopped.set()
+        with self._lock:
+            self._thread = None
+
+    def noteUse(self, consumer, endpoint):
+        """Note that the consumer looks for an association with the
+        endpoint's server and start the background thread if needed.
+
+        @type consumer: L{GenericConsumer}
+        @type endpoint: L{openid.consumer.discover.OpenIDServiceEndpoint}
+        """
+        server_url = endpoint.server_url
+        self._checkFork()
+        with self._lock:
+            self._uses[server_url] = self._uses.get(server_url, 0) + 1
+            self._sources[server_url] = (consumer.store, consumer.negotiator, endpoint)
+            self._startThread()
+
+    def refresh(self):
+        """Renew the associations with the most used servers which
+        expire soon.  Called by the background thread, or directly.
+
+        @return: The number of associations renewed
+        @rtype: C{int}
+        """
+        self._checkFork()
+        with self._refreshing:
+            now = time.time()
+            with self._lock:
+                renewals = self.renewals
+                for server_url, retry in self._retry.items():
+                    if retry <= now:
+                        del self._retry[server_url]
+                top = sorted(self._uses, key=self._uses.get, reverse=True)[:self.servers]
+                candidates = [(server_url, ) + self._sources[server_url] for server_url in top
+                              if server_url not in self._retry]
+                for server_url in self._uses.keys():
+                    self._uses[server_url] //= 2
+                    if not self._uses[server_url]:
+                        del self._uses[server_url]
+                        del self._sources[server_url]
+
+            due = []
+            for server_url, store, negotiator, endpoint in candidates:
+                assoc = store.getAssociation(server_url)
+                if assoc is None:
+                    due.append((server_url, store, negotiator, endpoint, 0))
+                    continue
+                ahead = min(self.ahead + random.uniform(0, self.jitter), assoc.lifetime / 2.0)
+                if assoc.expiresIn <= ahead:
+                    due.append((server_url, store, negotiator, endpoint, ahead))
+
+            slots = threading.Semaphore(self.concurrency)
+            threads = []
+            for args in due:
+                slots.acquire()
+                thread = threading.Thread(target=self._renew, args=(slots, ) + args, name='AssociationRefresher')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+            with self._lock:
+                return self.renewals - renewals
+
+    def _renew(self, slots, server_url, store, negotiator, endpoint, ahead):
+        try:
+            consumer = self.consumer_class(store)
+            consumer.negotiator = negotiator
+            try:
+                assoc = consumer._coalesceNegotiation(endpoint, min_expires_in=ahead)
+            except Exception:
+                _LOGGER.exception('Error renewing the association with %s', server_url)
+                assoc = None
+
+            with self._lock:
+                if assoc is None:
+                    self.failures += 1
+                    self._retry[server_url] = time.time() + self.retry_delay
+                else:
+                    _LOGGER.info('Renewed the association with %s', server_url)
+                    self.renewals += 1
+                    self._retry.pop(server_url, None)
+        finally:
+            slots.release()
+
+
+def getAssociationRefresher():
+    """Return the association refresher noted by the consumers, or None
+    if the associations are only made when they are needed.
+
+    @rtype: L{AssociationRefresher} or NoneType
+    """
+    return _association_refresher
+
+
+def setAssociationRefresher(refresher):
+    """Set the association refresher noted by the consumers.
+
+    The thread of the refresher replaced is stopped.
+
+    @param refresher: The refresher to use, or None to disable it.
+    @type refresher: L{AssociationRefresher} or NoneType
+    """
+    global _association_refresher
+    if _association_refresher is not None and _association_refresher is not refresher:
+        _association_refresher.stop()
+    _association_refresher = refresher
+
+
 class AuthRequest(object):
     """An object that holds the state necessary for generating an
     OpenID authentication request. This object holds the association
@@ -1737,9 +2224,10 @@ class SuccessResponse(Response):
         the arguments are not signed, return None.
         """
         msg_args = self.message.getArgs(ns_uri)
+        signed_fields = set(self.signed_fields)
 
         for key in msg_args.iterkeys():
-            if not self.isSigned(ns_uri, key):
+            if self.message.getKey(ns_uri, key) not in signed_fields:
                 _LOGGER.info("SuccessResponse.getSignedNS: (%s, %s) not signed.", ns_uri, key)
                 return None
 
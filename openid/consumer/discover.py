@@ -11,17 +11,22 @@ __all__ = [
     'OPENID_IDP_2_0_TYPE',
     'OpenIDServiceEndpoint',
     'discover',
+    'getDiscoveryCache',
+    'setDiscoveryCache',
 ]
 
+import copy
+import json
 import logging
 import urlparse
+from datetime import datetime
 
 from openid import fetchers, urinorm
 from openid.consumer import html_parse
 from openid.message import OPENID1_NS as OPENID_1_0_MESSAGE_NS, OPENID2_NS as OPENID_2_0_MESSAGE_NS
 from openid.yadis import filters, xri, xrires
 from openid.yadis.discover import DiscoveryFailure, discover as yadisDiscover
-from openid.yadis.etxrd import XRD_NS_2_0, XRDSError, nsTag
+from openid.yadis.etxrd import XRD_NS_2_0, XRDSError, getXRDExpiration, getYadisXRD, nsTag, parseXRDS
 from openid.yadis.services import applyFilter as extractServices
 
 _LOGGER = logging.getLogger(__name__)
@@ -32,6 +37,29 @@ OPENID_2_0_TYPE = 'http://specs.openid.net/auth/2.0/signon'
 OPENID_1_1_TYPE = 'http://openid.net/signon/1.1'
 OPENID_1_0_TYPE = 'http://openid.net/signon/1.0'
 
+# Type URIs written as their index by OpenIDServiceEndpoint.toBytes.
+# Only ever append to this list, endpoints encoded with it may be kept
+# in sessions.
+_ENCODED_TYPE_URIS = [
+    OPENID_IDP_2_0_TYPE,
+    OPENID_2_0_TYPE,
+    OPENID_1_1_TYPE,
+    OPENID_1_0_TYPE,
+    'http://openid.net/extensions/sreg/1.1',
+    'http://openid.net/sreg/1.0',
+    'http://openid.net/srv/ax/1.0',
+    'http://specs.openid.net/extensions/pape/1.0',
+]
+_TYPE_URI_CODES = dict((uri, code) for code, uri in enumerate(_ENCODED_TYPE_URIS))
+
+# The string fields of the endpoints in the order they are encoded
+_TEXT_FIELDS = ('server_url', 'claimed_id', 'local_id', 'display_identifier', 'canonicalID')
+
+# Contains the currently set discovery cache. If it is set to None,
+# discovery results are not cached. Do not access this variable
+# outside of this module.
+_discovery_cache = None
+
 
 class OpenIDServiceEndpoint(object):
     """Object representing an OpenID service endpoint.
@@ -40,6 +68,12 @@ class OpenIDServiceEndpoint(object):
     @ivar canonicalID: For XRI, the persistent identifier.
     """
 
+    __slots__ = ('claimed_id', 'server_url', 'type_uris', 'local_id', 'canonicalID', 'used_yadis',
+                 'display_identifier')
+
+    # Version of the encoding made by toBytes
+    encoding_version = '1'
+
     # OpenID service type URIs, listed in order of preference.  The
     # ordering of this list affects yadis and XRI service discovery.
     openid_type_uris = [
@@ -59,6 +93,103 @@ class OpenIDServiceEndpoint(object):
         self.used_yadis = False  # whether this came from an XRDS
         self.display_identifier = None
 
+    def toBytes(self):
+        """Encode this endpoint compactly, to be kept in a session.
+
+        The encoding starts with L{encoding_version}.  Known type URIs
+        are written as numbers and the trailing fields which are not
+        set are left out.  Which of the strings are unicode, and which
+        str are not UTF-8 and are written as Latin-1, is recorded along
+        with used_yadis, so they are decoded as they were.
+
+        @rtype: str
+
+        @raises ValueError: When a field is not a string.
+        """
+        type_uris = []
+        for uri in self.type_uris:
+            if isinstance(uri, unicode):
+                type_uris.append([uri])
+            elif uri in _TYPE_URI_CODES:
+                type_uris.append(_TYPE_URI_CODES[uri])
+            else:
+                text, latin1 = _encodeText('type URI', uri)
+                type_uris.append([text, 1] if latin1 else text)
+
+        flags = int(bool(self.used_yadis))
+        texts = []
+        for bit, name in enumerate(_TEXT_FIELDS):
+            value = getattr(self, name)
+            if isinstance(value, unicode):
+                flags |= 2 << bit
+            elif value is not None:
+                value, latin1 = _encodeText(name, value)
+                if latin1:
+                    flags |= 64 << bit
+            texts.append(value)
+
+        fields = [texts[0], type_uris, flags] + texts[1:]
+        while fields[-1] is None:
+            fields.pop()
+        return self.encoding_version + json.dumps(fields, separators=(',', ':'))
+
+    @classmethod
+    def fromBytes(cls, data):
+        """Decode an endpoint encoded by L{toBytes}.
+
+        @raises ValueError: When the data is not an endpoint encoded
+            by this version.
+        """
+        if data[:1] != cls.encoding_version:
+            raise ValueError('Unknown endpoint encoding %r' % data[:1])
+        fields = json.loads(data[1:])
+        if not isinstance(fields, list) or not 3 <= len(fields) <= 7:
+            raise ValueError('Malformed endpoint encoding %r' % data)
+        fields.extend([None] * (7 - len(fields)))
+        type_uris, flags = fields[1:3]
+        texts = fields[:1] + fields[3:]
+
+        endpoint = cls()
+        try:
+            endpoint.type_uris = [_decodeTypeURI(uri) for uri in type_uris]
+            endpoint.used_yadis = bool(flags & 1)
+            for bit, name in enumerate(_TEXT_FIELDS):
+                value = texts[bit]
+                if value is not None and not flags & 2 << bit:
+                    value = value.encode('latin-1' if flags & 64 << bit else 'utf-8')
+                setattr(endpoint, name, value)
+        except (IndexError, TypeError, AttributeError, UnicodeError):
+            raise ValueError('Malformed endpoint encoding %r' % data)
+        return endpoint
+
+    def __copy__(self):
+        copied = self.__class__.__new__(self.__class__)
+        for name in OpenIDServiceEndpoint.__slots__:
+            setattr(copied, name, getattr(self, name))
+        if hasattr(self, '__dict__'):
+            copied.__dict__.update(self.__dict__)
+        return copied
+
+    def __reduce__(self):
+        # Pickle the compact encoding, along with the attributes of
+        # subclasses which have any.
+        state = getattr(self, '__dict__', None) or None
+        try:
+            data = self.toBytes()
+        except ValueError:
+            # Fields the encoding cannot hold are pickled as they are.
+            data = None
+            state = dict(state or {})
+            for name in OpenIDServiceEndpoint.__slots__:
+                state[name] = getattr(self, name)
+        return (_loadEndpoint, (self.__class__, data), state)
+
+    def __setstate__(self, state):
+        # Endpoints pickled before they had slots have their attributes
+        # in a dictionary.
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def usesExtension(self, extension_uri):
         return extension_uri in self.type_uris
 
@@ -232,6 +363,40 @@ class OpenIDServiceEndpoint(object):
                     self.used_yadis))
 
 
+def _encodeText(name, value):
+    """Return the str value of an endpoint field decoded for JSON, and
+    whether it was decoded as Latin-1 because it is not UTF-8."""
+    if not isinstance(value, str):
+        raise ValueError('Endpoint %s %r is not a string' % (name, value))
+    try:
+        return value.decode('utf-8'), False
+    except UnicodeError:
+        return value.decode('latin-1'), True
+
+
+def _decodeTypeURI(value):
+    """Decode a type URI written by OpenIDServiceEndpoint.toBytes."""
+    if isinstance(value, int):
+        return _ENCODED_TYPE_URIS[value]
+    elif isinstance(value, list):
+        if value[1:] == [1]:
+            return value[0].encode('latin-1')
+        (uri,) = value
+        if not isinstance(uri, unicode):
+            raise TypeError(uri)
+        return uri
+    else:
+        return value.encode('utf-8')
+
+
+def _loadEndpoint(cls, data):
+    """Unpickle an endpoint of the class.  Without data, its fields
+    are in the pickled state."""
+    if data is None:
+        return cls.__new__(cls)
+    return cls.fromBytes(data)
+
+
 def findOPLocalIdentifier(service_element, type_uris):
     """Find the OP-Local Identifier for this xrd:Service element.
 
@@ -348,6 +513,159 @@ def getOPOrUserServices(openid_services):
     return op_services or openid_services
 
 
+def getDiscoveryCache():
+    """Return the discovery cache consulted by L{discover}, or None if
+    discovery results are not cached.
+
+    @rtype: L{openid.store.discocache.DiscoveryCache} or NoneType
+    """
+    return _discovery_cache
+
+
+def setDiscoveryCache(cache):
+    """Set the cache consulted by L{discover} before fetching anything.
+
+    Successful discovery is cached for as long as the C{xrd:Expires}
+    element or the C{Cache-Control} header of the discovered document
+    allows, or for the cache's default time to live if it says
+    nothing.  Failed discovery is cached for the cache's failure time
+    to live.
+
+    @param cache: The cache to use, or None to disable caching.
+    @type cache: L{openid.store.discocache.DiscoveryCache} or NoneType
+    """
+    global _discovery_cache
+    _discovery_cache = cache
+
+
+def _cacheControlTTL(headers):
+    """Return the number of seconds a response may be cached for
+    according to its C{Cache-Control} header, or None if it does not
+    say."""
+    if not headers:
+        return None
+
+    cache_control = headers.get('cache-control')
+    if not cache_control:
+        return None
+
+    directives = [d.strip().lower() for d in cache_control.split(',')]
+    if 'no-cache' in directives or 'no-store' in directives:
+        return 0
+
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return max(0, int(directive[8:].strip('"')))
+            except ValueError:
+                return None
+
+    return None
+
+
+def _expirationTTL(expires):
+    """Convert an C{xrd:Expires} date to a number of seconds from now."""
+    if expires is None:
+        return None
+
+    delta = expires - datetime.utcnow()
+    return max(0, delta.days * 24 * 60 * 60 + delta.seconds)
+
+
+def _xrdsTTL(body):
+    """Return the number of seconds until the XRD in this document
+    expires, or None if it does not expire or is not an XRDS
+    document."""
+    try:
+        expires = getXRDExpiration(getYadisXRD(parseXRDS(body)))
+    except (XRDSError, ValueError):
+        return None
+    return _expirationTTL(expires)
+
+
+def _minTTL(*ttls):
+    """Return the smallest of the given times to live that is not None."""
+    ttls = [ttl for ttl in ttls if ttl is not None]
+    if ttls:
+        return min(ttls)
+    return None
+
+
+def _copyServices(services):
+    return [copy.copy(service) for service in services]
+
+
+def _getCachedDiscovery(key):
+    """Return the cached discovery information for a normalized
+    identifier.
+
+    @return: (claimed_id, services), or None if nothing is cached.
+
+    @raises DiscoveryFailure: when failed discovery is cached.
+    @raises fetchers.HTTPFetchingError: when a failed fetch is cached.
+    """
+    cache = _discovery_cache
+    if cache is None:
+        return None
+
+    entry = cache.get(key)
+    if entry is None:
+        return None
+
+    _LOGGER.debug('Using cached discovery information for %s', key)
+    status, claimed_id, services = entry
+    if status == 'failure':
+        raise DiscoveryFailure(claimed_id, None)
+    elif status == 'fetch-failure':
+        raise fetchers.HTTPFetchingError(claimed_id)
+    return claimed_id, _copyServices(services)
+
+
+def _cacheDiscovery(key, claimed_id, services, ttl):
+    """Store the result of successful discovery in the discovery cache."""
+    cache = _discovery_cache
+    if cache is not None:
+        cache.set(key, ('success', claimed_id, _copyServices(services)), cache.getTTL(ttl))
+
+
+def _cacheDiscoveryFailure(key, why):
+    """Store the exception raised by failed discovery in the discovery
+    cache."""
+    cache = _discovery_cache
+    if cache is None:
+        return
+
+    if isinstance(why, DiscoveryFailure):
+        cache.set(key, ('failure', str(why), None), cache.failure_ttl)
+    else:
+        cache.set(key, ('fetch-failure', str(why), None), cache.failure_ttl)
+
+
+def _cachedDiscovery(key, discover_func):
+    """Perform discovery through the discovery cache.
+
+    @param key: The normalized identifier
+    @param discover_func: Function which performs the discovery on the
+        normalized identifier and returns a tuple of (claimed_id,
+        services, ttl), where ttl is a hint for the cache lifetime of
+        the result or None.
+
+    @return: (claimed_id, services)
+    """
+    cached = _getCachedDiscovery(key)
+    if cached is not None:
+        return cached
+
+    try:
+        claimed_id, services, ttl = discover_func(key)
+    except (DiscoveryFailure, fetchers.HTTPFetchingError) as why:
+        _cacheDiscoveryFailure(key, why)
+        raise
+
+    _cacheDiscovery(key, claimed_id, services, ttl)
+    return claimed_id, services
+
+
 def discoverYadis(uri):
     """Discover OpenID services for a URI. Tries Yadis and falls back
     on old-style <link rel='...'> discovery if Yadis fails.
@@ -360,12 +678,41 @@ def discoverYadis(uri):
 
     @raises DiscoveryFailure: when discovery fails.
     """
+    claimed_id, openid_services, _ = _discoverYadis(uri)
+    return claimed_id, openid_services
+
+
+def _discoverYadis(uri):
+    """See L{discoverYadis}.
+
+    @return: (claimed_id, services, ttl)
+    """
     # Might raise a yadis.discover.DiscoveryFailure if no document
     # came back for that URI at all.  I don't think falling back
     # to OpenID 1.0 discovery on the same URL will help, so don't
     # bother to catch it.
     response = yadisDiscover(uri)
 
+    result = _yadisServices(response)
+    if result is None:
+        # if we got the Yadis content-type or followed the Yadis
+        # header, re-fetch the document without following the Yadis
+        # header, with no Accept header.
+        return _discoverNoYadis(uri)
+    return result
+
+
+def _yadisServices(response):
+    """Extract the OpenID services from the result of Yadis discovery.
+
+    [non-blocking]
+
+    @type response: L{openid.yadis.discover.DiscoveryResult}
+
+    @return: (claimed_id, services, ttl), or None if the response is
+        an XRDS document without OpenID services and the identity URL
+        has to be fetched again without following the Yadis header.
+    """
     yadis_url = response.normalized_uri
     body = response.response_text
     try:
@@ -378,25 +725,42 @@ def discoverYadis(uri):
         # Either not an XRDS or there are no OpenID services.
 
         if response.isXRDS():
-            # if we got the Yadis content-type or followed the Yadis
-            # header, re-fetch the document without following the Yadis
-            # header, with no Accept header.
-            return discoverNoYadis(uri)
+            return None
 
         # Try to parse the response as HTML.
         # <link rel="...">
         openid_services = OpenIDServiceEndpoint.fromHTML(yadis_url, body)
+        ttl = _cacheControlTTL(response.headers)
+    else:
+        ttl = _minTTL(_cacheControlTTL(response.headers), _xrdsTTL(body))
 
-    return (yadis_url, getOPOrUserServices(openid_services))
+    return (yadis_url, getOPOrUserServices(openid_services), ttl)
 
 
 def discoverXRI(iname):
-    endpoints = []
     iname = normalizeXRI(iname)
+    return _cachedDiscovery(iname, _discoverXRI)
+
+
+def _discoverXRI(iname):
     try:
-        canonicalID, services = xrires.ProxyResolver().query(
+        canonicalID, services, expires = xrires.ProxyResolver().queryWithExpiration(
             iname, OpenIDServiceEndpoint.openid_type_uris)
+    except XRDSError:
+        _LOGGER.exception('xrds error on %s', iname)
+        return iname, [], None
+    return _xriServices(iname, canonicalID, services, expires)
+
+
+def _xriServices(iname, canonicalID, services, expires):
+    """Build the OpenID services from the result of XRI resolution.
+
+    [non-blocking]
 
+    @return: (claimed_id, services, ttl)
+    """
+    endpoints = []
+    try:
         if canonicalID is None:
             raise XRDSError('No CanonicalID found for XRI %r' % (iname,))
 
@@ -414,11 +778,25 @@ def discoverXRI(iname):
         endpoint.display_identifier = iname
 
     # FIXME: returned xri should probably be in some normal form
-    return iname, getOPOrUserServices(endpoints)
+    return iname, getOPOrUserServices(endpoints), _expirationTTL(expires)
 
 
 def discoverNoYadis(uri):
-    http_resp = fetchers.fetch(uri)
+    claimed_id, openid_services, _ = _discoverNoYadis(uri)
+    return claimed_id, openid_services
+
+
+def _discoverNoYadis(uri):
+    return _htmlServices(fetchers.fetch(uri))
+
+
+def _htmlServices(http_resp):
+    """Extract the OpenID services from an HTML identity page.
+
+    [non-blocking]
+
+    @return: (claimed_id, services, ttl)
+    """
     if http_resp.status not in (200, 206):
         raise DiscoveryFailure(
             'HTTP Response status from identity URL host is not 200. '
@@ -427,10 +805,14 @@ def discoverNoYadis(uri):
     claimed_id = http_resp.final_url
     openid_services = OpenIDServiceEndpoint.fromHTML(
         claimed_id, http_resp.body)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, _cacheControlTTL(http_resp.headers)
 
 
-def discoverURI(uri):
+def _normalizeURI(uri):
+    """Normalize an identity URL for discovery.
+
+    @raises DiscoveryFailure: when the URL is not an HTTP(S) URL.
+    """
     parsed = urlparse.urlparse(uri)
     if parsed[0] and parsed[1]:
         if parsed[0] not in ['http', 'https']:
@@ -438,10 +820,18 @@ def discoverURI(uri):
     else:
         uri = 'http://' + uri
 
-    uri = normalizeURL(uri)
-    claimed_id, openid_services = discoverYadis(uri)
+    return normalizeURL(uri)
+
+
+def discoverURI(uri):
+    uri = _normalizeURI(uri)
+    return _cachedDiscovery(uri, _discoverURI)
+
+
+def _discoverURI(uri):
+    claimed_id, openid_services, ttl = _discoverYadis(uri)
     claimed_id = normalizeURL(claimed_id)
-    return claimed_id, openid_services
+    return claimed_id, openid_services, ttl
 
 
 def discover(identifier):
@@ -8,25 +8,39 @@ integers. This module will work with the Python Cryptography Toolkit
 engine, but is currently found at:
 
 http://www.amk.ca/python/code/crypto
+
+Some of the primitives have several implementations, the fastest one
+available is picked when the module is imported.  See L{getBackends}.
 """
 
 __all__ = [
     'base64ToLong',
+    'BufferedRandom',
     'binaryToLong',
+    'const_eq',
+    'getBackends',
+    'getBytes',
+    'getRandomPool',
     'hmacSha1',
     'hmacSha256',
     'longToBase64',
     'longToBinary',
+    'powmod',
+    'precomputeBase',
     'randomString',
     'randrange',
+    'setRandomPool',
     'sha1',
     'sha256',
+    'strxor',
 ]
 
+import binascii
 import hashlib
 import hmac
 import os
 import random
+import threading
 
 from openid.oidutil import fromBase64, toBase64
 
@@ -94,7 +108,7 @@ else:
 
 # A cryptographically safe source of random bytes
 try:
-    getBytes = os.urandom
+    _getSystemBytes = os.urandom
 except AttributeError:
     try:
         from Crypto.Util.randpool import RandomPool
@@ -107,7 +121,7 @@ except AttributeError:
         except IOError:
             raise ImportError('No adequate source of randomness found!')
         else:
-            def getBytes(n):
+            def _getSystemBytes(n):
                 bytes = []
                 while n:
                     chunk = _urandom.read(n)
@@ -118,14 +132,14 @@ except AttributeError:
     else:
         _pool = RandomPool()
 
-        def getBytes(n, pool=_pool):
+        def _getSystemBytes(n, pool=_pool):
             if pool.entropy < n:
                 pool.randomize()
             return pool.get_bytes(n)
 
 # A randrange function that works for longs
 try:
-    randrange = random.SystemRandom().randrange
+    _systemRandrange = random.SystemRandom().randrange
 except AttributeError:
     # In Python 2.2's random.Random, randrange does not support
     # numbers larger than sys.maxint for randrange. For simplicity,
@@ -134,7 +148,7 @@ except AttributeError:
 
     _duplicate_cache = {}
 
-    def randrange(start, stop=None, step=1):
+    def _systemRandrange(start, stop=None, step=1):
         if stop is None:
             stop = start
             start = 0
@@ -170,6 +184,153 @@ except AttributeError:
         return start + (n % r) * step
 
 
+class _BufferedSystemRandom(random.SystemRandom):
+    """SystemRandom taking its bytes from a L{BufferedRandom}."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        random.SystemRandom.__init__(self)
+
+    def random(self):
+        return (long(binascii.hexlify(self._pool.getBytes(7)), 16) >> 3) * random.RECIP_BPF
+
+    def getrandbits(self, k):
+        if k <= 0:
+            raise ValueError('number of bits must be greater than zero')
+        if k != int(k):
+            raise TypeError('number of bits should be an integer')
+        bytes = (k + 7) // 8
+        x = long(binascii.hexlify(self._pool.getBytes(bytes)), 16)
+        return x >> (bytes * 8 - k)
+
+
+# Held while a buffer is reset in a forked process
+_fork_lock = threading.Lock()
+
+
+class BufferedRandom(object):
+    """A source of random bytes, which reads them from the operating
+    system in large chunks and hands them out in small pieces.
+
+    Nonces, association handles and secrets need only a few random bytes
+    each.  Reading them from the buffer saves a system call for most of
+    them.
+
+    A process forked from the one that filled the buffer discards it and
+    reads its own bytes, so the processes never share random bytes.  It
+    also replaces the lock of the buffer, which may have been held by
+    another thread when the process forked.
+    """
+
+    def __init__(self, chunk_size=4096):
+        """
+        @param chunk_size: How many bytes to read at once.  Larger
+            requests are read directly.
+        @type chunk_size: C{int}
+        """
+        self.chunk_size = chunk_size
+
+        self.requests = 0
+        self.refills = 0
+
+        self._buffer = ''
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._random = _BufferedSystemRandom(self)
+
+    def _checkFork(self):
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    # The parent process has the same bytes, and only
+                    # the thread which forked runs in this one.
+                    self._lock = threading.Lock()
+                    self._buffer = ''
+                    self._offset = 0
+                    self._pid = os.getpid()
+
+    def getStats(self):
+        """Return usage statistics of the buffer.
+
+        @return: dictionary with the C{chunk_size}, the number of bytes
+            C{available} in the buffer, the number of C{requests} served
+            and the number of C{refills} of the buffer
+        @rtype: C{dict}
+        """
+        self._checkFork()
+        with self._lock:
+            return {
+                'chunk_size': self.chunk_size,
+                'available': len(self._buffer) - self._offset,
+                'requests': self.requests,
+                'refills': self.refills,
+            }
+
+    def getBytes(self, n):
+        """Return C{n} random bytes.
+
+        @rtype: C{str}
+        """
+        self._checkFork()
+        with self._lock:
+            self.requests += 1
+            if n > self.chunk_size:
+                return _getSystemBytes(n)
+            if self._offset + n > len(self._buffer):
+                self._buffer = _getSystemBytes(self.chunk_size)
+                self._offset = 0
+                self.refills += 1
+            data = self._buffer[self._offset:self._offset + n]
+            self._offset += n
+            return data
+
+    def randrange(self, start, stop=None, step=1):
+        """Return a random number from C{range(start, stop, step)}, like
+        C{random.randrange}, but with bytes from the buffer."""
+        return self._random.randrange(start, stop, step)
+
+
+_random_pool = None
+
+
+def getRandomPool():
+    """Return the buffer of random bytes used by L{getBytes},
+    L{randrange} and L{randomString}, or None if the bytes are read
+    from the operating system every time.
+
+    @rtype: L{BufferedRandom} or NoneType
+    """
+    return _random_pool
+
+
+def setRandomPool(pool):
+    """Set the buffer of random bytes used by L{getBytes}, L{randrange}
+    and L{randomString}, and so by the nonces, association handles and
+    secrets of the consumer and the server.
+
+    @param pool: The buffer to use, or None to disable it.
+    @type pool: L{BufferedRandom} or NoneType
+    """
+    global _random_pool
+    _random_pool = pool
+
+
+def getBytes(n):
+    """Return C{n} cryptographically safe random bytes."""
+    if _random_pool is not None:
+        return _random_pool.getBytes(n)
+    return _getSystemBytes(n)
+
+
+def randrange(start, stop=None, step=1):
+    """A cryptographically safe C{random.randrange}, which works for
+    longs."""
+    if _random_pool is not None:
+        return _random_pool.randrange(start, stop, step)
+    return _systemRandrange(start, stop, step)
+
+
 def longToBase64(l):
     return toBase64(longToBinary(l))
 
@@ -178,7 +339,7 @@ def base64ToLong(s):
     return binaryToLong(fromBase64(s))
 
 
-def randomString(length, chrs=None):
+def _pythonRandomString(length, chrs=None):
     """Produce a string of length random bytes, chosen from chrs."""
     if chrs is None:
         return getBytes(length)
@@ -187,7 +348,33 @@ def randomString(length, chrs=None):
         return ''.join([chrs[randrange(n)] for _ in xrange(length)])
 
 
-def const_eq(s1, s2):
+def _bulkRandomString(length, chrs=None):
+    """Produce a string of length random bytes, chosen from chrs.
+
+    The characters are picked by random bytes read at once, instead of
+    a call to randrange for each.
+    """
+    if chrs is None:
+        return getBytes(length)
+    n = len(chrs)
+    if n > 256:
+        return _pythonRandomString(length, chrs)
+
+    # Bytes of this value or higher are skipped, they would make the
+    # first characters more likely.
+    limit = 256 - 256 % n
+    chars = []
+    while len(chars) < length:
+        for byte in getBytes((length - len(chars)) * 256 // limit + 1):
+            byte = ord(byte)
+            if byte < limit:
+                chars.append(chrs[byte % n])
+                if len(chars) == length:
+                    break
+    return ''.join(chars)
+
+
+def _pythonConstEq(s1, s2):
     if len(s1) != len(s2):
         return False
 
@@ -196,3 +383,137 @@ def const_eq(s1, s2):
         result = result and (s1[i] == s2[i])
 
     return result
+
+
+def _compareDigestConstEq(s1, s2):
+    # compare_digest only takes two byte strings or two ASCII unicode strings.
+    if isinstance(s1, unicode):
+        s1 = s1.encode('utf-8')
+    if isinstance(s2, unicode):
+        s2 = s2.encode('utf-8')
+    return hmac.compare_digest(s1, s2)
+
+
+def _pythonStrxor(x, y):
+    if len(x) != len(y):
+        raise ValueError('Inputs to strxor must have the same length')
+
+    return "".join([chr(ord(a) ^ ord(b)) for a, b in zip(x, y)])
+
+
+def _intStrxor(x, y):
+    if len(x) != len(y):
+        raise ValueError('Inputs to strxor must have the same length')
+    if not x:
+        return ''
+
+    # XOR the strings as two numbers.
+    result = int(binascii.hexlify(x), 16) ^ int(binascii.hexlify(y), 16)
+    return binascii.unhexlify('%0*x' % (len(x) * 2, result))
+
+
+class _FixedBase(object):
+    """Powers of a base modulo a modulus, precomputed for every
+    C{window} bits of the exponents."""
+
+    window = 6
+
+    def __init__(self, base, modulus):
+        self.base = base
+        self.modulus = modulus
+        self.rows = (modulus.bit_length() + self.window - 1) // self.window
+        self._table = None
+        self._lock = threading.Lock()
+
+    def _getTable(self):
+        with self._lock:
+            if self._table is None:
+                table = []
+                power = self.base % self.modulus
+                for _ in xrange(self.rows):
+                    row = [1]
+                    for _ in xrange(1, 1 << self.window):
+                        row.append(row[-1] * power % self.modulus)
+                    table.append(row)
+                    power = row[-1] * power % self.modulus
+                self._table = table
+            return self._table
+
+    def pow(self, exponent):
+        if exponent.bit_length() > self.rows * self.window:
+            return pow(self.base, exponent, self.modulus)
+        table = self._table or self._getTable()
+        mask = (1 << self.window) - 1
+        modulus = self.modulus
+        result = 1
+        for row in table:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % modulus
+            exponent >>= self.window
+        return result % modulus
+
+
+_fixed_bases = {}
+
+
+def precomputeBase(base, modulus):
+    """Precompute the powers of a base often raised modulo a modulus,
+    like the generator of Diffie-Hellman, for L{powmod}.
+
+    The table of the powers takes about 1.5MB for a 1024 bit modulus.
+    It is computed when the base is first raised.
+    """
+    if (base, modulus) not in _fixed_bases:
+        _fixed_bases[(base, modulus)] = _FixedBase(base, modulus)
+
+
+def _fixedBasePowmod(base, exponent, modulus):
+    fixed_base = _fixed_bases.get((base, modulus))
+    if fixed_base is None or exponent < 0:
+        return pow(base, exponent, modulus)
+    return fixed_base.pow(exponent)
+
+
+# The implementations of the primitives, fastest first.  The first
+# available one is used.
+_backends = {
+    'const_eq': [
+        ('compare_digest', _compareDigestConstEq if hasattr(hmac, 'compare_digest') else None),
+        ('python', _pythonConstEq),
+    ],
+    'powmod': [
+        ('fixed-base', _fixedBasePowmod),
+        ('builtin', pow),
+    ],
+    'randomString': [
+        ('bulk', _bulkRandomString),
+        ('python', _pythonRandomString),
+    ],
+    'strxor': [
+        ('int', _intStrxor),
+        ('python', _pythonStrxor),
+    ],
+}
+
+
+def getBackends(primitive):
+    """Return the available implementations of a primitive.
+
+    @param primitive: The name of the primitive, C{'const_eq'},
+        C{'powmod'}, C{'randomString'} or C{'strxor'}
+    @type primitive: str
+
+    @return: The names and functions of the implementations, the one
+        in use first
+    @rtype: [(str, function)]
+    """
+    return [(name, function) for name, function in _backends[primitive] if function is not None]
+
+
+const_eq = getBackends('const_eq')[0][1]
+powmod = getBackends('powmod')[0][1]
+randomString = getBackends('randomString')[0][1]
+strxor = getBackends('strxor')[0][1]
@@ -1,16 +1,19 @@
+import logging
+import os
+import threading
+from collections import deque
+
 from openid import cryptutil
 
+_LOGGER = logging.getLogger(__name__)
 
-def _xor(a_b):
-    a, b = a_b
-    return chr(ord(a) ^ ord(b))
+_key_pool = None
 
+# Held while a key pool is reset in a forked process
+_fork_lock = threading.Lock()
 
-def strxor(x, y):
-    if len(x) != len(y):
-        raise ValueError('Inputs to strxor must have the same length')
 
-    return "".join(map(_xor, zip(x, y)))
+strxor = cryptutil.strxor
 
 
 class DiffieHellman(object):
@@ -23,18 +26,35 @@ class DiffieHellman(object):
 
     @classmethod
     def fromDefaults(cls):
-        return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN)
+        """Create an instance with the default modulus and generator,
+        taking its key pair from the key pool if one is set.
+
+        @rtype: L{DiffieHellman}
+        """
+        keypair = None
+        if _key_pool is not None:
+            keypair = _key_pool.take()
+        return cls(cls.DEFAULT_MOD, cls.DEFAULT_GEN, keypair)
 
-    def __init__(self, modulus, generator):
+    def __init__(self, modulus, generator, keypair=None):
+        """
+        @param keypair: A C{(private, public)} key pair generated for
+            the modulus and the generator.  A new one is generated if
+            None.
+        @type keypair: C{tuple} or C{NoneType}
+        """
         self.modulus = long(modulus)
         self.generator = long(generator)
 
-        self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        if keypair is None:
+            self._setPrivate(cryptutil.randrange(1, modulus - 1))
+        else:
+            self.private, self.public = keypair
 
     def _setPrivate(self, private):
         """This is here to make testing easier"""
         self.private = private
-        self.public = pow(self.generator, self.private, self.modulus)
+        self.public = cryptutil.powmod(self.generator, self.private, self.modulus)
 
     def usingDefaultValues(self):
         return (self.modulus == self.DEFAULT_MOD and
@@ -47,3 +67,161 @@ class DiffieHellman(object):
         dh_shared = self.getSharedSecret(composite)
         hashed_dh_shared = hash_func(cryptutil.longToBinary(dh_shared))
         return strxor(secret, hashed_dh_shared)
+
+
+cryptutil.precomputeBase(DiffieHellman.DEFAULT_GEN, DiffieHellman.DEFAULT_MOD)
+
+
+def generateKeyPair(modulus=DiffieHellman.DEFAULT_MOD, generator=DiffieHellman.DEFAULT_GEN):
+    """Generate a random C{(private, public)} key pair.
+
+    @rtype: C{tuple}
+    """
+    private = cryptutil.randrange(1, modulus - 1)
+    return private, cryptutil.powmod(long(generator), private, long(modulus))
+
+
+class DiffieHellmanKeyPool(object):
+    """Key pairs for the default modulus and generator, generated in
+    advance by a background thread.
+
+    Computing a public key is a modular exponentiation over the 1024
+    bit modulus.  Taking the key pairs from the pool moves that work
+    out of the association requests, into the time between bursts of
+    them.  The thread holds the interpreter lock while it computes, so
+    it does not add CPU time; it only spreads it.
+
+    Every key pair is handed out once.  A process forked from the one
+    that generated the key pairs discards them and generates its own.
+    It also replaces the lock of the pool, which the background thread
+    may have held when the process forked.
+    """
+
+    def __init__(self, size=100, low_water=None):
+        """
+        @param size: How many key pairs to keep ready.
+        @type size: C{int}
+
+        @param low_water: When fewer key pairs are left, the pool is
+            refilled.  Half of C{size} by default.
+        @type low_water: C{int} or C{NoneType}
+        """
+        if low_water is None:
+            low_water = size // 2
+        self.size = size
+        self.low_water = low_water
+
+        self.hits = 0
+        self.misses = 0
+
+        self._keypairs = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._pid = os.getpid()
+        self._thread = None
+
+    def getStats(self):
+        """Return usage statistics of the pool.
+
+        @return: dictionary with the C{size} of the pool, the number of
+            C{available} key pairs, the number of C{hits} and C{misses}
+            (requests made when the pool was empty) and the C{hit_rate}
+        @rtype: C{dict}
+        """
+        self._checkFork()
+        with self._lock:
+            taken = self.hits + self.misses
+            return {
+                'size': self.size,
+                'available': len(self._keypairs),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / taken if taken else 0.0,
+            }
+
+    def _checkFork(self):
+        # Must be called without the lock held.
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    # The parent process is handing out the same key
+                    # pairs, and only the thread which forked runs in
+                    # this one.
+                    self._lock = threading.Lock()
+                    self._keypairs = deque()
+                    self._thread = None
+                    self._refill = threading.Event()
+                    self._pid = os.getpid()
+
+    def _startThread(self):
+        # Must be called with the lock held.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(self._refill, ), name='DiffieHellmanKeyPool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, refill):
+        while True:
+            refill.wait()
+            refill.clear()
+            try:
+                self.fill()
+            except Exception:
+                _LOGGER.exception('Error generating Diffie-Hellman key pairs')
+
+    def fill(self):
+        """Generate key pairs until the pool is full.  Called by the
+        background thread, or directly to fill the pool in advance."""
+        while True:
+            self._checkFork()
+            with self._lock:
+                if len(self._keypairs) >= self.size:
+                    return
+                pid = self._pid
+            keypair = generateKeyPair()
+            with self._lock:
+                if pid == os.getpid():
+                    self._keypairs.append(keypair)
+
+    def take(self):
+        """Take a key pair out of the pool and refill it in the
+        background if it runs low.
+
+        @return: A C{(private, public)} key pair, or None if the pool is
+            empty.
+        @rtype: C{tuple} or C{NoneType}
+        """
+        self._checkFork()
+        with self._lock:
+            if self._keypairs:
+                keypair = self._keypairs.popleft()
+                self.hits += 1
+            else:
+                keypair = None
+                self.misses += 1
+
+            if len(self._keypairs) < self.low_water:
+                self._startThread()
+                self._refill.set()
+        return keypair
+
+
+def getKeyPool():
+    """Return the key pool used by L{DiffieHellman.fromDefaults}, or
+    None if every key pair is generated when it is needed.
+
+    @rtype: L{DiffieHellmanKeyPool} or NoneType
+    """
+    return _key_pool
+
+
+def setKeyPool(pool):
+    """Set the key pool used by L{DiffieHellman.fromDefaults}, so the
+    sessions of both the consumer and the server take their key pairs
+    from it.
+
+    @param pool: The pool to use, or None to disable it.
+    @type pool: L{DiffieHellmanKeyPool} or NoneType
+    """
+    global _key_pool
+    _key_pool = pool
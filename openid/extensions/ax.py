@@ -369,7 +369,7 @@ class FetchRequest(AXMessage):
 
         if_available = toTypeURIs(aliases, ax_args.get('if_available'))
 
-        all_type_uris = required + if_available
+        all_type_uris = set(required + if_available)
 
         for type_uri in aliases.iterNamespaceURIs():
             if type_uri not in all_type_uris:
@@ -5,16 +5,24 @@ This module contains the HTTP fetcher interface and several implementations.
 
 __all__ = ['fetch', 'getDefaultFetcher', 'setDefaultFetcher', 'HTTPResponse',
            'HTTPFetcher', 'createHTTPFetcher', 'HTTPFetchingError',
-           'HTTPError']
+           'HTTPError', 'PooledHTTPFetcher', 'AsyncHTTPFetcher']
 
 import cStringIO
+import errno
+import httplib
+import logging
+import socket
 import sys
+import threading
 import time
 import urllib2
+import urlparse
 
 import openid
 import openid.urinorm
 
+_LOGGER = logging.getLogger(__name__)
+
 # Try to import httplib2 for caching support
 # http://bitworking.org/projects/httplib2/
 try:
@@ -154,6 +162,40 @@ class HTTPFetcher(object):
         raise NotImplementedError
 
 
+class AsyncHTTPFetcher(object):
+    """
+    This class is the interface for HTTP fetchers that do not block,
+    as used by L{openid.consumer.asyncconsumer}.  Implement it on top
+    of the HTTP client of your event loop.
+    """
+
+    def fetch(self, url, body, headers, callback, errback):
+        """
+        This starts an HTTP POST or GET, following redirects along the
+        way, and returns without waiting for the response.  If a body
+        is specified, then the request will be a POST.  Otherwise, it
+        will be a GET.
+
+        Exactly one of the callbacks must be called, once the request
+        is finished.  They must not be called before this method
+        returns.
+
+        @param headers: HTTP headers to include with the request, or
+            None
+        @type headers: {str:str}
+
+        @param callback: Called with the L{HTTPResponse} to the
+            request. HTTP error responses, like 404 or 500, are
+            responses.
+
+        @param errback: Called with an exception if there are network
+            or protocol errors.
+
+        @return: None
+        """
+        raise NotImplementedError
+
+
 def _allowedURL(url):
     return url.startswith('http://') or url.startswith('https://')
 
@@ -438,3 +480,293 @@ class HTTPLib2Fetcher(HTTPFetcher):
             headers=dict(httplib2_response.items()),
             status=httplib2_response.status,
         )
+
+
+class _PooledConnection(object):
+    """An C{httplib} connection and its bookkeeping."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.requests = 0
+        self.last_used = time.time()
+
+    def close(self):
+        self.connection.close()
+
+
+class _StaleConnection(Exception):
+    """A pooled connection failed before any of the response was
+    received.
+
+    @ivar unread: Whether the server closed the connection before
+        reading the request.
+    """
+
+    def __init__(self, error, unread=False):
+        Exception.__init__(self, error)
+        self.error = error
+        self.unread = unread
+
+
+def _isEmptyStatusLine(error):
+    """Return whether the BadStatusLine was raised for a connection
+    closed without a status line, which httplib reports as C{''} or,
+    in later versions, with a message."""
+    return error.line in ("''", '') or error.line.startswith('No status line received')
+
+
+class PooledHTTPFetcher(HTTPFetcher):
+    """An C{L{HTTPFetcher}} that keeps persistent (keep-alive)
+    connections to the hosts it talks to, so that repeated requests
+    to the same OpenID provider do not pay for a new TCP and TLS
+    handshake each time.
+
+    An instance may be shared between threads, for instance by
+    passing it to C{L{setDefaultFetcher}}. A connection is only used
+    by one request at a time; idle connections are kept in a pool per
+    scheme, host and port.
+
+    @ivar hits: The number of requests that reused a pooled connection.
+    @type hits: int
+
+    @ivar misses: The number of requests that had to open a new
+        connection.
+    @type misses: int
+    """
+    ALLOWED_TIME = 20  # seconds
+    MAX_REDIRECTS = 10
+
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    # Requests which are sent again on a new connection when a pooled
+    # one turns out to be closed.  POST requests, such as associate and
+    # check_authentication, are not idempotent.  They are only resent
+    # when the server closed the connection before reading them.
+    resent_methods = ('GET', 'HEAD')
+
+    # POST requests are only sent on connections idle for less than
+    # this many seconds, shorter than the keep-alive timeouts of most
+    # servers.
+    post_idle_timeout = 2
+
+    def __init__(self, pool_size=4, idle_timeout=60, max_requests=100):
+        """
+        @param pool_size: The maximum number of idle connections kept
+            for each host.
+        @type pool_size: int
+
+        @param idle_timeout: The number of seconds after which an idle
+            connection is closed instead of reused.
+        @type idle_timeout: int or float
+
+        @param max_requests: The number of requests after which a
+            connection is closed instead of reused.
+        @type max_requests: int
+        """
+        super(PooledHTTPFetcher, self).__init__()
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+
+        self.hits = 0
+        self.misses = 0
+
+        # (scheme, host, port) -> [_PooledConnection], most recently
+        # used last.
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def getStats(self):
+        """Return the pool counters.
+
+        @returns: A dictionary with the C{hits} and C{misses}
+            counters and the number of C{idle} pooled connections.
+        @rtype: {str: int}
+        """
+        with self._lock:
+            idle = sum(len(pool) for pool in self._pools.itervalues())
+            return {'hits': self.hits, 'misses': self.misses, 'idle': idle}
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools = self._pools
+            self._pools = {}
+
+        for pool in pools.itervalues():
+            for pooled in pool:
+                pooled.close()
+
+    def _checkout(self, key, max_idle=None):
+        """Return an idle connection to the host, or None if there is
+        none that can be reused.
+
+        @param max_idle: If given, only return a connection idle for
+            less than this many seconds.
+        """
+        now = time.time()
+        stale = []
+        pooled = None
+        with self._lock:
+            pool = self._pools.get(key, [])
+            while pool:
+                candidate = pool.pop()
+                if now - candidate.last_used > self.idle_timeout:
+                    stale.append(candidate)
+                elif max_idle is not None and now - candidate.last_used > max_idle:
+                    # The most recently used one is idle for too long.
+                    pool.append(candidate)
+                    break
+                else:
+                    pooled = candidate
+                    break
+
+        for candidate in stale:
+            candidate.close()
+
+        return pooled
+
+    def _checkin(self, key, pooled):
+        """Return a connection to the pool after a complete response
+        was read from it."""
+        pooled.last_used = time.time()
+        if pooled.requests < self.max_requests:
+            with self._lock:
+                pool = self._pools.setdefault(key, [])
+                if len(pool) < self.pool_size:
+                    pool.append(pooled)
+                    return
+
+        pooled.close()
+
+    def _count(self, reused):
+        with self._lock:
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _send(self, pooled, method, path, body, headers):
+        """Send one request over a connection and read the response.
+
+        @returns: (httplib.HTTPResponse, body)
+
+        @raises _StaleConnection: When the connection was closed by the
+            server before any of the response was received, so the
+            request can be resent.  Its C{unread} is true if the
+            server closed it before reading the request.
+        """
+        pooled.requests += 1
+        try:
+            try:
+                pooled.connection.request(method, path, body, headers)
+            except socket.timeout:
+                raise
+            except socket.error as error:
+                if error.errno in (errno.ECONNRESET, errno.EPIPE):
+                    raise _StaleConnection(error, unread=True)
+                raise
+            try:
+                response = pooled.connection.getresponse()
+            except httplib.BadStatusLine as error:
+                # The connection was closed without a byte of response
+                # if the status line is empty.
+                raise _StaleConnection(error, unread=_isEmptyStatusLine(error))
+            return response, response.read(MAX_RESPONSE_KB * 1024)
+        except Exception:
+            pooled.close()
+            raise
+
+    def _request(self, method, url, body, headers):
+        parsed = urlparse.urlsplit(url)
+        scheme = parsed.scheme.lower()
+        if scheme not in self.connection_classes or not parsed.hostname:
+            raise ValueError('Bad URL: %r' % (url,))
+
+        key = (scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+
+        response = None
+        if method in self.resent_methods:
+            pooled = self._checkout(key)
+        else:
+            pooled = self._checkout(key, max_idle=self.post_idle_timeout)
+        if pooled is not None:
+            try:
+                response, data = self._send(pooled, method, path, body, headers)
+            except _StaleConnection as why:
+                if method not in self.resent_methods and not why.unread:
+                    raise why.error
+                # The server has most likely closed the idle
+                # connection. Try again on a fresh one.
+                _LOGGER.debug('Pooled connection to %s failed, reconnecting', parsed.netloc)
+            else:
+                self._count(reused=True)
+
+        if response is None:
+            connection_class = self.connection_classes[scheme]
+            pooled = _PooledConnection(connection_class(parsed.hostname, parsed.port, timeout=self.ALLOWED_TIME))
+            try:
+                response, data = self._send(pooled, method, path, body, headers)
+            except _StaleConnection as why:
+                raise why.error
+            self._count(reused=False)
+
+        # The connection can only be reused if the whole response was
+        # read and the server did not ask for it to be closed.
+        if response.isclosed() and not response.will_close:
+            self._checkin(key, pooled)
+        else:
+            pooled.close()
+
+        return HTTPResponse(
+            final_url=url,
+            status=response.status,
+            headers=dict((name.lower(), value) for name, value in response.getheaders()),
+            body=data,
+        )
+
+    def fetch(self, url, body=None, headers=None):
+        """Perform an HTTP request over a pooled connection.
+
+        @raises Exception: Any exception that can be raised by httplib
+
+        @see: C{L{HTTPFetcher.fetch}}
+        """
+        if not _allowedURL(url):
+            raise ValueError('Bad URL scheme: %r' % (url,))
+
+        if headers is None:
+            headers = {}
+
+        headers.setdefault('User-Agent', "%s Python-httplib" % (USER_AGENT,))
+
+        if body is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        for _ in xrange(self.MAX_REDIRECTS + 1):
+            resp = self._request(method, url, body, headers)
+            if resp.status not in (301, 302, 303, 307):
+                return resp
+
+            location = resp.headers.get('location')
+            if location is None:
+                raise HTTPError('Redirect (%s) returned without a location' % (resp.status,))
+
+            url = urlparse.urljoin(url, location)
+            if not _allowedURL(url):
+                raise HTTPError('Redirected to a disallowed URL: %r' % (url,))
+
+            # Redirects are always GETs
+            method = 'GET'
+            body = None
+
+        raise HTTPError('Too many redirects fetching: %r' % (url,))
@@ -1,4 +1,4 @@
-__all__ = ['seqToKV', 'kvToSeq', 'dictToKV', 'kvToDict']
+__all__ = ['seqToKV', 'fastSeqToKV', 'kvToSeq', 'dictToKV', 'kvToDict']
 
 import logging
 import types
@@ -64,6 +64,40 @@ def seqToKV(seq, strict=False):
     return ''.join(lines).encode('UTF8')
 
 
+def fastSeqToKV(seq):
+    """Represent a sequence of pairs of strings as KV form, like
+    L{seqToKV}, but without the per-pair warnings.
+
+    This is meant for the pairs of signed messages, which are strings
+    already.  Only the checks keeping the result unambiguous are made,
+    if any of them fails, the pairs are handed to L{seqToKV}.
+
+    @param seq: The pairs
+    @type seq: [(str, (unicode|str))]
+
+    @return: A string representation of the sequence
+    @rtype: str
+    """
+    lines = []
+    for k, v in seq:
+        if type(k) is unicode:
+            k = k.encode('UTF8')
+        elif type(k) is not str:
+            return seqToKV(seq)
+        if type(v) is unicode:
+            v = v.encode('UTF8')
+        elif type(v) is not str:
+            return seqToKV(seq)
+        if ':' in k:
+            return seqToKV(seq)
+        lines.append(k + ':' + v + '\n')
+
+    data = ''.join(lines)
+    if data.count('\n') != len(lines):
+        return seqToKV(seq)
+    return data
+
+
 def kvToSeq(data, strict=False):
     """
 
@@ -1,10 +1,9 @@
 """Extension argument processing code
 """
-__all__ = ['Message', 'NamespaceMap', 'no_default', 'registerNamespaceAlias',
+__all__ = ['Message', 'FrozenMessage', 'LazyMessage', 'NamespaceMap', 'no_default', 'registerNamespaceAlias',
            'OPENID_NS', 'BARE_NS', 'OPENID1_NS', 'OPENID2_NS', 'SREG_URI',
            'IDENTIFIER_SELECT']
 
-import copy
 import urllib
 import warnings
 
@@ -134,11 +133,18 @@ class Message(object):
 
     @ivar ns_args: two-level dictionary of the values in this message,
         grouped by namespace URI. The first level is the namespace
-        URI.
+        URI.  Namespaces without arguments are not in it.  Change it
+        with L{setArg}, L{updateArgs} and L{delArg} only, as the
+        encoded forms of the message are cached until they are called.
     """
 
     allowed_openid_namespaces = [OPENID1_NS, THE_OTHER_OPENID1_NS, OPENID2_NS]
 
+    # The cached encoded forms of the message by name, valid while
+    # _encoded_for is (namespaces, namespaces.version).
+    _encoded = None
+    _encoded_for = None
+
     def __init__(self, openid_namespace=None, implicit_namespace=None):
         """Create an empty Message.
 
@@ -148,7 +154,7 @@ class Message(object):
         @raises InvalidOpenIDNamespace: if openid_namespace is not in
             L{Message.allowed_openid_namespaces}
         """
-        self.args = {}
+        self.ns_args = {}
         self.namespaces = NamespaceMap()
         if openid_namespace is not None:
             if implicit_namespace is None:
@@ -180,8 +186,8 @@ class Message(object):
 
         self = cls._fromOpenIDArgs(openid_args)
 
-        for key, value in bare_args.items():
-            self.args[(BARE_NS, key)] = value
+        if bare_args:
+            self.ns_args[BARE_NS] = bare_args
         return self
 
     @classmethod
@@ -237,7 +243,7 @@ class Message(object):
                 else:
                     self.namespaces.addAlias(ns_uri, ns_alias, implicit=True)
 
-            self.setArg(ns_uri, ns_key, value)
+            self._setArg(ns_uri, ns_key, value)
         return self
 
     def _getDefaultNamespace(self, mystery_alias):
@@ -286,12 +292,75 @@ class Message(object):
         """Create a Message from a KVForm string"""
         return cls.fromOpenIDArgs(kvform.kvToDict(kvform_string))
 
+    def _copyAs(self, cls):
+        message = cls.__new__(cls)
+        message.__dict__.update(self.__dict__)
+        message.ns_args = dict((namespace, args.copy()) for namespace, args in self.ns_args.iteritems())
+        message.namespaces = self.namespaces.copy()
+        message._encoded = message._encoded_for = None
+        return message
+
     def copy(self):
-        return copy.deepcopy(self)
+        """Return a copy of this message, which may be changed without
+        changing this one.
+
+        The values of the arguments are strings, which are immutable,
+        so only the containers holding them are copied.
+
+        @rtype: L{Message}
+        """
+        return self._copyAs(self.__class__)
+
+    def freeze(self):
+        """Return a copy of this message which can't be changed.
+
+        @rtype: L{FrozenMessage}
+        """
+        return self._copyAs(FrozenMessage)
+
+    @property
+    def args(self):
+        """All of the arguments, keyed by C{(namespace, key)}.  This is
+        a copy, changing it does not change the message.
+
+        @rtype: dict
+        """
+        return dict(((namespace, key), value)
+                    for namespace, args in self.ns_args.iteritems()
+                    for key, value in args.iteritems())
+
+    def _getEncoded(self, form, encode):
+        """Return an encoded form of the message, encoding it only if it
+        has changed since it was last encoded.
+
+        @param form: The name of the form
+        @param encode: Returns the encoded form
+        """
+        namespaces = self.namespaces
+        encoded_for = self._encoded_for
+        if encoded_for is None or encoded_for[0] is not namespaces or encoded_for[1] != namespaces.version:
+            self._encoded = {}
+            self._encoded_for = (namespaces, namespaces.version)
+        try:
+            return self._encoded[form]
+        except KeyError:
+            value = self._encoded[form] = encode()
+            return value
+
+    def _changed(self):
+        self._encoded = self._encoded_for = None
 
     def toPostArgs(self):
         """Return all arguments with openid. in front of namespaced arguments.
         """
+        return dict(self._getPostArgs())
+
+    def _getPostArgs(self):
+        """Return the cached result of L{toPostArgs}, which must not be
+        changed."""
+        return self._getEncoded('post', self._encodePostArgs)
+
+    def _encodePostArgs(self):
         args = {}
 
         # Add namespace definitions to the output
@@ -304,10 +373,23 @@ class Message(object):
                 ns_key = 'openid.ns.' + alias
             args[ns_key] = oidutil.toUnicode(ns_uri).encode('UTF-8')
 
-        for (ns_uri, ns_key), value in self.args.iteritems():
-            key = self.getKey(ns_uri, ns_key)
-            # Ensure the resulting value is an UTF-8 encoded bytestring.
-            args[key] = oidutil.toUnicode(value).encode('UTF-8')
+        for ns_uri, ns_args in self.ns_args.iteritems():
+            # Every key of a namespace has the same prefix.
+            if ns_uri == BARE_NS:
+                prefix = ''
+            else:
+                ns_alias = self.namespaces.getAlias(ns_uri)
+                if ns_alias is None:
+                    prefix = None
+                elif ns_alias == NULL_NAMESPACE:
+                    prefix = 'openid.'
+                else:
+                    prefix = 'openid.%s.' % (ns_alias,)
+
+            for ns_key, value in ns_args.iteritems():
+                key = None if prefix is None else prefix + ns_key
+                # Ensure the resulting value is an UTF-8 encoded bytestring.
+                args[key] = oidutil.toUnicode(value).encode('UTF-8')
 
         return args
 
@@ -315,7 +397,13 @@ class Message(object):
         """Return all namespaced arguments, failing if any
         non-namespaced arguments exist."""
         # FIXME - undocumented exception
-        post_args = self.toPostArgs()
+        return dict(self._getArgs())
+
+    def _getArgs(self):
+        return self._getEncoded('args', self._encodeArgs)
+
+    def _encodeArgs(self):
+        post_args = self._getPostArgs()
         kvargs = {}
         for k, v in post_args.iteritems():
             if not k.startswith('openid.'):
@@ -365,7 +453,7 @@ class Message(object):
         form.attrib[u'accept-charset'] = u'UTF-8'
         form.attrib[u'enctype'] = u'application/x-www-form-urlencoded'
 
-        for name, value in self.toPostArgs().iteritems():
+        for name, value in self._getPostArgs().iteritems():
             attrs = {u'type': u'hidden',
                      u'name': oidutil.toUnicode(name),
                      u'value': oidutil.toUnicode(value)}
@@ -380,18 +468,32 @@ class Message(object):
     def toURL(self, base_url):
         """Generate a GET URL with the parameters in this message
         attached as query parameters."""
-        return oidutil.appendArgs(base_url, self.toPostArgs())
+        query = self.toURLEncoded()
+        if not query:
+            return base_url
+        elif '?' in base_url:
+            return '%s&%s' % (base_url, query)
+        else:
+            return '%s?%s' % (base_url, query)
 
     def toKVForm(self):
         """Generate a KVForm string that contains the parameters in
         this message. This will fail if the message contains arguments
         outside of the 'openid.' prefix.
         """
-        return kvform.dictToKV(self.toArgs())
+        return self._getEncoded('kvform', lambda: kvform.dictToKV(self._getArgs()))
 
     def toURLEncoded(self):
         """Generate an x-www-urlencoded string"""
-        args = sorted(self.toPostArgs().items())
+        return self._getEncoded('urlencoded', self._encodeURLEncoded)
+
+    def _encodeURLEncoded(self):
+        args = []
+        for key, value in sorted(self._getPostArgs().iteritems()):
+            # The values are encoded already.
+            if not isinstance(key, str):
+                key = key.encode('UTF-8')
+            args.append((key, value))
         return urllib.urlencode(args)
 
     def _fixNS(self, namespace):
@@ -424,7 +526,7 @@ class Message(object):
 
     def hasKey(self, namespace, ns_key):
         namespace = self._fixNS(namespace)
-        return (namespace, ns_key) in self.args
+        return ns_key in self.ns_args.get(namespace, ())
 
     def getKey(self, namespace, ns_key):
         """Get the key for a particular namespaced argument"""
@@ -465,9 +567,8 @@ class Message(object):
             had an OpenID namespace set
         """
         namespace = self._fixNS(namespace)
-        args_key = (namespace, key)
         try:
-            return self.args[args_key]
+            return self.ns_args[namespace][key]
         except KeyError:
             if default is no_default:
                 raise KeyError((namespace, key))
@@ -481,12 +582,7 @@ class Message(object):
         @returntype: dict
         """
         namespace = self._fixNS(namespace)
-        return dict([
-            (ns_key, value)
-            for ((pair_ns, ns_key), value)
-            in self.args.iteritems()
-            if pair_ns == namespace
-        ])
+        return dict(self.ns_args.get(namespace, ()))
 
     def updateArgs(self, namespace, updates):
         """Set multiple key/value pairs in one call
@@ -496,20 +592,40 @@ class Message(object):
         """
         namespace = self._fixNS(namespace)
         for k, v in updates.iteritems():
-            self.setArg(namespace, k, v)
+            assert k is not None
+            assert v is not None
+        if updates:
+            self._changed()
+            self.ns_args.setdefault(namespace, {}).update(updates)
+            if not (namespace is BARE_NS):
+                self.namespaces.add(namespace)
 
     def setArg(self, namespace, key, value):
         """Set a single argument in this namespace"""
+        self._setArg(namespace, key, value)
+
+    def _setArg(self, namespace, key, value):
         assert key is not None
         assert value is not None
         namespace = self._fixNS(namespace)
-        self.args[(namespace, key)] = value
+        self._changed()
+        try:
+            self.ns_args[namespace][key] = value
+        except KeyError:
+            self.ns_args[namespace] = {key: value}
         if not (namespace is BARE_NS):
             self.namespaces.add(namespace)
 
     def delArg(self, namespace, key):
         namespace = self._fixNS(namespace)
-        del self.args[(namespace, key)]
+        args = self.ns_args.get(namespace, {})
+        try:
+            del args[key]
+        except KeyError:
+            raise KeyError((namespace, key))
+        self._changed()
+        if not args:
+            del self.ns_args[namespace]
 
     def __repr__(self):
         return "<%s.%s %r>" % (self.__class__.__module__,
@@ -517,7 +633,7 @@ class Message(object):
                                self.args)
 
     def __eq__(self, other):
-        return self.args == other.args
+        return self.ns_args == other.ns_args
 
     def __ne__(self, other):
         return not (self == other)
@@ -551,15 +667,145 @@ class Message(object):
         return self.getArg(ns, key, default)
 
 
+class FrozenMessage(Message):
+    """A L{Message} whose arguments can't be changed, such as a message
+    received from the other party.  Its encoded forms are only computed
+    once.
+
+    Use L{copy} to get a message which can be changed.
+    """
+
+    def _frozen(self, *args, **kwargs):
+        raise TypeError('%s can not be changed' % self.__class__.__name__)
+
+    setArg = updateArgs = delArg = setOpenIDNamespace = _frozen
+
+    def copy(self):
+        """Return a copy of this message which can be changed.
+
+        @rtype: L{Message}
+        """
+        return self._copyAs(Message)
+
+    def freeze(self):
+        return self
+
+
+class LazyMessage(FrozenMessage):
+    """A L{FrozenMessage} made of POST arguments, which are only parsed
+    when they are first needed.
+
+    Only the OpenID namespace is checked when the message is created.
+    The arguments of the OpenID namespace with no dot in their key,
+    such as C{mode}, and the bare arguments are got without parsing the
+    others, so requests which are rejected by their mode cost little.
+    """
+
+    def __init__(self, args):
+        """
+        @param args: The POST arguments.
+        @type args: dict
+
+        @raises InvalidOpenIDNamespace: if openid.ns is not in
+            L{Message.allowed_openid_namespaces}
+        """
+        for value in args.itervalues():
+            if isinstance(value, list):
+                raise TypeError("query dict must have one value for each key, "
+                                "not lists of values.  Query is %r" % (args,))
+
+        openid_namespace = args.get('openid.ns')
+        if openid_namespace is None:
+            openid_namespace = OPENID1_NS
+        elif openid_namespace not in self.allowed_openid_namespaces:
+            raise InvalidOpenIDNamespace(openid_namespace)
+        self._post_args = args
+        self._openid_namespace = openid_namespace
+
+    def __getattr__(self, name):
+        # Only called for attributes which are not set yet.
+        if name in ('ns_args', 'namespaces'):
+            self.parse()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def isParsed(self):
+        return 'ns_args' in self.__dict__
+
+    def parse(self):
+        """Parse all of the arguments, if they are not parsed yet.
+
+        @raises InvalidNamespace: if the namespace aliases are invalid
+        """
+        if not self.isParsed():
+            message = Message.fromPostArgs(self._post_args)
+            self.namespaces = message.namespaces
+            self.ns_args = message.ns_args
+
+    def getOpenIDNamespace(self):
+        return self._openid_namespace
+
+    def _getPostKey(self, namespace, key):
+        """Return the POST argument holding a key of the OpenID or the
+        bare namespace if it can be found without parsing, or C{None}."""
+        if self.isParsed():
+            return None
+        if namespace == BARE_NS:
+            if key.startswith('openid.'):
+                return None
+            return key
+        if '.' in key or key == 'ns':
+            return None
+        if namespace != OPENID_NS and namespace != self._openid_namespace:
+            return None
+        return 'openid.' + key
+
+    def hasKey(self, namespace, ns_key):
+        post_key = self._getPostKey(namespace, ns_key)
+        if post_key is None:
+            return super(LazyMessage, self).hasKey(namespace, ns_key)
+        return post_key in self._post_args
+
+    def getArg(self, namespace, key, default=None):
+        post_key = self._getPostKey(namespace, key)
+        if post_key is None:
+            return super(LazyMessage, self).getArg(namespace, key, default)
+        try:
+            return self._post_args[post_key]
+        except KeyError:
+            if default is no_default:
+                raise KeyError((namespace if namespace == BARE_NS else self._openid_namespace, key))
+            else:
+                return default
+
+    def __repr__(self):
+        if self.isParsed():
+            return super(LazyMessage, self).__repr__()
+        return "<%s.%s %r>" % (self.__class__.__module__, self.__class__.__name__, self._post_args)
+
+
 class NamespaceMap(object):
     """Maintains a bijective map between namespace uris and aliases.
+
+    @ivar version: Incremented whenever an alias is added.
+    @type version: int
     """
 
+    version = 0
+
     def __init__(self):
         self.alias_to_namespace = {}
         self.namespace_to_alias = {}
         self.implicit_namespaces = []
 
+    def copy(self):
+        """Return an independent copy of the mapping."""
+        namespaces = self.__class__()
+        namespaces.alias_to_namespace = self.alias_to_namespace.copy()
+        namespaces.namespace_to_alias = self.namespace_to_alias.copy()
+        namespaces.implicit_namespaces = list(self.implicit_namespaces)
+        return namespaces
+
     def getAlias(self, namespace_uri):
         return self.namespace_to_alias.get(namespace_uri)
 
@@ -624,6 +870,7 @@ class NamespaceMap(object):
         self.namespace_to_alias[namespace_uri] = desired_alias
         if implicit:
             self.implicit_namespaces.append(namespace_uri)
+        self.version += 1
         return desired_alias
 
     def add(self, namespace_uri):
@@ -82,6 +82,9 @@ Stores
     For stores based on MySQL or SQLite, see the C{L{openid.store.sqlstore}}
     module.
 
+    An L{Server} using a L{StatelessSignatory} doesn't store the
+    associations it makes for relying parties in dumb mode.
+
 
 Upgrading
 =========
@@ -117,16 +120,20 @@ From 1.1 to 2.0
 """
 
 import logging
+import re
+import threading
 import time
 import warnings
-from copy import deepcopy
+from collections import OrderedDict
+from copy import copy
 
 from openid import cryptutil, kvform, oidutil
 from openid.association import Association, default_negotiator, getSecretSize
 from openid.dh import DiffieHellman
 from openid.message import (IDENTIFIER_SELECT, OPENID1_URL_LIMIT, OPENID2_NS, OPENID_NS, InvalidNamespace,
-                            InvalidOpenIDNamespace, Message)
+                            InvalidOpenIDNamespace, LazyMessage, Message)
 from openid.server.trustroot import TrustRoot, verifyReturnTo
+from openid.store import nonce
 from openid.store.nonce import mkNonce
 from openid.urinorm import urinorm
 
@@ -249,9 +256,8 @@ class CheckAuthRequest(OpenIDRequest):
         @returntype: L{OpenIDResponse}
         """
         is_valid = signatory.verify(self.assoc_handle, self.signed)
-        # Now invalidate that assoc_handle so it this checkAuth message cannot
-        # be replayed.
-        signatory.invalidate(self.assoc_handle, dumb=True)
+        # Now make sure this checkAuth message cannot be replayed.
+        is_valid = signatory.useResponse(self.assoc_handle, self.signed) and is_valid
         response = OpenIDResponse(self)
         valid_str = (is_valid and "true") or "false"
         response.fields.setArg(OPENID_NS, 'is_valid', valid_str)
@@ -293,10 +299,15 @@ class PlainTextServerSession(object):
     def fromMessage(cls, unused_request):
         return cls()
 
-    def answer(self, secret):
+    def answer(self, secret, executor=None):
         return {'mac_key': oidutil.toBase64(secret)}
 
 
+def _xorSecret(dh, consumer_pubkey, secret, hash_func):
+    """Run in the executor of L{DiffieHellmanSHA1ServerSession.answer}."""
+    return dh.xorSecret(consumer_pubkey, secret, hash_func)
+
+
 class DiffieHellmanSHA1ServerSession(object):
     """An object that knows how to handle association requests with the
     Diffie-Hellman session type.
@@ -320,6 +331,10 @@ class DiffieHellmanSHA1ServerSession(object):
     hash_func = staticmethod(cryptutil.sha1)
     allowed_assoc_types = ['HMAC-SHA1']
 
+    # Seconds to wait for the executor passed to answer before the
+    # shared secret is computed inline.
+    executor_timeout = 5
+
     def __init__(self, dh, consumer_pubkey):
         self.dh = dh
         self.consumer_pubkey = consumer_pubkey
@@ -353,8 +368,11 @@ class DiffieHellmanSHA1ServerSession(object):
         if dh_modulus or dh_gen:
             dh_modulus = cryptutil.base64ToLong(dh_modulus)
             dh_gen = cryptutil.base64ToLong(dh_gen)
+
+        if (dh_modulus or dh_gen) and (dh_modulus, dh_gen) != (DiffieHellman.DEFAULT_MOD, DiffieHellman.DEFAULT_GEN):
             dh = DiffieHellman(dh_modulus, dh_gen)
         else:
+            # The default values may come from the key pool.
             dh = DiffieHellman.fromDefaults()
 
         consumer_pubkey = message.getArg(OPENID_NS, 'dh_consumer_public')
@@ -366,10 +384,28 @@ class DiffieHellmanSHA1ServerSession(object):
 
         return cls(dh, consumer_pubkey)
 
-    def answer(self, secret):
-        mac_key = self.dh.xorSecret(self.consumer_pubkey,
-                                    secret,
-                                    self.hash_func)
+    def answer(self, secret, executor=None):
+        """Encrypt the secret with the shared Diffie-Hellman secret.
+
+        @param executor: If given, the shared secret is computed by it
+            rather than in this thread, unless it fails or does not
+            finish within executor_timeout seconds.
+        @type executor: C{concurrent.futures.Executor}
+        """
+        mac_key = None
+        if executor is not None:
+            future = None
+            try:
+                future = executor.submit(_xorSecret, self.dh, self.consumer_pubkey, secret, self.hash_func)
+                mac_key = future.result(timeout=self.executor_timeout)
+            except Exception:
+                if future is not None:
+                    future.cancel()
+                _LOGGER.exception('Error computing the Diffie-Hellman secret in %r, computing it inline', executor)
+        if mac_key is None:
+            mac_key = self.dh.xorSecret(self.consumer_pubkey,
+                                        secret,
+                                        self.hash_func)
         return {
             'dh_server_public': cryptutil.longToBase64(self.dh.public),
             'enc_mac_key': oidutil.toBase64(mac_key),
@@ -467,12 +503,16 @@ class AssociateRequest(OpenIDRequest):
         self = klass(session, assoc_type, message=message)
         return self
 
-    def answer(self, assoc):
+    def answer(self, assoc, executor=None):
         """Respond to this request with an X{association}.
 
         @param assoc: The association to send back.
         @type assoc: L{openid.association.Association}
 
+        @param executor: If given, the session may encrypt the secret
+            in it.  See L{DiffieHellmanSHA1ServerSession.answer}.
+        @type executor: C{concurrent.futures.Executor}
+
         @returns: A response with the association information, encrypted
             to the consumer's X{public key} if appropriate.
         @returntype: L{OpenIDResponse}
@@ -483,8 +523,11 @@ class AssociateRequest(OpenIDRequest):
             'assoc_type': self.assoc_type,
             'assoc_handle': assoc.handle,
         })
-        response.fields.updateArgs(OPENID_NS,
-                                   self.session.answer(assoc.secret))
+        if executor is None:
+            session_fields = self.session.answer(assoc.secret)
+        else:
+            session_fields = self.session.answer(assoc.secret, executor=executor)
+        response.fields.updateArgs(OPENID_NS, session_fields)
 
         if not (self.session.session_type == 'no-encryption' and
                 self.message.isOpenID1()):
@@ -1103,6 +1146,129 @@ class WebResponse(object):
         self.body = body
 
 
+class AssociationCache(object):
+    """A bounded in-process cache of the associations of a
+    L{Signatory}, keyed by dumb or normal mode and handle.
+
+    When full, the least recently used association is evicted.  Handles
+    not found in the store are remembered for C{negative_ttl} seconds,
+    so forged handles don't reach the store every time.
+
+    Associations used in dumb mode are not cached, only their absence
+    is: unless they are shared, they are looked up once to be verified
+    and then invalidated, so caching them would only keep them valid in
+    other processes after the invalidation.
+
+    When several processes share a store, an association invalidated
+    by one of them stays in the cache of the others.  To propagate
+    invalidations, pass an C{on_invalidate} hook publishing them, and
+    call L{discard} when they are received.
+    """
+
+    def __init__(self, max_size=1000, negative_ttl=5, on_invalidate=None):
+        """
+        @param max_size: The maximum number of cached handles.
+        @type max_size: int
+
+        @param negative_ttl: The number of seconds to remember handles
+            which are not in the store.
+        @type negative_ttl: int
+
+        @param on_invalidate: Called with C{dumb} and C{assoc_handle}
+            when an association is invalidated in this process.
+        @type on_invalidate: callable
+        """
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.on_invalidate = on_invalidate
+
+        # Maps (dumb, assoc_handle) to the association, or to the
+        # expiration time of the negative entry.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getStats(self):
+        """Return usage statistics of the cache.
+
+        @return: dictionary with the C{size} of the cache, the number
+            of C{hits}, C{negative_hits} and C{misses} and the number
+            of C{evictions} of least recently used entries
+        @rtype: dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def get(self, dumb, assoc_handle):
+        """Look an association up.
+
+        @returns: C{(found, assoc)}, where C{assoc} is C{None} if the
+            handle is known not to be in the store
+        @returntype: tuple
+        """
+        key = (dumb, assoc_handle)
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            if isinstance(entry, Association):
+                self._entries[key] = entry
+                self.hits += 1
+                return True, entry
+            elif entry > time.time():
+                self._entries[key] = entry
+                self.negative_hits += 1
+                return True, None
+            else:
+                self.misses += 1
+                return False, None
+
+    def put(self, dumb, assoc_handle, assoc):
+        """Cache the association found for a handle, or C{None} if it
+        was not found."""
+        key = (dumb, assoc_handle)
+        if assoc is None:
+            entry = time.time() + self.negative_ttl
+        elif dumb:
+            self.discard(dumb, assoc_handle)
+            return
+        else:
+            entry = assoc
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, dumb, assoc_handle):
+        """Forget a handle, e.g. when it was invalidated by another
+        process."""
+        with self._lock:
+            self._entries.pop((dumb, assoc_handle), None)
+
+    def invalidate(self, dumb, assoc_handle):
+        """Forget a handle invalidated by this process and call the
+        C{on_invalidate} hook."""
+        self.discard(dumb, assoc_handle)
+        if self.on_invalidate is not None:
+            self.on_invalidate(dumb, assoc_handle)
+
+
 class Signatory(object):
     """I sign things.
 
@@ -1112,11 +1278,29 @@ class Signatory(object):
     L{OpenIDStore<openid.store.interface.OpenIDStore>}, which means
     I'm not generally pickleable but I am easy to reconstruct.
 
+    Dumb-mode responses carrying a nonce are signed with an association
+    shared by all of the responses signed within
+    C{DUMB_ASSOCIATION_REUSE} seconds, so signing them rarely writes to
+    the store.  Such a response can only be checked once, because its
+    nonce is used in the store when it is checked, which must happen
+    within L{openid.store.nonce.SKEW} of the response.  The other
+    dumb-mode responses are signed with an association of their own,
+    which is invalidated when the response is checked.
+
     @cvar SECRET_LIFETIME: The number of seconds a secret remains valid.
     @type SECRET_LIFETIME: int
+
+    @cvar DUMB_ASSOCIATION_REUSE: The number of seconds a dumb-mode
+        association is used to sign new responses, or 0 to sign every
+        response with a new association.
+    @type DUMB_ASSOCIATION_REUSE: int
+
+    @ivar association_cache: The cache in front of the store, if any.
+    @type association_cache: L{AssociationCache}
     """
 
     SECRET_LIFETIME = 14 * 24 * 60 * 60  # 14 days, in seconds
+    DUMB_ASSOCIATION_REUSE = 5 * 60
 
     # keys have a bogus server URL in them because the filestore
     # really does expect that key to be a URL.  This seems a little
@@ -1125,14 +1309,22 @@ class Signatory(object):
     _normal_key = 'http://localhost/|normal'
     _dumb_key = 'http://localhost/|dumb'
 
-    def __init__(self, store):
+    def __init__(self, store, association_cache=None):
         """Create a new Signatory.
 
         @param store: The back-end where my associations are stored.
         @type store: L{openid.store.interface.OpenIDStore}
+
+        @param association_cache: A cache to look associations up in
+            before the store.
+        @type association_cache: L{AssociationCache}
         """
         assert store is not None
         self.store = store
+        self.association_cache = association_cache
+        self._lock = threading.Lock()
+        # The shared dumb-mode associations by type
+        self._shared_associations = {}
 
     def verify(self, assoc_handle, message):
         """Verify that the signature for some data is valid.
@@ -1166,13 +1358,17 @@ class Signatory(object):
         in its L{signed<OpenIDResponse.signed>} list, and return a new
         copy of the response object with that signature included.
 
+        Only the fields of the response are copied, the copy shares
+        its request with the original.
+
         @param response: A response to sign.
         @type response: L{OpenIDResponse}
 
         @returns: A signed copy of the response.
         @returntype: L{OpenIDResponse}
         """
-        signed_response = deepcopy(response)
+        signed_response = copy(response)
+        fields = response.fields
         assoc_handle = response.request.assoc_handle
         if assoc_handle:
             # normal mode
@@ -1185,25 +1381,80 @@ class Signatory(object):
 
             if not assoc or assoc.expiresIn <= 0:
                 # fall back to dumb mode
-                signed_response.fields.setArg(
-                    OPENID_NS, 'invalidate_handle', assoc_handle)
+                fields = fields.copy()
+                fields.setArg(OPENID_NS, 'invalidate_handle', assoc_handle)
                 assoc_type = assoc and assoc.assoc_type or 'HMAC-SHA1'
                 if assoc and assoc.expiresIn <= 0:
                     # now do the clean-up that the disabled checkExpiration
                     # code didn't get to do.
                     self.invalidate(assoc_handle, dumb=False)
-                assoc = self.createAssociation(dumb=True, assoc_type=assoc_type)
+                assoc = self._getDumbAssociation(fields, assoc_type)
         else:
             # dumb mode.
-            assoc = self.createAssociation(dumb=True)
+            assoc = self._getDumbAssociation(fields, 'HMAC-SHA1')
 
         try:
-            signed_response.fields = assoc.signMessage(signed_response.fields)
+            signed_response.fields = assoc.signMessage(fields)
         except kvform.KVFormError as err:
             raise EncodingError(response, explanation=str(err))
         return signed_response
 
-    def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1'):
+    def _getDumbAssociation(self, message, assoc_type):
+        """Return the association to sign a dumb-mode response with."""
+        if not self.DUMB_ASSOCIATION_REUSE or not message.hasKey(OPENID_NS, 'response_nonce'):
+            return self.createAssociation(dumb=True, assoc_type=assoc_type)
+
+        now = time.time()
+        with self._lock:
+            assoc = self._shared_associations.get(assoc_type)
+        if assoc is None or now - assoc.issued >= self.DUMB_ASSOCIATION_REUSE:
+            # Several threads may make one at once, which does no harm.
+            assoc = self.createAssociation(dumb=True, assoc_type=assoc_type, shared=True)
+            with self._lock:
+                self._shared_associations[assoc_type] = assoc
+        return assoc
+
+    def _isShared(self, assoc_handle):
+        return assoc_handle.endswith('}{shared}')
+
+    def useResponse(self, assoc_handle, message):
+        """Make sure a dumb-mode response is only checked once.
+
+        A response signed with a shared association has its nonce
+        used, the association of any other response is invalidated.
+
+        @param assoc_handle: The handle of the association used to sign the
+            response.
+        @type assoc_handle: str
+
+        @param message: The signed response
+        @type message: openid.message.Message
+
+        @returns: C{False} if the response was checked before, or can't
+            be told apart from the other responses signed with its
+            association.
+        @returntype: bool
+        """
+        if not self._isShared(assoc_handle):
+            self.invalidate(assoc_handle, dumb=True)
+            return True
+
+        signed_list = message.getArg(OPENID_NS, 'signed', '').split(',')
+        if 'response_nonce' not in signed_list:
+            _LOGGER.error("response signed with shared association %r has no signed nonce", assoc_handle)
+            return False
+        try:
+            timestamp, salt = nonce.split(message.getArg(OPENID_NS, 'response_nonce'))
+        except ValueError as error:
+            _LOGGER.error("response signed with shared association %r has a bad nonce: %s", assoc_handle, error)
+            return False
+        if not self.store.useNonce(self._dumb_key, timestamp, salt):
+            _LOGGER.error("response with nonce %r was checked before or is too old",
+                          message.getArg(OPENID_NS, 'response_nonce'))
+            return False
+        return True
+
+    def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1', shared=False):
         """Make a new association.
 
         @param dumb: Is this association for a dumb-mode transaction?
@@ -1213,12 +1464,18 @@ class Signatory(object):
             there is only one type defined, C{HMAC-SHA1}.
         @type assoc_type: str
 
+        @param shared: Is this dumb-mode association shared by several
+            responses?
+        @type shared: bool
+
         @returns: the new association.
         @returntype: L{openid.association.Association}
         """
         secret = cryptutil.getBytes(getSecretSize(assoc_type))
         uniq = oidutil.toBase64(cryptutil.getBytes(4))
         handle = '{%s}{%x}{%s}' % (assoc_type, int(time.time()), uniq)
+        if shared:
+            handle += '{shared}'
 
         assoc = Association.fromExpiresIn(
             self.SECRET_LIFETIME, handle, secret, assoc_type)
@@ -1228,6 +1485,8 @@ class Signatory(object):
         else:
             key = self._normal_key
         self.store.storeAssociation(key, assoc)
+        if self.association_cache is not None:
+            self.association_cache.put(dumb, handle, assoc)
         return assoc
 
     def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
@@ -1255,12 +1514,23 @@ class Signatory(object):
             key = self._dumb_key
         else:
             key = self._normal_key
-        assoc = self.store.getAssociation(key, assoc_handle)
+
+        cache = self.association_cache
+        if cache is None:
+            assoc = self.store.getAssociation(key, assoc_handle)
+        else:
+            found, assoc = cache.get(dumb, assoc_handle)
+            if not found:
+                assoc = self.store.getAssociation(key, assoc_handle)
+                cache.put(dumb, assoc_handle, assoc)
+
         if assoc is not None and assoc.expiresIn <= 0:
             _LOGGER.info("requested %sdumb key %r is expired (by %s seconds)",
                          (not dumb) and 'not-' or '', assoc_handle, assoc.expiresIn)
             if checkExpiration:
                 self.store.removeAssociation(key, assoc_handle)
+                if cache is not None:
+                    cache.discard(dumb, assoc_handle)
                 assoc = None
         return assoc
 
@@ -1277,6 +1547,214 @@ class Signatory(object):
         else:
             key = self._normal_key
         self.store.removeAssociation(key, assoc_handle)
+        if self.association_cache is not None:
+            self.association_cache.invalidate(dumb, assoc_handle)
+
+
+class StatelessSignatory(Signatory):
+    """I sign things without storing dumb-mode associations.
+
+    The secret of a dumb-mode association is derived from a master key
+    and its handle, which names the master key and carries the
+    association type and issue time, authenticated by a tag.  Creating
+    such an association or looking it up takes no store access.
+    Associations used in normal mode are stored as by L{Signatory}.
+
+    The master keys are kept in the store, so all of the servers
+    sharing it use the same ones, and cached in memory.  A new master
+    key is made every C{MASTER_KEY_ROTATION} seconds; the old ones stay
+    in the store for the lifetime of the associations derived from
+    them.
+
+    A dumb-mode handle is revoked when it is verified or invalidated,
+    by using it as a nonce of the store.  As nonces are only accepted
+    within L{openid.store.nonce.SKEW} of their timestamp, a dumb-mode
+    association can only be checked within that time after it was
+    issued.
+
+    As creating dumb-mode associations is cheap, every response is
+    signed with a new one.
+
+    To use me, pass C{signatoryClass=StatelessSignatory} to L{Server}.
+
+    @cvar MASTER_KEY_ROTATION: The number of seconds a master key is
+        used for new associations.
+    @type MASTER_KEY_ROTATION: int
+
+    @cvar MASTER_KEY_REFRESH: The number of seconds between looking up
+        the newest master key in the store.
+    @type MASTER_KEY_REFRESH: int
+
+    @cvar REVOKED_CACHE_SIZE: The number of recently revoked handles
+        remembered, so they are not revoked in the store twice.
+    @type REVOKED_CACHE_SIZE: int
+    """
+
+    DUMB_ASSOCIATION_REUSE = 0
+    MASTER_KEY_ROTATION = 24 * 60 * 60  # 1 day, in seconds
+    MASTER_KEY_REFRESH = 60
+    REVOKED_CACHE_SIZE = 1024
+
+    _master_key = 'http://localhost/|master'
+
+    _handle_re = re.compile(r'^\{(HMAC-SHA1|HMAC-SHA256)\}\{([0-9a-f]+)\}\{([^{}]+)\}\{([^{}]+)\}\{([^{}]+)\}$')
+
+    def __init__(self, store, association_cache=None):
+        super(StatelessSignatory, self).__init__(store, association_cache)
+        # Master keys by handle
+        self._master_keys = {}
+        self._newest_master_key = None
+        self._master_key_checked = 0
+        self._revoked = OrderedDict()
+
+    def _makeMasterKey(self):
+        key_id = oidutil.toBase64(cryptutil.getBytes(6))
+        master_key = Association.fromExpiresIn(self.MASTER_KEY_ROTATION + self.SECRET_LIFETIME, key_id,
+                                               cryptutil.getBytes(32), 'HMAC-SHA256')
+        self.store.storeAssociation(self._master_key, master_key)
+        return master_key
+
+    def _getNewestMasterKey(self):
+        """Return the master key to derive new associations from."""
+        now = time.time()
+        with self._lock:
+            master_key = self._newest_master_key
+            if master_key is not None and now - self._master_key_checked < self.MASTER_KEY_REFRESH:
+                return master_key
+
+        master_key = self.store.getAssociation(self._master_key)
+        if master_key is None or now - master_key.issued >= self.MASTER_KEY_ROTATION:
+            master_key = self._makeMasterKey()
+
+        with self._lock:
+            self._master_keys[master_key.handle] = master_key
+            self._newest_master_key = master_key
+            self._master_key_checked = now
+            for key_id, old_key in self._master_keys.items():
+                if old_key.expiresIn <= 0:
+                    del self._master_keys[key_id]
+        return master_key
+
+    def _getMasterKey(self, key_id):
+        with self._lock:
+            master_key = self._master_keys.get(key_id)
+        if master_key is None:
+            master_key = self.store.getAssociation(self._master_key, key_id)
+            if master_key is None:
+                return None
+            with self._lock:
+                self._master_keys[key_id] = master_key
+        if master_key.expiresIn <= 0:
+            return None
+        return master_key
+
+    def _deriveAssociation(self, master_key, assoc_type, issued, uniq):
+        body = '{%s}{%x}{%s}{%s}' % (assoc_type, issued, master_key.handle, uniq)
+        tag = oidutil.toBase64(cryptutil.hmacSha256(master_key.secret, 'tag' + body)[:9])
+        if assoc_type == 'HMAC-SHA1':
+            secret = cryptutil.hmacSha1(master_key.secret, body)
+        else:
+            secret = cryptutil.hmacSha256(master_key.secret, body)
+        return Association('%s{%s}' % (body, tag), secret, issued, self.SECRET_LIFETIME, assoc_type)
+
+    def _parseHandle(self, assoc_handle):
+        """Return the association derived for a handle made by
+        L{createAssociation}, or C{None} if the handle is not one."""
+        match = self._handle_re.match(assoc_handle)
+        if match is None:
+            return None
+        assoc_type, issued, key_id, uniq, tag = match.groups()
+
+        master_key = self._getMasterKey(key_id)
+        if master_key is None:
+            return None
+        assoc = self._deriveAssociation(master_key, assoc_type, int(issued, 16), uniq)
+        if not cryptutil.const_eq(assoc.handle, assoc_handle):
+            _LOGGER.info('Association handle %r has a bad tag', assoc_handle)
+            return None
+        return assoc
+
+    def _revoke(self, assoc):
+        """Revoke a dumb-mode association.
+
+        @returns: Whether it was not revoked yet.
+        @returntype: bool
+        """
+        with self._lock:
+            if assoc.handle in self._revoked:
+                return False
+        # The key id and unique part are short enough to make a salt.
+        _, _, key_id, uniq, _ = assoc.handle.split('}{')
+        revoked = self.store.useNonce(self._dumb_key, assoc.issued, key_id + uniq)
+        with self._lock:
+            self._revoked[assoc.handle] = None
+            while len(self._revoked) > self.REVOKED_CACHE_SIZE:
+                self._revoked.popitem(last=False)
+        return revoked
+
+    def verify(self, assoc_handle, message):
+        """Verify that the signature for some data is valid, revoking
+        the dumb-mode association it was made with.
+
+        @see: L{Signatory.verify}
+        """
+        assoc = self._parseHandle(assoc_handle)
+        if assoc is None:
+            return super(StatelessSignatory, self).verify(assoc_handle, message)
+
+        if not self._revoke(assoc):
+            _LOGGER.error("association with handle %r was revoked, can't verify message %r", assoc_handle, message)
+            return False
+
+        try:
+            return assoc.checkMessageSignature(message)
+        except ValueError as ex:
+            _LOGGER.exception("Error in verifying %s with %s: %s", message, assoc, ex)
+            return False
+
+    def createAssociation(self, dumb=True, assoc_type='HMAC-SHA1', shared=False):
+        """Make a new association.  Dumb-mode associations which are not
+        shared are derived from the master key and not stored.
+
+        @see: L{Signatory.createAssociation}
+        """
+        if not dumb or shared:
+            return super(StatelessSignatory, self).createAssociation(dumb, assoc_type, shared)
+
+        getSecretSize(assoc_type)  # Check the type is supported
+        uniq = oidutil.toBase64(cryptutil.getBytes(6))
+        return self._deriveAssociation(self._getNewestMasterKey(), assoc_type, int(time.time()), uniq)
+
+    def getAssociation(self, assoc_handle, dumb, checkExpiration=True):
+        """Get the association with the specified handle.
+
+        @see: L{Signatory.getAssociation}
+        """
+        if assoc_handle is None:
+            raise ValueError("assoc_handle must not be None")
+
+        if dumb:
+            assoc = self._parseHandle(assoc_handle)
+            if assoc is not None:
+                with self._lock:
+                    if assoc_handle in self._revoked:
+                        return None
+                if assoc.expiresIn <= 0 and checkExpiration:
+                    return None
+                return assoc
+        return super(StatelessSignatory, self).getAssociation(assoc_handle, dumb, checkExpiration)
+
+    def invalidate(self, assoc_handle, dumb):
+        """Invalidates the association with the given handle.
+
+        @see: L{Signatory.invalidate}
+        """
+        if dumb:
+            assoc = self._parseHandle(assoc_handle)
+            if assoc is not None:
+                self._revoke(assoc)
+                return
+        super(StatelessSignatory, self).invalidate(assoc_handle, dumb)
 
 
 class Encoder(object):
@@ -1389,7 +1867,8 @@ class Decoder(object):
             return None
 
         try:
-            message = Message.fromPostArgs(query)
+            # Only the arguments needed to find the handler are parsed.
+            message = LazyMessage(query)
         except InvalidOpenIDNamespace as err:
             # It's useful to have a Message attached to a ProtocolError, so we
             # override the bad ns value to build a Message out of it.  Kinda
@@ -1399,19 +1878,24 @@ class Decoder(object):
             query['openid.ns'] = OPENID2_NS
             message = Message.fromPostArgs(query)
             raise ProtocolError(message, str(err))
-        except InvalidNamespace as err:
-            # If openid.ns is OK, but there is problem with other namespaces
-            # We keep only bare parts of query and we try to make a ProtocolError from it
-            query = [(key, value) for key, value in query.items() if key.count('.') < 2]
-            message = Message.fromPostArgs(dict(query))
-            raise ProtocolError(message, str(err))
 
         mode = message.getArg(OPENID_NS, 'mode')
         if not mode:
             fmt = "No mode value in message %s"
             raise ProtocolError(message, text=fmt % (message,))
 
-        handler = self._handlers.get(mode, self.defaultDecoder)
+        handler = self._handlers.get(mode)
+        if handler is None:
+            return self.defaultDecoder(message, self.server.op_endpoint)
+
+        try:
+            message.parse()
+        except InvalidNamespace as err:
+            # If openid.ns is OK, but there is problem with other namespaces
+            # We keep only bare parts of query and we try to make a ProtocolError from it
+            query = [(key, value) for key, value in query.items() if key.count('.') < 2]
+            message = Message.fromPostArgs(dict(query))
+            raise ProtocolError(message, str(err))
         return handler(message, self.server.op_endpoint)
 
     def defaultDecoder(self, message, server):
@@ -1472,13 +1956,19 @@ class Server(object):
     @ivar negotiator: I use this to determine which kinds of
         associations I can make and how.
     @type negotiator: L{openid.association.SessionNegotiator}
+
+    @ivar dh_executor: The executor computing the Diffie-Hellman shared
+        secrets of associate requests, or C{None} to compute them in the
+        thread handling the request.
+    @type dh_executor: C{concurrent.futures.Executor}
     """
 
     signatoryClass = Signatory
     encoderClass = SigningEncoder
     decoderClass = Decoder
 
-    def __init__(self, store, op_endpoint=None, signatoryClass=None, encoderClass=None, decoderClass=None):
+    def __init__(self, store, op_endpoint=None, signatoryClass=None, encoderClass=None, decoderClass=None,
+                 dh_executor=None, association_cache=None):
         """A new L{Server}.
 
         @param store: The back-end where my associations are stored.
@@ -1492,14 +1982,30 @@ class Server(object):
             currently defaults to C{None} for compatibility with
             earlier versions of the library, but you must provide it
             if you want to respond to any version 2 OpenID requests.
+
+        @param dh_executor: An executor to compute the Diffie-Hellman
+            shared secrets in, typically a
+            C{concurrent.futures.ProcessPoolExecutor}, so that
+            concurrent associate requests use several processors.  If
+            the executor fails or does not answer within the
+            executor_timeout of the session, the secret is computed
+            inline.
+        @type dh_executor: C{concurrent.futures.Executor}
+
+        @param association_cache: A cache for my signatory to look
+            associations up in before the store.
+        @type association_cache: L{AssociationCache}
         """
         self.store = store
+        self.dh_executor = dh_executor
         if signatoryClass is None:
             signatoryClass = self.signatoryClass
             if signatoryClass != Server.signatoryClass:
                 warnings.warn("Attribute signatoryClass on Server class is deprecated."
                               "Use signatoryClass argument of __init__ instead.", DeprecationWarning)
         self.signatory = signatoryClass(self.store)
+        if association_cache is not None:
+            self.signatory.association_cache = association_cache
         if encoderClass is None:
             encoderClass = self.encoderClass
             if encoderClass != Server.encoderClass:
@@ -1560,7 +2066,7 @@ class Server(object):
         if self.negotiator.isAllowed(assoc_type, session_type):
             assoc = self.signatory.createAssociation(dumb=False,
                                                      assoc_type=assoc_type)
-            return request.answer(assoc)
+            return request.answer(assoc, executor=self.dh_executor)
         else:
             message = ('Association type %r is not supported with '
                        'session type %r' % (assoc_type, session_type))
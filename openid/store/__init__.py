@@ -2,7 +2,7 @@
 This package contains the modules related to this library's use of
 persistent storage.
 
-@sort: interface, filestore, sqlstore, memstore
+@sort: interface, filestore, sqlstore, memstore, redisstore, discocache
 """
 
-__all__ = ['interface', 'filestore', 'sqlstore', 'memstore', 'nonce']
+__all__ = ['interface', 'filestore', 'sqlstore', 'memstore', 'redisstore', 'nonce', 'discocache']
@@ -0,0 +1,300 @@
+"""
+This module contains caches for the results of OpenID discovery.
+
+A discovery cache is consulted by
+C{L{openid.consumer.discover.discover}} before any HTTP request is
+made, once it has been installed with
+C{L{openid.consumer.discover.setDiscoveryCache}}.  Two implementations
+are provided: C{L{MemoryDiscoveryCache}}, a bounded in-process LRU
+cache, and C{L{FileDiscoveryCache}}, which keeps its entries in a
+directory that can be shared by all of the processes on a host (or
+all of the hosts mounting it).
+"""
+
+__all__ = [
+    'DiscoveryCache',
+    'FileDiscoveryCache',
+    'MemoryDiscoveryCache',
+]
+
+import cPickle as pickle
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from errno import EEXIST, ENOENT
+from tempfile import mkstemp
+
+from openid.store.filestore import _ensureDir, _removeIfPresent, _safe64
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DiscoveryCache(object):
+    """
+    This is the interface for discovery caches.
+
+    The values stored in a cache are opaque to it; they only have to
+    be returned unchanged by C{L{get}} until they expire.  Cache
+    implementations that store their entries outside of the process
+    must be able to pickle them.
+
+    @cvar default_ttl: How long, in seconds, discovery information is
+        kept if the discovered document does not say otherwise.
+
+    @cvar max_ttl: The longest time, in seconds, discovery information
+        is kept, regardless of what the discovered document says.
+
+    @cvar failure_ttl: How long, in seconds, failed discovery is
+        remembered.  Keep this short: it only exists so that an
+        unreachable identity host does not tie up every worker that
+        tries to log in one of its users.
+    """
+
+    default_ttl = 60 * 60
+    max_ttl = 24 * 60 * 60
+    failure_ttl = 60
+
+    def getTTL(self, hint=None):
+        """Return the time to live for an entry.
+
+        @param hint: The lifetime in seconds suggested by the
+            discovered document, or C{None} if it had no opinion.
+        @type hint: C{int} or C{NoneType}
+
+        @rtype: C{int}
+        """
+        if hint is None:
+            return self.default_ttl
+        return int(max(0, min(hint, self.max_ttl)))
+
+    def get(self, key):
+        """Return the value stored for this key, or C{None} if there
+        is no such value or it has expired.
+
+        @type key: C{str} or C{unicode}
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """Store a value for this key for C{ttl} seconds.  Values with
+        a time to live that is not positive are not stored.
+
+        @type key: C{str} or C{unicode}
+
+        @type ttl: C{int}
+
+        @return: C{None}
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """Remove the value stored for this key.
+
+        @return: Whether a value was stored.
+        @rtype: C{bool}
+        """
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Remove expired entries from the cache.
+
+        @return: the number of entries removed.
+        @rtype: C{int}
+        """
+        raise NotImplementedError
+
+
+class MemoryDiscoveryCache(DiscoveryCache):
+    """In-process discovery cache.
+
+    Entries are kept in least-recently-used order; once there are
+    C{max_entries} of them, storing a new entry discards the least
+    recently used one.  The cache may be shared between threads.
+    """
+
+    def __init__(self, max_entries=1000, default_ttl=None, failure_ttl=None):
+        """
+        @param max_entries: The maximum number of entries to keep.
+        @type max_entries: C{int}
+
+        @param default_ttl: Overrides C{L{DiscoveryCache.default_ttl}}
+
+        @param failure_ttl: Overrides C{L{DiscoveryCache.failure_ttl}}
+        """
+        self.max_entries = max_entries
+        if default_ttl is not None:
+            self.default_ttl = default_ttl
+        if failure_ttl is not None:
+            self.failure_ttl = failure_ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expires <= time.time():
+                return None
+
+            # Re-insert to mark this entry as the most recently used.
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def cleanup(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires, _) in self._entries.iteritems()
+                       if expires <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+
+class FileDiscoveryCache(DiscoveryCache):
+    """
+    A discovery cache that keeps one file per entry in a directory,
+    in the same way as C{L{FileOpenIDStore
+    <openid.store.filestore.FileOpenIDStore>}} keeps associations.
+    Every process pointed at the same directory shares the cached
+    information.
+
+    Entries are pickled, so the directory must not be writable by
+    anyone who should not be able to run code in the processes that
+    use it.
+
+    Methods of this object can raise OSError if unexpected filesystem
+    conditions, such as bad permissions or missing directories, occur.
+    """
+
+    def __init__(self, directory, default_ttl=None, failure_ttl=None):
+        """
+        @param directory: This is the directory to put the cache
+            directories in.  It may be the directory of a
+            C{FileOpenIDStore}.
+        @type directory: C{str}
+
+        @param default_ttl: Overrides C{L{DiscoveryCache.default_ttl}}
+
+        @param failure_ttl: Overrides C{L{DiscoveryCache.failure_ttl}}
+        """
+        directory = os.path.normpath(os.path.abspath(directory))
+        self.discovery_dir = os.path.join(directory, 'discovery')
+
+        # Temp dir must be on the same filesystem as the discovery
+        # directory
+        self.temp_dir = os.path.join(directory, 'temp')
+
+        if default_ttl is not None:
+            self.default_ttl = default_ttl
+        if failure_ttl is not None:
+            self.failure_ttl = failure_ttl
+
+        _ensureDir(self.discovery_dir)
+        _ensureDir(self.temp_dir)
+
+    def getFilename(self, key):
+        """Return the name of the file holding the entry for a key.
+
+        unicode -> str
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.discovery_dir, _safe64(key))
+
+    def _read(self, filename):
+        """Return the (expires, value) pair stored in a file, or None
+        if the file is missing or unreadable."""
+        try:
+            entry_file = open(filename, 'rb')
+        except IOError as why:
+            if why.errno == ENOENT:
+                return None
+            raise
+
+        try:
+            try:
+                return pickle.load(entry_file)
+            except Exception:
+                _LOGGER.exception('Corrupted discovery cache entry %s', filename)
+                _removeIfPresent(filename)
+                return None
+        finally:
+            entry_file.close()
+
+    def get(self, key):
+        filename = self.getFilename(key)
+        entry = self._read(filename)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= time.time():
+            _removeIfPresent(filename)
+            return None
+
+        return value
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+
+        filename = self.getFilename(key)
+        fd, tmp = mkstemp(dir=self.temp_dir)
+        try:
+            tmp_file = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((time.time() + ttl, value), tmp_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                tmp_file.close()
+
+            try:
+                os.rename(tmp, filename)
+            except OSError as why:
+                if why.errno != EEXIST:
+                    raise
+
+                # Only expected on Windows, where rename does not
+                # replace an existing file.
+                _removeIfPresent(filename)
+                os.rename(tmp, filename)
+        except Exception:
+            # If there was an error, don't leave the temporary file
+            # around.
+            _removeIfPresent(tmp)
+            raise
+
+    def remove(self, key):
+        return bool(_removeIfPresent(self.getFilename(key)))
+
+    def cleanup(self):
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.discovery_dir):
+            filename = os.path.join(self.discovery_dir, name)
+            entry = self._read(filename)
+            if entry is not None and entry[0] <= now:
+                removed += _removeIfPresent(filename)
+        return removed
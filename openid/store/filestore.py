@@ -40,6 +40,43 @@ def _filenameEscape(s):
     return ''.join(filename_chunks)
 
 
+def _serverName(server_url):
+    """Return the part of file names that identifies a server. It
+    contains the domain name from the server URL for ease of human
+    inspection of the data directory.
+
+    str -> str
+    """
+    if server_url:
+        proto, rest = server_url.split('://', 1)
+    else:
+        # Create empty proto / rest values for empty server_url,
+        # which is part of a consumer-generated nonce.
+        proto, rest = '', ''
+
+    domain = _filenameEscape(rest.split('/', 1)[0])
+    url_hash = _safe64(server_url)
+    return '%s-%s-%s' % (proto, domain, url_hash)
+
+
+def _nonceName(server_url, timestamp, salt):
+    """Return the name of the file that marks a nonce as used.
+
+    (str, int, str) -> str
+    """
+    return '%08x-%s-%s' % (timestamp, _serverName(server_url), _safe64(salt))
+
+
+def _fanOut(nonce_name):
+    """Return the name of the directory a nonce file is put in, taken
+    from the last two characters of the hash of its salt.  The last one
+    carries only four bits of the hash, so there are 1024 directories.
+
+    str -> str
+    """
+    return nonce_name[-2:].encode('hex')
+
+
 def _removeIfPresent(filename):
     """Attempt to remove a file, returning whether the file existed at
     the time of the call.
@@ -160,15 +197,12 @@ class FileOpenIDStore(OpenIDStore):
         if server_url.find('://') == -1:
             raise ValueError('Bad server URL: %r' % server_url)
 
-        proto, rest = server_url.split('://', 1)
-        domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
         if handle:
             handle_hash = _safe64(handle)
         else:
             handle_hash = ''
 
-        filename = '%s-%s-%s-%s' % (proto, domain, url_hash, handle_hash)
+        filename = '%s-%s' % (_serverName(server_url), handle_hash)
 
         return os.path.join(self.association_dir, filename)
 
@@ -179,11 +213,18 @@ class FileOpenIDStore(OpenIDStore):
         """
         association_s = association.serialize()
         filename = self.getAssociationFilename(server_url, association.handle)
+        self._writeFile(filename, association_s)
+
+    def _writeFile(self, filename, data):
+        """Atomically replace the contents of a file.
+
+        (str, str) -> NoneType
+        """
         tmp_file, tmp = self._mktemp()
 
         try:
             try:
-                tmp_file.write(association_s)
+                tmp_file.write(data)
                 os.fsync(tmp_file.fileno())
             finally:
                 tmp_file.close()
@@ -304,21 +345,7 @@ class FileOpenIDStore(OpenIDStore):
         if abs(timestamp - time.time()) > nonce.SKEW:
             return False
 
-        if server_url:
-            proto, rest = server_url.split('://', 1)
-        else:
-            # Create empty proto / rest values for empty server_url,
-            # which is part of a consumer-generated nonce.
-            proto, rest = '', ''
-
-        domain = _filenameEscape(rest.split('/', 1)[0])
-        url_hash = _safe64(server_url)
-        salt_hash = _safe64(salt)
-
-        filename = '%08x-%s-%s-%s-%s' % (timestamp, proto, domain,
-                                         url_hash, salt_hash)
-
-        filename = os.path.join(self.nonce_dir, filename)
+        filename = os.path.join(self.nonce_dir, _nonceName(server_url, timestamp, salt))
         try:
             fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o200)
         except OSError as why:
@@ -394,3 +421,340 @@ class FileOpenIDStore(OpenIDStore):
                 _removeIfPresent(filename)
                 removed += 1
         return removed
+
+
+class ShardedFileOpenIDStore(FileOpenIDStore):
+    """
+    A filesystem-based store like C{L{FileOpenIDStore}}, with a layout
+    that does not need to list large directories.
+
+    Layout of the store directory::
+
+        associations-v2/<server>/<handle hash>
+        associations-v2/<server>/latest
+        nonces-v2/<bucket timestamp>/<fan-out>/<nonce>
+        temp/
+
+    The associations with each server are kept in a directory of their
+    own.  Its C{latest} file contains the name of the file of the most
+    recently issued association, so it is found without looking at the
+    others.
+
+    Nonces are spread over directories by their timestamp and by the
+    last two characters of the hash of their salt, which make 1024
+    fan-out directories.  A timestamp directory is removed as a whole
+    once all of its nonces have expired.
+
+    If the directory contains the flat layout of C{L{FileOpenIDStore}},
+    it is used alongside the new one until it is moved over by
+    C{L{migrateFileStore}}, which may be run while the store is in use.
+
+    @cvar nonce_bucket_size: How many seconds of nonce timestamps
+        share a timestamp directory.
+    """
+
+    nonce_bucket_size = 10 * 60
+
+    latest_filename = 'latest'
+
+    def __init__(self, directory):
+        """
+        Initializes a new ShardedFileOpenIDStore.
+
+        @param directory: This is the directory to put the store
+            directories in.
+
+        @type directory: C{str}
+        """
+        directory = os.path.normpath(os.path.abspath(directory))
+
+        self.nonce_dir = os.path.join(directory, 'nonces-v2')
+        self.association_dir = os.path.join(directory, 'associations-v2')
+        self.temp_dir = os.path.join(directory, 'temp')
+        self.max_nonce_age = 6 * 60 * 60  # Six hours, in seconds
+
+        # The store in the flat layout, while there is one to migrate.
+        if (os.path.isdir(os.path.join(directory, 'associations')) or
+                os.path.isdir(os.path.join(directory, 'nonces'))):
+            self.legacy = FileOpenIDStore(directory)
+        else:
+            self.legacy = None
+
+        self._setup()
+
+    def _callLegacy(self, method, *args):
+        """Call a method of the store in the flat layout, unless it
+        has been migrated."""
+        legacy = self.legacy
+        if legacy is None:
+            return None
+
+        try:
+            return getattr(legacy, method)(*args)
+        except OSError as why:
+            if why.errno != ENOENT:
+                raise
+            # migrateFileStore has removed the flat layout.
+            self.legacy = None
+            return None
+
+    def getServerDirectory(self, server_url):
+        """Return the directory of the associations with a server.
+
+        str -> str
+        """
+        if server_url.find('://') == -1:
+            raise ValueError('Bad server URL: %r' % server_url)
+        return os.path.join(self.association_dir, _serverName(server_url))
+
+    def getAssociationFilename(self, server_url, handle):
+        return os.path.join(self.getServerDirectory(server_url), _safe64(handle))
+
+    def getNonceFilename(self, server_url, timestamp, salt):
+        """Return the name of the file that marks a nonce as used.
+
+        (str, int, str) -> str
+        """
+        name = _nonceName(server_url, timestamp, salt)
+        return os.path.join(self._bucketDirectory(timestamp), _fanOut(name), name)
+
+    def _bucketDirectory(self, timestamp):
+        bucket = timestamp - timestamp % self.nonce_bucket_size
+        return os.path.join(self.nonce_dir, '%08x' % bucket)
+
+    def _readLatest(self, server_dir):
+        try:
+            latest_file = open(os.path.join(server_dir, self.latest_filename), 'rb')
+        except IOError as why:
+            if why.errno == ENOENT:
+                return None
+            raise
+        try:
+            name = latest_file.read().strip()
+        finally:
+            latest_file.close()
+
+        if not name:
+            return None
+        return self._getAssociation(os.path.join(server_dir, name))
+
+    def _writeLatest(self, server_dir, handle):
+        self._writeFile(os.path.join(server_dir, self.latest_filename), _safe64(handle))
+
+    def storeAssociation(self, server_url, association):
+        server_dir = self.getServerDirectory(server_url)
+        _ensureDir(server_dir)
+        self._writeFile(os.path.join(server_dir, _safe64(association.handle)), association.serialize())
+
+        latest = self._readLatest(server_dir)
+        if latest is None or latest.issued <= association.issued:
+            self._writeLatest(server_dir, association.handle)
+
+    def _findLatest(self, server_dir):
+        """Find the most recently issued association in a server
+        directory and point the latest file to it."""
+        try:
+            names = os.listdir(server_dir)
+        except OSError as why:
+            if why.errno == ENOENT:
+                return None
+            raise
+
+        latest = None
+        for name in names:
+            if name == self.latest_filename:
+                continue
+            association = self._getAssociation(os.path.join(server_dir, name))
+            if association is not None and (latest is None or latest.issued < association.issued):
+                latest = association
+
+        if latest is not None:
+            self._writeLatest(server_dir, latest.handle)
+        return latest
+
+    def getAssociation(self, server_url, handle=None):
+        """Retrieve an association. If no handle is specified, return
+        the association with the latest issue date.
+
+        (str, str or NoneType) -> Association or NoneType
+        """
+        if handle:
+            association = self._getAssociation(self.getAssociationFilename(server_url, handle))
+            if association is None:
+                association = self._callLegacy('getAssociation', server_url, handle)
+            return association
+
+        server_dir = self.getServerDirectory(server_url)
+        association = self._readLatest(server_dir)
+        if association is None:
+            # The latest association expired or was removed.
+            association = self._findLatest(server_dir)
+
+        legacy_association = self._callLegacy('getAssociation', server_url)
+        if legacy_association is not None and (association is None or
+                                               association.issued < legacy_association.issued):
+            association = legacy_association
+        return association
+
+    def removeAssociation(self, server_url, handle):
+        """Remove an association if it exists. Do nothing if it does not.
+
+        (str, str) -> bool
+        """
+        removed = 0
+        if self._getAssociation(self.getAssociationFilename(server_url, handle)) is not None:
+            removed = _removeIfPresent(self.getAssociationFilename(server_url, handle))
+        return self._callLegacy('removeAssociation', server_url, handle) or removed
+
+    def useNonce(self, server_url, timestamp, salt):
+        """Return whether this nonce is valid.
+
+        str -> bool
+        """
+        if abs(timestamp - time.time()) > nonce.SKEW:
+            return False
+
+        if self.legacy is not None:
+            legacy_filename = os.path.join(self.legacy.nonce_dir, _nonceName(server_url, timestamp, salt))
+            if os.path.exists(legacy_filename):
+                return False
+
+        filename = self.getNonceFilename(server_url, timestamp, salt)
+        _ensureDir(os.path.dirname(filename))
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o200)
+        except OSError as why:
+            if why.errno == EEXIST:
+                return False
+            else:
+                raise
+        else:
+            os.close(fd)
+            return True
+
+    def cleanupAssociations(self):
+        removed = 0
+        for server_name in os.listdir(self.association_dir):
+            server_dir = os.path.join(self.association_dir, server_name)
+            for name in os.listdir(server_dir):
+                if name == self.latest_filename:
+                    continue
+                filename = os.path.join(server_dir, name)
+                # Removes expired and corrupted associations
+                if self._getAssociation(filename) is None:
+                    removed += 1
+
+            if self._readLatest(server_dir) is None and self._findLatest(server_dir) is None:
+                _removeIfPresent(os.path.join(server_dir, self.latest_filename))
+                try:
+                    os.rmdir(server_dir)
+                except OSError:
+                    # An association was just stored.
+                    pass
+
+        return removed + (self._callLegacy('cleanupAssociations') or 0)
+
+    def _removeNonces(self, bucket_dir, expired):
+        """Remove nonces from a timestamp directory.
+
+        @param expired: Function telling whether a nonce file name is
+            expired, or None to remove all of the nonces.
+
+        @return: the number of nonces removed
+        """
+        removed = 0
+        for fan_out in os.listdir(bucket_dir):
+            fan_out_dir = os.path.join(bucket_dir, fan_out)
+            for name in os.listdir(fan_out_dir):
+                if expired is None or expired(name):
+                    removed += _removeIfPresent(os.path.join(fan_out_dir, name))
+            if expired is None:
+                try:
+                    os.rmdir(fan_out_dir)
+                except OSError:
+                    # A nonce was just used.
+                    pass
+        if expired is None:
+            try:
+                os.rmdir(bucket_dir)
+            except OSError:
+                pass
+        return removed
+
+    def cleanupNonces(self):
+        now = time.time()
+
+        def expired(name):
+            timestamp = int(name.split('-', 1)[0], 16)
+            return abs(timestamp - now) > nonce.SKEW
+
+        removed = 0
+        for bucket in os.listdir(self.nonce_dir):
+            start = int(bucket, 16)
+            end = start + self.nonce_bucket_size - 1
+            bucket_dir = os.path.join(self.nonce_dir, bucket)
+            if end < now - nonce.SKEW or start > now + nonce.SKEW:
+                removed += self._removeNonces(bucket_dir, None)
+            elif start < now - nonce.SKEW or end > now + nonce.SKEW:
+                removed += self._removeNonces(bucket_dir, expired)
+
+        return removed + (self._callLegacy('cleanupNonces') or 0)
+
+
+def migrateFileStore(directory):
+    """Move the associations and nonces of a C{L{FileOpenIDStore}} to
+    the layout of C{L{ShardedFileOpenIDStore}}, and remove the
+    directories of the old layout.
+
+    This can be done while the directory is used by
+    C{ShardedFileOpenIDStore}s, but not by C{FileOpenIDStore}s.
+    Expired associations and nonces are removed instead of moved.
+
+    @param directory: The store directory
+    @type directory: C{str}
+
+    @return: The number of associations and nonces moved
+    @rtype: (int, int)
+    """
+    store = ShardedFileOpenIDStore(directory)
+    legacy = store.legacy
+    if legacy is None:
+        return 0, 0
+
+    moved_associations = 0
+    for name in os.listdir(legacy.association_dir):
+        filename = os.path.join(legacy.association_dir, name)
+        association = legacy._getAssociation(filename)
+        if association is None:
+            continue
+
+        server_dir = os.path.join(store.association_dir, name.rsplit('-', 1)[0])
+        _ensureDir(server_dir)
+        store._writeFile(os.path.join(server_dir, _safe64(association.handle)), association.serialize())
+        # The latest file is fixed up once everything is moved.
+        _removeIfPresent(os.path.join(server_dir, store.latest_filename))
+        _removeIfPresent(filename)
+        moved_associations += 1
+
+    for server_name in os.listdir(store.association_dir):
+        server_dir = os.path.join(store.association_dir, server_name)
+        if store._readLatest(server_dir) is None:
+            store._findLatest(server_dir)
+
+    now = time.time()
+    moved_nonces = 0
+    for name in os.listdir(legacy.nonce_dir):
+        filename = os.path.join(legacy.nonce_dir, name)
+        timestamp = int(name.split('-', 1)[0], 16)
+        if abs(timestamp - now) > nonce.SKEW:
+            _removeIfPresent(filename)
+            continue
+
+        new_filename = os.path.join(store._bucketDirectory(timestamp), _fanOut(name), name)
+        _ensureDir(os.path.dirname(new_filename))
+        os.rename(filename, new_filename)
+        moved_nonces += 1
+
+    os.rmdir(legacy.association_dir)
+    os.rmdir(legacy.nonce_dir)
+    return moved_associations, moved_nonces
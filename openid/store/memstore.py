@@ -1,44 +1,72 @@
 """A simple store using only in-process memory."""
 
 import copy
+import logging
+import threading
 import time
+from collections import OrderedDict
 
 from openid.store import nonce
 
+_LOGGER = logging.getLogger(__name__)
+
 
 class ServerAssocs(object):
+    """The associations with one server, indexed by handle.  The
+    newest association is kept at hand, so L{best} does not have to
+    look at the others."""
+
     def __init__(self):
         self.assocs = {}
+        self.newest = None
+
+    def __len__(self):
+        return len(self.assocs)
+
+    def __eq__(self, other):
+        return self.assocs == other.assocs
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def _findNewest(self):
+        self.newest = None
+        for assoc in self.assocs.itervalues():
+            if self.newest is None or self.newest.issued < assoc.issued:
+                self.newest = assoc
 
     def set(self, assoc):
+        replaced = self.assocs.get(assoc.handle)
         self.assocs[assoc.handle] = assoc
+        if replaced is not None and replaced is self.newest:
+            self._findNewest()
+        elif self.newest is None or self.newest.issued <= assoc.issued:
+            self.newest = assoc
 
     def get(self, handle):
         return self.assocs.get(handle)
 
     def remove(self, handle):
         try:
-            del self.assocs[handle]
+            assoc = self.assocs.pop(handle)
         except KeyError:
             return False
-        else:
-            return True
+
+        if assoc is self.newest:
+            self._findNewest()
+        return True
 
     def best(self):
-        """Returns association with the oldest issued date.
+        """Returns association with the newest issued date.
 
         or None if there are no associations.
         """
-        best = None
-        for assoc in self.assocs.values():
-            if best is None or best.issued < assoc.issued:
-                best = assoc
-        return best
+        return self.newest
 
     def cleanup(self):
         """Remove expired associations.
 
-        @return: tuple of (removed associations, remaining associations)
+        @return: tuple of (removed handles, remaining associations)
         """
         remove = []
         for handle, assoc in self.assocs.iteritems():
@@ -46,81 +74,187 @@ class ServerAssocs(object):
                 remove.append(handle)
         for handle in remove:
             del self.assocs[handle]
-        return len(remove), len(self.assocs)
+        if self.newest is not None and self.newest.handle in remove:
+            self._findNewest()
+        return remove, len(self.assocs)
 
 
 class MemoryStore(object):
     """In-process memory store.
 
     Use for single long-running processes.  No persistence supplied.
+
+    The store may be shared between threads.  The newest association
+    with every server is indexed and nonces are kept in buckets by
+    timestamp, so neither getting an association nor expiring nonces
+    has to look at every entry.
+
+    @cvar nonce_bucket_size: How many seconds of nonce timestamps
+        share a bucket.
     """
 
-    def __init__(self):
+    nonce_bucket_size = 60
+
+    def __init__(self, max_associations=None, max_nonces=None):
+        """
+        @param max_associations: The maximum number of associations
+            to keep.  When it is reached, the association that was
+            stored first is discarded.  Unlimited if None.
+        @type max_associations: C{int} or C{NoneType}
+
+        @param max_nonces: The maximum number of nonces to keep.  When
+            it is reached and no nonces have expired, new nonces are
+            rejected.  Unlimited if None.
+        @type max_nonces: C{int} or C{NoneType}
+        """
+        self.max_associations = max_associations
+        self.max_nonces = max_nonces
+
         self.server_assocs = {}
-        self.nonces = {}
+        # Keys of the stored associations, (server_url, handle), in the
+        # order they were stored.
+        self._assoc_order = OrderedDict()
+        # Maps timestamp // nonce_bucket_size to a set of nonces.
+        self.nonce_buckets = {}
+        self._nonce_count = 0
 
-    def _getServerAssocs(self, server_url):
-        try:
-            return self.server_assocs[server_url]
-        except KeyError:
-            assocs = self.server_assocs[server_url] = ServerAssocs()
-            return assocs
+        self.evicted_associations = 0
+        self.rejected_nonces = 0
+
+        self._lock = threading.Lock()
+
+    def getStats(self):
+        """Return the size of the store.
+
+        @return: dictionary with the number of C{servers},
+            C{associations}, C{nonces}, C{nonce_buckets},
+            C{evicted_associations} discarded to stay below
+            C{max_associations} and C{rejected_nonces} refused to stay
+            below C{max_nonces}
+        @rtype: C{dict}
+        """
+        with self._lock:
+            return {
+                'servers': len(self.server_assocs),
+                'associations': len(self._assoc_order),
+                'nonces': self._nonce_count,
+                'nonce_buckets': len(self.nonce_buckets),
+                'evicted_associations': self.evicted_associations,
+                'rejected_nonces': self.rejected_nonces,
+            }
 
     def storeAssociation(self, server_url, assoc):
-        assocs = self._getServerAssocs(server_url)
-        assocs.set(copy.deepcopy(assoc))
+        # Associations are not modified once they are created, so a
+        # shallow copy is enough to keep the stored one independent.
+        assoc = copy.copy(assoc)
+        key = (server_url, assoc.handle)
+        with self._lock:
+            try:
+                assocs = self.server_assocs[server_url]
+            except KeyError:
+                assocs = self.server_assocs[server_url] = ServerAssocs()
+            assocs.set(assoc)
+
+            self._assoc_order.pop(key, None)
+            self._assoc_order[key] = None
+            if self.max_associations is not None:
+                while len(self._assoc_order) > self.max_associations:
+                    (old_url, old_handle), _ = self._assoc_order.popitem(last=False)
+                    self._removeAssociation(old_url, old_handle)
+                    self.evicted_associations += 1
 
     def getAssociation(self, server_url, handle=None):
-        assocs = self._getServerAssocs(server_url)
-        if handle is None:
-            return assocs.best()
-        else:
-            return assocs.get(handle)
+        with self._lock:
+            assocs = self.server_assocs.get(server_url)
+            if assocs is None:
+                return None
+            if handle is None:
+                return assocs.best()
+            else:
+                return assocs.get(handle)
+
+    def _removeAssociation(self, server_url, handle):
+        assocs = self.server_assocs.get(server_url)
+        if assocs is None or not assocs.remove(handle):
+            return False
+        if not assocs:
+            del self.server_assocs[server_url]
+        return True
 
     def removeAssociation(self, server_url, handle):
-        assocs = self._getServerAssocs(server_url)
-        return assocs.remove(handle)
+        with self._lock:
+            self._assoc_order.pop((server_url, handle), None)
+            return self._removeAssociation(server_url, handle)
 
     def useNonce(self, server_url, timestamp, salt):
         if abs(timestamp - time.time()) > nonce.SKEW:
             return False
 
         anonce = (str(server_url), int(timestamp), str(salt))
-        if anonce in self.nonces:
-            return False
-        else:
-            self.nonces[anonce] = None
+        bucket_key = anonce[1] // self.nonce_bucket_size
+        with self._lock:
+            bucket = self.nonce_buckets.get(bucket_key)
+            if bucket is not None and anonce in bucket:
+                return False
+
+            if self.max_nonces is not None and self._nonce_count >= self.max_nonces:
+                self._cleanupNonces()
+                if self._nonce_count >= self.max_nonces:
+                    self.rejected_nonces += 1
+                    _LOGGER.warn('Rejecting nonce, the store is full with %d nonces', self._nonce_count)
+                    return False
+                bucket = self.nonce_buckets.get(bucket_key)
+
+            if bucket is None:
+                bucket = self.nonce_buckets[bucket_key] = set()
+            bucket.add(anonce)
+            self._nonce_count += 1
             return True
 
-    def cleanupNonces(self):
+    def _cleanupNonces(self):
         now = time.time()
-        expired = []
-        for anonce in self.nonces.iterkeys():
-            if abs(anonce[1] - now) > nonce.SKEW:
-                # removing items while iterating over the set could be bad.
-                expired.append(anonce)
+        size = self.nonce_bucket_size
+        removed = 0
+        for bucket_key in self.nonce_buckets.keys():
+            start = bucket_key * size
+            end = start + size - 1
+            if end < now - nonce.SKEW or start > now + nonce.SKEW:
+                # Every nonce in the bucket has expired.
+                expired = self.nonce_buckets.pop(bucket_key)
+                removed += len(expired)
+            elif start < now - nonce.SKEW or end > now + nonce.SKEW:
+                # Some of them have.
+                bucket = self.nonce_buckets[bucket_key]
+                expired = [anonce for anonce in bucket if abs(anonce[1] - now) > nonce.SKEW]
+                bucket.difference_update(expired)
+                if not bucket:
+                    del self.nonce_buckets[bucket_key]
+                removed += len(expired)
 
-        for anonce in expired:
-            del self.nonces[anonce]
-        return len(expired)
+        self._nonce_count -= removed
+        return removed
+
+    def cleanupNonces(self):
+        with self._lock:
+            return self._cleanupNonces()
 
     def cleanupAssociations(self):
-        remove_urls = []
         removed_assocs = 0
-        for server_url, assocs in self.server_assocs.iteritems():
-            removed, remaining = assocs.cleanup()
-            removed_assocs += removed
-            if not remaining:
-                remove_urls.append(server_url)
-
-        # Remove entries from server_assocs that had none remaining.
-        for server_url in remove_urls:
-            del self.server_assocs[server_url]
+        with self._lock:
+            for server_url, assocs in self.server_assocs.items():
+                removed, remaining = assocs.cleanup()
+                removed_assocs += len(removed)
+                for handle in removed:
+                    del self._assoc_order[(server_url, handle)]
+
+                # Remove entries from server_assocs that had none remaining.
+                if not remaining:
+                    del self.server_assocs[server_url]
         return removed_assocs
 
     def __eq__(self, other):
         return ((self.server_assocs == other.server_assocs) and
-                (self.nonces == other.nonces))
+                (self.nonce_buckets == other.nonce_buckets))
 
     def __ne__(self, other):
         return not (self == other)
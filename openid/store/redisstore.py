@@ -0,0 +1,325 @@
+"""
+This module contains an C{L{OpenIDStore}} implementation backed by a
+server speaking the Redis protocol (RESP).
+
+Every nonce is claimed by a single C{SET NX EX} command, and both
+nonces and associations are given a time to live, so the server
+expires them by itself and the cleanup methods do nothing.  The
+associations with a server are indexed by a sorted set scored by
+their issue date, so the newest one is found with one range query.
+
+The module contains its own small client, so no Redis library is
+required::
+
+    from openid.store.redisstore import RedisConnectionPool, RedisStore
+    store = RedisStore(RedisConnectionPool('redis.example.com'))
+"""
+
+__all__ = [
+    'RedisConnectionPool',
+    'RedisError',
+    'RedisStore',
+]
+
+import socket
+import threading
+import time
+
+from openid.association import Association
+from openid.store import nonce
+from openid.store.interface import OpenIDStore
+
+
+class RedisError(Exception):
+    """An error reply from the server, or a reply that does not
+    conform to the protocol."""
+
+
+def _encodeCommand(command):
+    """Encode a command, a sequence of arguments, as a RESP array of
+    bulk strings."""
+    parts = ['*%d\r\n' % len(command)]
+    for arg in command:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        else:
+            arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+class _RedisConnection(object):
+    """A connection to the server."""
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        # Pipelined commands are sent in one write, don't delay them.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def send(self, commands):
+        self.sock.sendall(''.join(_encodeCommand(command) for command in commands))
+
+    def readReply(self):
+        """Read one reply.  Error replies are returned as
+        L{RedisError}s, so the replies following them can still be
+        read."""
+        line = self.reader.readline()
+        if not line.endswith('\r\n'):
+            raise socket.error('Connection closed by the server')
+
+        kind, rest = line[0], line[1:-2]
+        if kind == '+':
+            return rest
+        elif kind == '-':
+            return RedisError(rest)
+        elif kind == ':':
+            return int(rest)
+        elif kind == '$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise socket.error('Connection closed by the server')
+            return data[:-2]
+        elif kind == '*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.readReply() for _ in xrange(length)]
+        else:
+            raise RedisError('Unexpected reply: %r' % (line,))
+
+
+class RedisConnectionPool(object):
+    """A pool of connections to a Redis server, which may be shared
+    between threads.
+
+    Commands are sent with L{execute}, which pipelines them: all of
+    them are sent before the first reply is read.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, max_idle=10, timeout=5.0):
+        """
+        @param db: The number of the database to select.
+        @type db: C{int}
+
+        @param password: The password to authenticate with, if any.
+        @type password: C{str} or C{NoneType}
+
+        @param max_idle: The maximum number of idle connections to
+            keep open.
+        @type max_idle: C{int}
+
+        @param timeout: The socket timeout, in seconds.
+        @type timeout: C{float}
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self.connections_made = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def getStats(self):
+        """Return usage statistics of the pool.
+
+        @return: dictionary with the number of C{connections} made and
+            of C{idle} connections
+        @rtype: C{dict}
+        """
+        with self._lock:
+            return {'connections': self.connections_made, 'idle': len(self._idle)}
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _connect(self):
+        connection = _RedisConnection(self.host, self.port, self.timeout)
+        with self._lock:
+            self.connections_made += 1
+
+        setup = []
+        if self.password is not None:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            try:
+                self._checkReplies(self._pipeline(connection, setup))
+            except RedisError:
+                connection.close()
+                raise
+        return connection
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _pipeline(self, connection, commands):
+        try:
+            connection.send(commands)
+            replies = [connection.readReply() for _ in commands]
+        except Exception:
+            # The connection is in an unknown state; don't reuse it.
+            connection.close()
+            raise
+        return replies
+
+    def _checkReplies(self, replies):
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def execute(self, *commands):
+        """Send commands to the server in one pipeline and return
+        their replies.
+
+        @param commands: The commands, each a tuple of arguments.
+
+        @return: The replies, in the order of the commands.
+        @rtype: C{list}
+
+        @raises RedisError: if any of the commands failed.
+        @raises socket.error: if the connection failed.
+        """
+        connection = self._checkout()
+        replies = self._pipeline(connection, commands)
+        self._checkin(connection)
+        return self._checkReplies(replies)
+
+
+class RedisStore(OpenIDStore):
+    """
+    This is a store for use with a Redis server shared by all of the
+    processes serving OpenID requests.
+
+    Keys:
+      - C{<prefix>assoc:<len(handle)>:<handle><server_url>} holds a
+        serialized association until it expires.
+      - C{<prefix>assocs:<server_url>} is a sorted set of the handles
+        of the associations with a server, scored by their issue
+        date.  Members whose association has expired are removed when
+        they are found.
+      - C{<prefix>nonce:<timestamp>:<len(salt)>:<salt><server_url>}
+        exists while the nonce can be used.
+    """
+
+    def __init__(self, pool=None, key_prefix='openid:'):
+        """
+        @param pool: The connection pool to use.  By default, a pool
+            of connections to a Redis server on localhost.
+        @type pool: L{RedisConnectionPool}
+
+        @param key_prefix: Prepended to all keys, to separate them
+            from the other data on the server.
+        @type key_prefix: C{str}
+        """
+        if pool is None:
+            pool = RedisConnectionPool()
+        self.pool = pool
+        self.key_prefix = key_prefix
+
+    def _assocKey(self, server_url, handle):
+        return '%sassoc:%d:%s%s' % (self.key_prefix, len(handle), handle, server_url)
+
+    def _assocsKey(self, server_url):
+        return '%sassocs:%s' % (self.key_prefix, server_url)
+
+    def _nonceKey(self, server_url, timestamp, salt):
+        return '%snonce:%d:%d:%s%s' % (self.key_prefix, timestamp, len(salt), salt, server_url)
+
+    def storeAssociation(self, server_url, association):
+        ttl = association.getExpiresIn()
+        if ttl <= 0:
+            return
+
+        assocs_key = self._assocsKey(server_url)
+        _, _, assocs_ttl = self.pool.execute(
+            ('SET', self._assocKey(server_url, association.handle), association.serialize(), 'EX', ttl),
+            ('ZADD', assocs_key, association.issued, association.handle),
+            ('TTL', assocs_key))
+
+        # The index lives as long as the association that expires last.
+        if assocs_ttl < ttl:
+            self.pool.execute(('EXPIRE', assocs_key, ttl))
+
+    def _getAssociation(self, server_url, handle):
+        assoc_s = self.pool.execute(('GET', self._assocKey(server_url, handle)))[0]
+        if assoc_s is None:
+            return None
+
+        assoc = Association.deserialize(assoc_s)
+        if assoc.getExpiresIn() <= 0:
+            return None
+        return assoc
+
+    def getAssociation(self, server_url, handle=None):
+        if handle is not None:
+            return self._getAssociation(server_url, handle)
+
+        assocs_key = self._assocsKey(server_url)
+        while True:
+            handles = self.pool.execute(('ZREVRANGE', assocs_key, 0, 0))[0]
+            if not handles:
+                return None
+
+            assoc = self._getAssociation(server_url, handles[0])
+            if assoc is not None:
+                return assoc
+
+            # The newest association has expired.
+            self.pool.execute(('ZREM', assocs_key, handles[0]))
+
+    def removeAssociation(self, server_url, handle):
+        deleted, _ = self.pool.execute(
+            ('DEL', self._assocKey(server_url, handle)),
+            ('ZREM', self._assocsKey(server_url), handle))
+        return deleted > 0
+
+    def useNonce(self, server_url, timestamp, salt):
+        now = time.time()
+        if abs(timestamp - now) > nonce.SKEW:
+            return False
+
+        # Keep the nonce for as long as its timestamp is acceptable.
+        ttl = max(1, int(timestamp + nonce.SKEW - now) + 1)
+        reply = self.pool.execute(('SET', self._nonceKey(server_url, timestamp, salt), '1', 'NX', 'EX', ttl))[0]
+        return reply is not None
+
+    def cleanupNonces(self):
+        """Nonces are expired by the server.
+
+        @return: 0
+        """
+        return 0
+
+    def cleanupAssociations(self):
+        """Associations are expired by the server.
+
+        @return: 0
+        """
+        return 0
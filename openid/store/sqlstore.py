@@ -6,14 +6,25 @@ Example of how to initialize a store database::
 
     python -c 'from openid.store import sqlstore; import pysqlite2.dbapi2;
                sqlstore.SQLiteStore(pysqlite2.dbapi2.connect("cstore.db")).createTables()'
+
+To share one store between the threads of a server, give it a
+C{L{SQLConnectionPool}} instead of a connection::
+
+    pool = sqlstore.SQLConnectionPool(lambda: MySQLdb.connect(db='openid'), max_connections=10)
+    store = sqlstore.MySQLStore(pool)
 """
+import logging
 import re
+import threading
 import time
+from collections import deque
 
 from openid.association import Association
 from openid.store import nonce
 from openid.store.interface import OpenIDStore
 
+_LOGGER = logging.getLogger(__name__)
+
 
 def _inTxn(func):
     def wrapped(self, *args, **kwargs):
@@ -31,6 +42,190 @@ def _inTxn(func):
     return wrapped
 
 
+class PoolTimeout(Exception):
+    """No connection of a L{SQLConnectionPool} became available in
+    time."""
+
+
+class SQLConnectionPool(object):
+    """A pool of database connections, which may be shared between
+    threads.
+
+    A connection is checked out of the pool for every transaction.
+    Connections are opened when needed, up to C{max_connections}; then
+    the threads wait for a connection to be checked in.
+
+    A transaction failing with an error the store considers transient,
+    such as an C{OperationalError}, is retried on another connection
+    after an exponentially growing delay.  The connection it failed on
+    is closed.
+    """
+
+    def __init__(self, connect, max_connections=10, timeout=None, retries=3, retry_delay=0.05):
+        """
+        @param connect: Called without arguments to open a new
+            connection.  The connections are used by several threads
+            in turn, so they must allow it, e.g. SQLite connections
+            must be opened with C{check_same_thread=False}.
+        @type connect: callable
+
+        @param max_connections: The maximum number of open
+            connections.
+        @type max_connections: C{int}
+
+        @param timeout: How many seconds to wait for a connection when
+            all of them are in use, before raising L{PoolTimeout}.
+            Wait forever if None.
+        @type timeout: C{float} or C{NoneType}
+
+        @param retries: How many times a transaction is retried.
+        @type retries: C{int}
+
+        @param retry_delay: The delay before the first retry, in
+            seconds.  It doubles with every retry.
+        @type retry_delay: C{float}
+        """
+        self.connect = connect
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.discarded = 0
+
+    def getStats(self):
+        """Return usage statistics of the pool.
+
+        @return: dictionary with the number of open C{connections},
+            C{idle} and C{in_use} ones, C{max_connections}, the number
+            of C{checkouts}, of C{waits} for a connection when all were
+            in use and of C{timeouts} of such waits, of transactions
+            C{retried} and of connections C{discarded} after an error
+        @rtype: C{dict}
+        """
+        with self._cond:
+            return {
+                'connections': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'max_connections': self.max_connections,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'retried': self.retried,
+                'discarded': self.discarded,
+            }
+
+    def checkout(self):
+        """Return a connection, opening it if needed.
+
+        @raises PoolTimeout: if no connection became available in
+            C{timeout} seconds.
+        """
+        with self._cond:
+            self.checkouts += 1
+            if not self._idle and self._open >= self.max_connections:
+                self.waits += 1
+                if self.timeout is not None:
+                    deadline = time.time() + self.timeout
+                while not self._idle and self._open >= self.max_connections:
+                    if self.timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout('No connection available in %s seconds' % self.timeout)
+                    self._cond.wait(remaining)
+
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, conn, discard=False):
+        """Return a connection to the pool.
+
+        @param discard: Whether to close the connection rather than
+            reuse it.
+        @type discard: C{bool}
+        """
+        if discard:
+            try:
+                conn.close()
+            except Exception:
+                _LOGGER.exception('Error closing a discarded connection')
+            with self._cond:
+                self._open -= 1
+                self.discarded += 1
+                self._cond.notify()
+        else:
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def call(self, is_transient, func, *args, **kwargs):
+        """Call C{func} with a connection checked out of the pool and
+        the other arguments.
+
+        @param is_transient: Called with an exception raised by
+            C{func}, returns whether the call should be retried.
+        @type is_transient: callable
+        """
+        attempt = 0
+        while True:
+            conn = self.checkout()
+            try:
+                result = func(conn, *args, **kwargs)
+            except Exception as why:
+                if not is_transient(why):
+                    self.checkin(conn)
+                    raise
+                self.checkin(conn, discard=True)
+                if attempt >= self.retries:
+                    raise
+                _LOGGER.warn('Retrying the transaction after an error: %s', why)
+                with self._cond:
+                    self.retried += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+            else:
+                self.checkin(conn)
+                return result
+
+
+class _NonceBatch(object):
+    """Nonces waiting to be inserted in one transaction."""
+
+    def __init__(self):
+        self.nonces = []
+        self.results = None
+        self.error = None
+
+
 class SQLStore(OpenIDStore):
     """
     This is the parent class for the SQL stores, which contains the
@@ -44,12 +239,21 @@ class SQLStore(OpenIDStore):
     To create the tables with the proper schema, see the
     C{L{createTables}} method.
 
+    The store may be shared between threads, which take turns using
+    the connection, or use the connections of a
+    C{L{SQLConnectionPool}} given instead.  If C{nonce_batch_size} is given, the nonces used
+    by concurrent threads are inserted together: while one transaction
+    inserts nonces, the nonces used by the other threads are gathered
+    and inserted by the next one.  Several nonces can also be used at
+    once with C{L{useNonces}}.
+
     This class shouldn't be used directly.  Use one of its subclasses
     instead, as those contain the code necessary to use a specific
     database.
 
-    All methods other than C{L{__init__}} and C{L{createTables}}
-    should be considered implementation details.
+    All methods other than C{L{__init__}}, C{L{createTables}},
+    C{L{useNonces}} and the methods of C{L{OpenIDStore}} should be
+    considered implementation details.
 
 
     @cvar associations_table: This is the default name of the table to
@@ -59,13 +263,18 @@ class SQLStore(OpenIDStore):
         nonces in.
 
 
-    @sort: __init__, createTables
+    @cvar nonce_insert_rows: The maximum number of nonces inserted by
+        one statement.
+
+
+    @sort: __init__, createTables, useNonces, cleanupNonces
     """
 
     associations_table = 'oid_associations'
     nonces_table = 'oid_nonces'
+    nonce_insert_rows = 100
 
-    def __init__(self, conn, associations_table=None, nonces_table=None):
+    def __init__(self, conn, associations_table=None, nonces_table=None, nonce_batch_size=None):
         """
         This creates a new SQLStore instance.  It requires an
         established database connection be given to it, and it allows
@@ -74,10 +283,10 @@ class SQLStore(OpenIDStore):
 
         @param conn: This must be an established connection to a
             database of the correct type for the SQLStore subclass
-            you're using.
+            you're using, or a pool of such connections.
 
         @type conn: A python database API compatible connection
-            object.
+            object or C{L{SQLConnectionPool}}
 
 
         @param associations_table: This is an optional parameter to
@@ -93,9 +302,24 @@ class SQLStore(OpenIDStore):
             default value is specified in C{L{SQLStore.nonces_table}}.
 
         @type nonces_table: C{str}
+
+
+        @param nonce_batch_size: The maximum number of nonces used by
+            concurrent calls to C{L{useNonce}} that are inserted in one
+            transaction.  If None, every nonce is inserted in its own
+            transaction.
+
+        @type nonce_batch_size: C{int} or C{NoneType}
         """
-        self.conn = conn
-        self.cur = None
+        if isinstance(conn, SQLConnectionPool):
+            self.conn = None
+            self.pool = conn
+        else:
+            self.conn = conn
+            self.pool = None
+        # Every thread has its own cursor.
+        self._local = threading.local()
+        self._conn_lock = threading.Lock()
         self._statement_cache = {}
         self._table_names = {
             'associations': associations_table or self.associations_table,
@@ -103,17 +327,36 @@ class SQLStore(OpenIDStore):
         }
         self.max_nonce_age = 6 * 60 * 60  # Six hours, in seconds
 
+        self.nonce_batch_size = nonce_batch_size
+        self._nonce_batches = deque()
+        self._nonce_batches_cond = threading.Condition()
+        self._inserting_nonces = False
+
         # DB API extension: search for "Connection Attributes .Error,
         # .ProgrammingError, etc." in
         # http://www.python.org/dev/peps/pep-0249/
-        if hasattr(self.conn, 'IntegrityError') and hasattr(self.conn, 'OperationalError'):
-            self.exceptions = self.conn
+        if self.pool is None:
+            probe = self.conn
+        else:
+            probe = self.pool.checkout()
+            self.pool.checkin(probe)
+        if hasattr(probe, 'IntegrityError') and hasattr(probe, 'OperationalError'):
+            self.exceptions = probe
 
         if not (hasattr(self.exceptions, 'IntegrityError') and
                 hasattr(self.exceptions, 'OperationalError')):
             raise RuntimeError("Error using database connection module "
                                "(Maybe it can't be imported?)")
 
+    @property
+    def cur(self):
+        """The cursor of the transaction in progress in this thread."""
+        return getattr(self._local, 'cur', None)
+
+    @cur.setter
+    def cur(self, cur):
+        self._local.cur = cur
+
     def blobDecode(self, blob):
         """Convert a blob as returned by the SQL engine into a str object.
 
@@ -134,8 +377,21 @@ class SQLStore(OpenIDStore):
             self._statement_cache[sql_name] = sql
             return sql
 
+    def _getAddNoncesSQL(self, count):
+        """Return the statement inserting C{count} nonces."""
+        key = ('add_nonces_sql', count)
+        try:
+            return self._statement_cache[key]
+        except KeyError:
+            sql = self.add_nonces_sql % {'nonces': '%(nonces)s', 'values': ', '.join([self.nonce_values_sql] * count)}
+            sql %= self._table_names
+            self._statement_cache[key] = sql
+            return sql
+
     def _execSQL(self, sql_name, *args):
-        sql = self._getSQL(sql_name)
+        self._execute(self._getSQL(sql_name), args)
+
+    def _execute(self, sql, args):
         # Kludge because we have reports of postgresql not quoting
         # arguments if they are passed in as unicode instead of str.
         # Currently the strings in our tables just have ascii in them,
@@ -167,24 +423,36 @@ class SQLStore(OpenIDStore):
         """Execute the given function inside of a transaction, with an
         open cursor. If no exception is raised, the transaction is
         comitted, otherwise it is rolled back."""
+        if self.pool is not None:
+            return self.pool.call(self._isTransientError, self._runTransaction, func, *args, **kwargs)
+
+        with self._conn_lock:
+            return self._runTransaction(self.conn, func, *args, **kwargs)
+
+    def _runTransaction(self, conn, func, *args, **kwargs):
         # No nesting of transactions
-        self.conn.rollback()
+        conn.rollback()
 
         try:
-            self.cur = self.conn.cursor()
+            self.cur = conn.cursor()
             try:
                 ret = func(*args, **kwargs)
             finally:
                 self.cur.close()
                 self.cur = None
         except Exception:
-            self.conn.rollback()
+            conn.rollback()
             raise
         else:
-            self.conn.commit()
+            conn.commit()
 
         return ret
 
+    def _isTransientError(self, error):
+        """Return whether a transaction that failed with the error
+        should be retried on another connection."""
+        return isinstance(error, self.exceptions.OperationalError) and not self._isNonceConflict(error)
+
     def txn_createTables(self):
         """
         This method creates the database tables necessary for this
@@ -272,13 +540,130 @@ class SQLStore(OpenIDStore):
             # The nonce was successfully added
             return True
 
-    useNonce = _inTxn(txn_useNonce)
+    def useNonce(self, server_url, timestamp, salt):
+        """Return whether this nonce is present, and if it is, then
+        remove it from the set.
+
+        str -> bool"""
+        if self.nonce_batch_size is None:
+            return self._callInTransaction(self.txn_useNonce, server_url, timestamp, salt)
+
+        with self._nonce_batches_cond:
+            if not self._nonce_batches or len(self._nonce_batches[-1].nonces) >= self.nonce_batch_size:
+                self._nonce_batches.append(_NonceBatch())
+            batch = self._nonce_batches[-1]
+            index = len(batch.nonces)
+            batch.nonces.append((server_url, timestamp, salt))
+
+            # Wait until the batch was inserted by another thread, or
+            # it's this thread's turn to insert it.
+            while batch.results is None and batch.error is None:
+                if not self._inserting_nonces and self._nonce_batches[0] is batch:
+                    self._inserting_nonces = True
+                    self._nonce_batches.popleft()
+                    break
+                self._nonce_batches_cond.wait()
+            else:
+                if batch.error is not None:
+                    raise batch.error
+                return batch.results[index]
+
+        try:
+            batch.results = self.useNonces(batch.nonces)
+        except Exception as error:
+            batch.error = error
+            raise
+        finally:
+            with self._nonce_batches_cond:
+                self._inserting_nonces = False
+                self._nonce_batches_cond.notify_all()
+        return batch.results[index]
+
+    def _isNonceConflict(self, error):
+        """Return whether the error was caused by inserting a nonce
+        which is present already."""
+        return isinstance(error, self.exceptions.IntegrityError)
+
+    def useNonces(self, nonces):
+        """Use several nonces in one transaction.
+
+        @param nonces: The nonces, as C{(server_url, timestamp, salt)}
+            tuples.
+        @type nonces: C{list}
+
+        @return: Whether each of the nonces was present, in order.
+        @rtype: C{list} of C{bool}
+        """
+        results = [False] * len(nonces)
+        now = time.time()
+        new_nonces = {}
+        for index, anonce in enumerate(nonces):
+            if abs(anonce[1] - now) <= nonce.SKEW and anonce not in new_nonces:
+                new_nonces[anonce] = index
+        if not new_nonces:
+            return results
+
+        rows = new_nonces.keys()
+        try:
+            self._callInTransaction(self.txn_addNonces, rows)
+        except (self.exceptions.IntegrityError, self.exceptions.OperationalError) as why:
+            if not self._isNonceConflict(why):
+                raise
+            # Some of the nonces were used; insert the others.
+            added = self._callInTransaction(self.txn_addNewNonces, rows)
+        else:
+            added = [True] * len(rows)
+
+        for anonce, is_added in zip(rows, added):
+            results[new_nonces[anonce]] = is_added
+        return results
+
+    def txn_addNonces(self, rows):
+        """Insert the nonces, failing if any of them is present."""
+        for start in xrange(0, len(rows), self.nonce_insert_rows):
+            chunk = rows[start:start + self.nonce_insert_rows]
+            self._execute(self._getAddNoncesSQL(len(chunk)), [value for row in chunk for value in row])
 
-    def txn_cleanupNonces(self):
-        self.db_clean_nonce(int(time.time()) - nonce.SKEW)
+    def txn_addNewNonces(self, rows):
+        """Insert the nonces which are not present.
+
+        @return: Whether each of the nonces was inserted.
+        @rtype: C{list} of C{bool}
+        """
+        added = []
+        for row in rows:
+            self.db_add_new_nonce(*row)
+            added.append(self.cur.rowcount == 1)
+        return added
+
+    def txn_cleanupNonces(self, cutoff, limit=None):
+        if limit is None:
+            self.db_clean_nonce(cutoff)
+        else:
+            self.db_clean_nonce_limit(cutoff, limit)
         return self.cur.rowcount
 
-    cleanupNonces = _inTxn(txn_cleanupNonces)
+    def cleanupNonces(self, batch_size=None):
+        """Remove expired nonces from the store.
+
+        @param batch_size: If given, the nonces are removed in slices of
+            at most this many rows, each in its own transaction, so the
+            nonces table is never locked for long.
+        @type batch_size: C{int} or C{NoneType}
+
+        @return: the number of nonces expired.
+        @rtype: C{int}
+        """
+        cutoff = int(time.time()) - nonce.SKEW
+        if batch_size is None:
+            return self._callInTransaction(self.txn_cleanupNonces, cutoff)
+
+        removed = 0
+        while True:
+            count = self._callInTransaction(self.txn_cleanupNonces, cutoff, batch_size)
+            removed += max(count, 0)  # -1 is undefined
+            if count < batch_size:
+                return removed
 
     def txn_cleanupAssociations(self):
         self.db_clean_assoc(int(time.time()))
@@ -339,8 +724,16 @@ class SQLiteStore(SQLStore):
 
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (?, ?, ?);'
 
+    add_nonces_sql = 'INSERT INTO %(nonces)s VALUES %(values)s;'
+    nonce_values_sql = '(?, ?, ?)'
+
+    add_new_nonce_sql = 'INSERT OR IGNORE INTO %(nonces)s VALUES (?, ?, ?);'
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < ?;'
 
+    clean_nonce_limit_sql = ('DELETE FROM %(nonces)s WHERE rowid IN '
+                             '(SELECT rowid FROM %(nonces)s WHERE timestamp < ? LIMIT ?);')
+
     def blobDecode(self, buf):
         return str(buf)
 
@@ -359,6 +752,11 @@ class SQLiteStore(SQLStore):
             else:
                 raise
 
+    def _isNonceConflict(self, error):
+        if isinstance(error, self.exceptions.OperationalError):
+            return bool(re.match('^columns .* are not unique$', error[0]))
+        return super(SQLiteStore, self)._isNonceConflict(error)
+
 
 class MySQLStore(SQLStore):
     """
@@ -418,8 +816,15 @@ class MySQLStore(SQLStore):
 
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
+    add_nonces_sql = 'INSERT INTO %(nonces)s VALUES %(values)s;'
+    nonce_values_sql = '(%%s, %%s, %%s)'
+
+    add_new_nonce_sql = 'INSERT IGNORE INTO %(nonces)s VALUES (%%s, %%s, %%s);'
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    clean_nonce_limit_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s LIMIT %%s;'
+
     def blobDecode(self, blob):
         if isinstance(blob, str):
             # Versions of MySQLdb >= 1.2.2
@@ -511,8 +916,17 @@ class PostgreSQLStore(SQLStore):
 
     add_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s);'
 
+    add_nonces_sql = 'INSERT INTO %(nonces)s VALUES %(values)s;'
+    nonce_values_sql = '(%%s, %%s, %%s)'
+
+    # Requires PostgreSQL 9.5
+    add_new_nonce_sql = 'INSERT INTO %(nonces)s VALUES (%%s, %%s, %%s) ON CONFLICT DO NOTHING;'
+
     clean_nonce_sql = 'DELETE FROM %(nonces)s WHERE timestamp < %%s;'
 
+    clean_nonce_limit_sql = ('DELETE FROM %(nonces)s WHERE ctid IN '
+                             '(SELECT ctid FROM %(nonces)s WHERE timestamp < %%s LIMIT %%s);')
+
     def blobEncode(self, blob):
         try:
             from psycopg2 import Binary
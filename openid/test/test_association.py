@@ -1,5 +1,7 @@
+import pickle
 import time
 import unittest
+from copy import deepcopy
 
 from openid import association
 from openid.consumer.consumer import DiffieHellmanSHA1ConsumerSession, PlainTextConsumerSession
@@ -100,6 +102,38 @@ class TestMac(unittest.TestCase):
         sig = assoc.sign(self.pairs)
         self.assertEqual(sig, expected)
 
+    def test_signMany(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        other_pairs = [('key1', 'value1')]
+        self.assertEqual(assoc.signMany([self.pairs, other_pairs]),
+                         [assoc.sign(self.pairs), assoc.sign(other_pairs)])
+        self.assertEqual(assoc.signMany([]), [])
+
+    def test_secretChanged(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        sig = assoc.sign(self.pairs)
+        assoc.secret = 'other_secret'
+        self.assertNotEqual(assoc.sign(self.pairs), sig)
+        assoc.secret = 'very_secret'
+        self.assertEqual(assoc.sign(self.pairs), sig)
+
+    def test_copy(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        sig = assoc.sign(self.pairs)
+        copied = deepcopy(assoc)
+        self.assertEqual(copied, assoc)
+        self.assertEqual(pickle.loads(pickle.dumps(assoc)), assoc)
+        self.assertEqual(copied.sign(self.pairs), sig)
+
+    def test_unknownType(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        assoc.assoc_type = 'HMAC-MD5'
+        self.assertRaises(ValueError, assoc.sign, self.pairs)
+
 
 class TestMessageSigning(unittest.TestCase):
     def setUp(self):
@@ -127,8 +161,43 @@ class TestMessageSigning(unittest.TestCase):
         self.assertEqual(signed.getArg(OPENID_NS, "signed"), "assoc_handle,identifier,mode,ns,signed")
         self.assertEqual(signed.getArg(BARE_NS, "xey"), "value")
 
+    def test_signUnchanged(self):
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        original = self.message.toPostArgs()
+        signed = assoc.signMessage(self.message)
+        self.assertEqual(self.message.toPostArgs(), original)
+        self.assertTrue(assoc.checkMessageSignature(signed))
+        self.assertEqual(signed.getArg(OPENID_NS, "sig"), assoc.getMessageSignature(signed))
+
+    def test_signUnicode(self):
+        self.message.setArg(OPENID2_NS, 'identifier', u'=\u010dlov\u011bk')
+        assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        signed = assoc.signMessage(self.message)
+        self.assertTrue(assoc.checkMessageSignature(signed))
+
 
 class TestCheckMessageSignature(unittest.TestCase):
+    def setUp(self):
+        self.assoc = association.Association.fromExpiresIn(
+            3600, '{sha1}', 'very_secret', "HMAC-SHA1")
+        self.messages = []
+        for i in range(3):
+            message = Message(OPENID2_NS)
+            message.updateArgs(OPENID2_NS, {'mode': 'id_res', 'identifier': '=example%d' % i})
+            self.messages.append(self.assoc.signMessage(message))
+
+    def test_checkMessageSignatures(self):
+        self.messages[1].setArg(OPENID2_NS, 'identifier', '=forged')
+        self.assertEqual(self.assoc.checkMessageSignatures(self.messages), [True, False, True])
+        self.assertEqual([self.assoc.checkMessageSignature(m) for m in self.messages], [True, False, True])
+        self.assertEqual(self.assoc.checkMessageSignatures([]), [])
+
+    def test_checkMessageSignaturesNoSig(self):
+        self.messages[2].delArg(OPENID2_NS, 'sig')
+        self.assertRaises(ValueError, self.assoc.checkMessageSignatures, self.messages)
+
     def test_aintGotSignedList(self):
         m = Message(OPENID2_NS)
         m.updateArgs(OPENID2_NS, {'mode': 'id_res',
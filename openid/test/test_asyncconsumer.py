@@ -0,0 +1,247 @@
+"""Test `openid.consumer.asyncconsumer` module."""
+import socket
+import unittest
+from collections import deque
+from urlparse import parse_qsl, urlparse
+
+from openid.consumer.asyncconsumer import AsyncConsumer, Fetch, Return, runCoroutine
+from openid.consumer.consumer import CANCEL, FAILURE, SUCCESS
+from openid.consumer.discover import DiscoveryFailure, setDiscoveryCache
+from openid.fetchers import AsyncHTTPFetcher, HTTPFetchingError, HTTPResponse
+from openid.server.server import Server
+from openid.store.discocache import MemoryDiscoveryCache
+from openid.store.memstore import MemoryStore
+
+IDENTITY_PAGE = '''<html><head>
+<link rel="openid2.provider" href="%(op_url)s">
+<link rel="openid2.local_id" href="%(identity)s">
+</head></html>'''
+
+
+class EventLoop(object):
+    """A minimal event loop running callbacks in order."""
+
+    def __init__(self):
+        self.calls = deque()
+
+    def callSoon(self, func, *args):
+        self.calls.append((func, args))
+
+    def run(self):
+        while self.calls:
+            func, args = self.calls.popleft()
+            func(*args)
+
+
+class StubOP(AsyncHTTPFetcher):
+    """Asynchronous fetcher which serves identity pages and an OpenID
+    provider from memory.  Every response is delivered by the event
+    loop, so the requests of concurrent logins interleave."""
+
+    op_url = 'http://op.example.com/openid'
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.server = Server(MemoryStore(), self.op_url)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def fetch(self, url, body, headers, callback, errback):
+        self.requests.append((url, body))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.loop.callSoon(self.respond, url, body, callback, errback)
+
+    def respond(self, url, body, callback, errback):
+        self.in_flight -= 1
+        if url.startswith('http://unreachable.example.com/'):
+            errback(socket.error('Connection refused'))
+        elif url == self.op_url:
+            request = self.server.decodeRequest(dict(parse_qsl(body)))
+            web_response = self.server.encodeResponse(self.server.handleRequest(request))
+            callback(HTTPResponse(url, web_response.code, web_response.headers, web_response.body))
+        else:
+            page = IDENTITY_PAGE % {'op_url': self.op_url, 'identity': url}
+            callback(HTTPResponse(url, 200, {'content-type': 'text/html'}, page))
+
+    def checkid(self, redirect_url):
+        """Approve the request the user is redirected with and return
+        the query of the redirect back to the relying party."""
+        request = self.server.decodeRequest(dict(parse_qsl(urlparse(redirect_url).query)))
+        web_response = self.server.encodeResponse(request.answer(True))
+        return dict(parse_qsl(urlparse(web_response.headers['location']).query))
+
+    def countRequests(self, mode):
+        return len([url for url, body in self.requests if body and 'openid.mode=%s' % mode in body])
+
+
+class TestRunCoroutine(unittest.TestCase):
+    """Test `runCoroutine` function."""
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.fetcher = StubOP(self.loop)
+        self.results = []
+        self.errors = []
+
+    def run_coroutine(self, coroutine):
+        runCoroutine(coroutine, self.fetcher, self.results.append, self.errors.append)
+        self.loop.run()
+
+    def test_return(self):
+        def coroutine():
+            raise Return('value')
+            yield
+        self.run_coroutine(coroutine())
+        self.assertEqual(self.results, ['value'])
+        self.assertEqual(self.errors, [])
+
+    def test_no_return(self):
+        def coroutine():
+            yield Fetch('http://example.com/')
+        self.run_coroutine(coroutine())
+        self.assertEqual(self.results, [None])
+
+    def test_nested(self):
+        def inner(url):
+            response = yield Fetch(url)
+            raise Return(response.final_url)
+
+        def outer():
+            first = yield inner('http://example.com/first')
+            second = yield inner('http://example.com/second')
+            raise Return((first, second))
+
+        self.run_coroutine(outer())
+        self.assertEqual(self.results, [('http://example.com/first', 'http://example.com/second')])
+
+    def test_fetch_error(self):
+        def coroutine():
+            try:
+                yield Fetch('http://unreachable.example.com/')
+            except HTTPFetchingError as why:
+                raise Return(why.why)
+
+        self.run_coroutine(coroutine())
+        self.assertIsInstance(self.results[0], socket.error)
+
+    def test_error(self):
+        def inner():
+            yield Fetch('http://example.com/')
+            raise ValueError('Oops')
+
+        def outer():
+            yield inner()
+
+        self.run_coroutine(outer())
+        self.assertEqual(self.results, [])
+        self.assertIsInstance(self.errors[0], ValueError)
+
+    def test_bad_yield(self):
+        def coroutine():
+            yield 'http://example.com/'
+        self.run_coroutine(coroutine())
+        self.assertIsInstance(self.errors[0], TypeError)
+
+
+class TestAsyncConsumer(unittest.TestCase):
+    """Test `AsyncConsumer` against a stub OP."""
+
+    return_to = 'http://rp.example.com/return'
+    realm = 'http://rp.example.com/'
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.op = StubOP(self.loop)
+        self.store = MemoryStore()
+
+    def run_coroutine(self, coroutine):
+        results = []
+        errors = []
+        runCoroutine(coroutine, self.op, results.append, errors.append)
+        self.loop.run()
+        if errors:
+            raise errors[0]
+        return results[0]
+
+    def login(self, identity, store=None):
+        """Coroutine doing a complete login with a fresh consumer."""
+        session = {}
+        consumer = AsyncConsumer(session, store)
+        auth_request = yield consumer.begin(identity)
+        query = self.op.checkid(auth_request.redirectURL(self.realm, self.return_to))
+        response = yield consumer.complete(query, self.return_to)
+        raise Return(response)
+
+    def test_login(self):
+        response = self.run_coroutine(self.login('http://example.com/alice', self.store))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(response.identity_url, 'http://example.com/alice')
+        self.assertEqual(self.op.countRequests('associate'), 1)
+        self.assertEqual(self.op.countRequests('check_authentication'), 0)
+
+    def test_login_stateless(self):
+        response = self.run_coroutine(self.login('http://example.com/alice'))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(self.op.countRequests('associate'), 0)
+        self.assertEqual(self.op.countRequests('check_authentication'), 1)
+
+    def test_concurrent_logins(self):
+        results = []
+        errors = []
+        for i in range(20):
+            runCoroutine(self.login('http://example.com/user%d' % i, self.store), self.op, results.append,
+                         errors.append)
+        self.loop.run()
+
+        self.assertEqual(errors, [])
+        self.assertEqual([r.status for r in results], [SUCCESS] * 20)
+        self.assertEqual(sorted(r.identity_url for r in results),
+                         sorted('http://example.com/user%d' % i for i in range(20)))
+        # All of the logins were waiting for their discovery at once.
+        self.assertEqual(self.op.max_in_flight, 20)
+
+    def test_complete_without_session(self):
+        # Discovery is performed again to verify the assertion.
+        consumer = AsyncConsumer({}, self.store)
+        auth_request = self.run_coroutine(consumer.begin('http://example.com/alice'))
+        query = self.op.checkid(auth_request.redirectURL(self.realm, self.return_to))
+
+        del self.op.requests[:]
+        consumer = AsyncConsumer({}, self.store)
+        response = self.run_coroutine(consumer.complete(query, self.return_to))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(self.op.requests, [('http://example.com/alice', None)])
+
+    def test_complete_cancel(self):
+        consumer = AsyncConsumer({}, self.store)
+        response = self.run_coroutine(consumer.complete({'openid.mode': 'cancel'}, self.return_to))
+        self.assertEqual(response.status, CANCEL)
+        self.assertEqual(self.op.requests, [])
+
+    def test_complete_bad_signature(self):
+        session = {}
+        consumer = AsyncConsumer(session, self.store)
+        auth_request = self.run_coroutine(consumer.begin('http://example.com/alice'))
+        query = self.op.checkid(auth_request.redirectURL(self.realm, self.return_to))
+        query['openid.sig'] = 'AAAA' + query['openid.sig'][4:]
+
+        response = self.run_coroutine(consumer.complete(query, self.return_to))
+        self.assertEqual(response.status, FAILURE)
+        self.assertEqual(response.message, 'Bad signature')
+
+    def test_begin_unreachable(self):
+        consumer = AsyncConsumer({}, self.store)
+        with self.assertRaisesRegexp(DiscoveryFailure, 'Error fetching XRDS document'):
+            self.run_coroutine(consumer.begin('http://unreachable.example.com/alice'))
+
+    def test_discovery_cache(self):
+        setDiscoveryCache(MemoryDiscoveryCache())
+        self.addCleanup(setDiscoveryCache, None)
+
+        self.run_coroutine(self.login('http://example.com/alice', self.store))
+        del self.op.requests[:]
+        response = self.run_coroutine(self.login('http://example.com/alice', self.store))
+        self.assertEqual(response.status, SUCCESS)
+        self.assertEqual(self.op.requests, [])
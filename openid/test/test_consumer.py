@@ -1,15 +1,21 @@
+import base64
+import os
+import threading
 import time
 import unittest
 import urlparse
 
+from mock import patch
 from testfixtures import LogCapture, StringComparison
 
 from openid import association, cryptutil, fetchers, kvform, oidutil
-from openid.consumer.consumer import (CANCEL, FAILURE, SETUP_NEEDED, SUCCESS, AuthRequest, CancelResponse, Consumer,
-                                      DiffieHellmanSHA1ConsumerSession, DiffieHellmanSHA256ConsumerSession,
-                                      FailureResponse, GenericConsumer, PlainTextConsumerSession, ProtocolError,
-                                      ServerError, SetupNeededError, SetupNeededResponse, SuccessResponse,
-                                      _httpResponseToMessage)
+from openid.consumer import consumer as consumer_module
+from openid.consumer.consumer import (CANCEL, FAILURE, SETUP_NEEDED, SUCCESS, AssociationRefresher, AuthRequest,
+                                      CancelResponse, Consumer, DiffieHellmanSHA1ConsumerSession,
+                                      DiffieHellmanSHA256ConsumerSession, FailureResponse, GenericConsumer,
+                                      PlainTextConsumerSession, ProtocolError, ServerError, SetupNeededError,
+                                      SetupNeededResponse, SuccessResponse, _httpResponseToMessage,
+                                      getAssociationRefresher, setAssociationRefresher)
 from openid.consumer.discover import OPENID_1_1_TYPE, OPENID_2_0_TYPE, OpenIDServiceEndpoint
 from openid.dh import DiffieHellman
 from openid.extension import Extension
@@ -1270,6 +1276,370 @@ class TestFetchAssoc(unittest.TestCase):
         self.assertFalse(self.consumer._checkAuth(msg, 'some://url'))
 
 
+class RenewingConsumer(GenericConsumer):
+    """Makes associations without requests."""
+
+    fail = set()
+    negotiated = []
+
+    def _negotiateAssociation(self, endpoint):
+        self.negotiated.append((endpoint.server_url, self.negotiator))
+        if endpoint.server_url in self.fail:
+            return None
+        return association.Association.fromExpiresIn(3600, 'handle%d' % len(self.negotiated), 'secret', 'HMAC-SHA1')
+
+
+class TestEndpointToken(unittest.TestCase):
+    """Test the endpoint tokens in the return_to URLs."""
+
+    def setUp(self):
+        self.consumer = GenericConsumer(None)
+        self.consumer.endpoint_token_key = 'k' * 32
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.claimed_id = 'http://user.example/'
+        self.endpoint.local_id = 'http://user.example/local'
+        self.endpoint.server_url = 'http://server.example/'
+        self.endpoint.type_uris = [OPENID_2_0_TYPE]
+        self.endpoint.used_yadis = True
+
+    def assertSameEndpoint(self, endpoint):
+        self.assertIsNotNone(endpoint)
+        for name in ('claimed_id', 'local_id', 'server_url', 'type_uris', 'canonicalID', 'display_identifier',
+                     'used_yadis'):
+            self.assertEqual(getattr(endpoint, name), getattr(self.endpoint, name), name)
+
+    def test_roundTrip(self):
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        self.assertSameEndpoint(self.consumer._parseEndpointToken(token))
+
+    def test_invalid(self):
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        payload, tag = token.split('.')
+        forged = base64.urlsafe_b64encode(base64.urlsafe_b64decode(payload).replace('user', 'evil')) + '.' + tag
+        other = GenericConsumer(None)
+        other.endpoint_token_key = 'o' * 32
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._parseEndpointToken(forged))
+            self.assertIsNone(other._parseEndpointToken(token))
+            self.assertIsNone(self.consumer._parseEndpointToken('garbage'))
+            self.assertIsNone(self.consumer._parseEndpointToken(u'\u010d.\u010d'))
+        self.assertEqual(len(logbook.records), 4)
+
+    def test_otherEncoding(self):
+        payload = '%d:0[]' % (time.time() + 60)
+        tag = cryptutil.hmacSha256(self.consumer.endpoint_token_key, payload)[:16]
+        token = base64.urlsafe_b64encode(payload) + '.' + base64.urlsafe_b64encode(tag)
+        with LogCapture() as logbook:
+            self.assertIsNone(self.consumer._parseEndpointToken(token))
+        logbook.check(('openid.consumer.consumer', 'WARNING', 'Malformed endpoint token %r' % token))
+
+    def test_expired(self):
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        with patch('time.time', return_value=time.time() + self.consumer.endpoint_token_lifetime + 10):
+            with LogCapture():
+                self.assertIsNone(self.consumer._parseEndpointToken(token))
+
+    def test_begin(self):
+        request = self.consumer.begin(self.endpoint)
+        token = request.return_to_args[self.consumer.endpoint_token_arg_name]
+        self.assertSameEndpoint(self.consumer._parseEndpointToken(token))
+
+        self.consumer.endpoint_token_key = None
+        request = self.consumer.begin(self.endpoint)
+        self.assertNotIn(self.consumer.endpoint_token_arg_name, request.return_to_args)
+
+    def test_notUTF8(self):
+        self.endpoint.claimed_id = 'http://user.example/\xe9'
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        self.assertSameEndpoint(self.consumer._parseEndpointToken(token))
+
+    def test_beginWithoutToken(self):
+        self.endpoint.claimed_id = 42
+        with LogCapture() as logbook:
+            request = self.consumer.begin(self.endpoint)
+        self.assertNotIn(self.consumer.endpoint_token_arg_name, request.return_to_args)
+        logbook.check(('openid.consumer.consumer', 'WARNING', StringComparison('Cannot make an endpoint token .*')))
+
+    def test_complete(self):
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        message = Message.fromPostArgs({'openid.mode': 'cancel', 'endpoint_token': token})
+        response = self.consumer.complete(message, None, None)
+        self.assertEqual(response.status, CANCEL)
+        self.assertSameEndpoint(response.endpoint)
+
+        # The endpoint from the session is preferred.
+        session_endpoint = OpenIDServiceEndpoint()
+        response = self.consumer.complete(message, session_endpoint, None)
+        self.assertIs(response.endpoint, session_endpoint)
+
+    def test_completeIdRes(self):
+        token = self.consumer._makeEndpointToken(self.endpoint)
+        message = Message.fromPostArgs({'openid.ns': OPENID2_NS, 'openid.mode': 'id_res', 'endpoint_token': token})
+        with patch.object(self.consumer, '_doIdRes', return_value='response') as do_id_res:
+            self.assertEqual(self.consumer.complete(message, None, 'http://rp.example/'), 'response')
+        self.assertSameEndpoint(do_id_res.call_args[0][1])
+
+    def test_setEndpointTokenKey(self):
+        consumer = Consumer({}, None)
+        consumer.setEndpointTokenKey('k' * 32)
+        self.assertEqual(consumer.consumer.endpoint_token_key, 'k' * 32)
+
+
+class TestCoalescedNegotiation(unittest.TestCase):
+    """Test that concurrent consumers negotiate an association once."""
+
+    def setUp(self):
+        RenewingConsumer.fail = set()
+        RenewingConsumer.negotiated = []
+        self.store = memstore.MemoryStore()
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.server_url = 'http://a.example/'
+        self.started = []
+        self.release = threading.Event()
+
+    def slowConsumer(self):
+        test = self
+
+        class SlowConsumer(RenewingConsumer):
+            def _negotiateAssociation(self, endpoint):
+                test.started.append(self)
+                test.release.wait(5)
+                return RenewingConsumer._negotiateAssociation(self, endpoint)
+
+        return SlowConsumer(self.store)
+
+    def getAssociations(self, count, consumer_factory, negotiations=1):
+        """Get associations in count threads, letting the negotiations
+        finish once the given number of them started."""
+        results = []
+
+        def worker():
+            results.append(consumer_factory()._getAssociation(self.endpoint))
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while len(self.started) < negotiations and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesced(self):
+        results = self.getAssociations(5, self.slowConsumer)
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+        self.assertEqual(len(set(assoc.handle for assoc in results)), 1)
+        self.assertEqual(self.store.getAssociation(self.endpoint.server_url), results[0])
+        self.assertEqual(consumer_module._negotiations, {})
+
+    def test_failure(self):
+        RenewingConsumer.fail.add(self.endpoint.server_url)
+        results = self.getAssociations(3, self.slowConsumer)
+        self.assertEqual(results, [None] * 3)
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+
+    def test_timeout(self):
+        def factory():
+            consumer = self.slowConsumer()
+            consumer.association_wait = 0
+            return consumer
+
+        with LogCapture() as logbook:
+            results = self.getAssociations(2, factory, negotiations=2)
+        self.assertEqual(len(RenewingConsumer.negotiated), 2)
+        self.assertEqual(len(results), 2)
+        logbook.check(('openid.consumer.consumer', 'WARNING', 'Timed out waiting for the association with %s' %
+                       self.endpoint.server_url))
+
+    def test_storedMeanwhile(self):
+        assoc = association.Association.fromExpiresIn(3600, 'stored', 'secret', 'HMAC-SHA1')
+        consumer = RenewingConsumer(self.store)
+        with patch.object(self.store, 'getAssociation', side_effect=[None, assoc]):
+            self.assertEqual(consumer._getAssociation(self.endpoint), assoc)
+        self.assertEqual(RenewingConsumer.negotiated, [])
+
+    def takeTurn(self, period):
+        # Another process takes the turns for this period and the next one.
+        now = int(time.time())
+        for timestamp in (now - now % period, now - now % period + period):
+            self.assertTrue(self.store.useNonce('associate:' + self.endpoint.server_url, timestamp, 'turn'))
+
+    def test_storeLock(self):
+        consumer = RenewingConsumer(self.store)
+        consumer.association_store_lock = True
+        consumer.association_wait = 5
+        self.assertIsNotNone(consumer._getAssociation(self.endpoint))
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+
+    def test_storeLockWait(self):
+        consumer = RenewingConsumer(self.store)
+        consumer.association_store_lock = True
+        consumer.association_wait = 5
+        self.takeTurn(5)
+        # The other process stores the association.
+        assoc = association.Association.fromExpiresIn(3600, 'other', 'secret', 'HMAC-SHA1')
+        timer = threading.Timer(0.2, self.store.storeAssociation, (self.endpoint.server_url, assoc))
+        timer.start()
+        self.assertEqual(consumer._getAssociation(self.endpoint), assoc)
+        timer.join()
+        self.assertEqual(RenewingConsumer.negotiated, [])
+
+    def test_storeLockTimeout(self):
+        consumer = RenewingConsumer(self.store)
+        consumer.association_store_lock = True
+        consumer.association_wait = 0.2
+        self.takeTurn(1)
+        with LogCapture() as logbook:
+            self.assertIsNotNone(consumer._getAssociation(self.endpoint))
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+        self.assertEqual(len(logbook.records), 1)
+
+
+class TestAssociationRefresher(unittest.TestCase):
+    """Test `AssociationRefresher` class."""
+
+    def setUp(self):
+        RenewingConsumer.fail = set()
+        RenewingConsumer.negotiated = []
+        self.store = memstore.MemoryStore()
+        self.consumer = RenewingConsumer(self.store)
+        self.refresher = AssociationRefresher(servers=2, ahead=600, jitter=0, interval=3600, concurrency=2)
+        self.refresher.consumer_class = RenewingConsumer
+
+    def tearDown(self):
+        setAssociationRefresher(None)
+        self.refresher.stop()
+
+    def endpoint(self, server_url):
+        endpoint = OpenIDServiceEndpoint()
+        endpoint.server_url = server_url
+        return endpoint
+
+    def use(self, server_url, count=1):
+        for _ in range(count):
+            self.refresher.noteUse(self.consumer, self.endpoint(server_url))
+
+    def test_refresh(self):
+        self.use('http://a.example/', 3)
+        self.use('http://b.example/', 2)
+        self.use('http://c.example/')
+        self.assertEqual(self.refresher.refresh(), 2)
+        self.assertEqual(sorted(url for url, _ in RenewingConsumer.negotiated),
+                         ['http://a.example/', 'http://b.example/'])
+        self.assertIsNotNone(self.store.getAssociation('http://a.example/'))
+        self.assertIsNone(self.store.getAssociation('http://c.example/'))
+        self.assertEqual(RenewingConsumer.negotiated[0][1], self.consumer.negotiator)
+        # c.example was used once, it is not tracked anymore.
+        self.assertEqual(self.refresher.getStats(), {'servers': 2, 'renewals': 2, 'failures': 0})
+
+        # The associations are fresh.
+        self.assertEqual(self.refresher.refresh(), 0)
+        self.assertEqual(self.refresher.getStats()['servers'], 0)
+
+        # Only a.example is still used.
+        self.use('http://a.example/')
+        with patch('time.time', return_value=time.time() + 3100):
+            self.assertEqual(self.refresher.refresh(), 1)
+        self.assertEqual(RenewingConsumer.negotiated[-1][0], 'http://a.example/')
+
+    def test_failure(self):
+        RenewingConsumer.fail.add('http://a.example/')
+        self.use('http://a.example/', 8)
+        with LogCapture():
+            self.assertEqual(self.refresher.refresh(), 0)
+            self.assertEqual(self.refresher.refresh(), 0)
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+        self.assertEqual(self.refresher.getStats()['failures'], 1)
+
+        RenewingConsumer.fail = set()
+        with patch('time.time', return_value=time.time() + 610):
+            self.assertEqual(self.refresher.refresh(), 1)
+
+    def test_concurrency(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        class SlowConsumer(RenewingConsumer):
+            def _negotiateAssociation(self, endpoint):
+                with lock:
+                    running.append(endpoint)
+                    peak.append(len(running))
+                time.sleep(0.01)
+                with lock:
+                    running.remove(endpoint)
+                return RenewingConsumer._negotiateAssociation(self, endpoint)
+
+        self.refresher.consumer_class = SlowConsumer
+        self.refresher.servers = 10
+        for i in range(6):
+            self.use('http://%d.example/' % i, 2)
+        self.assertEqual(self.refresher.refresh(), 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_shortLifetime(self):
+        # Associations living less than `ahead` are renewed when half
+        # of their lifetime is left.
+        assoc = association.Association.fromExpiresIn(300, 'short', 'secret', 'HMAC-SHA1')
+        self.store.storeAssociation('http://a.example/', assoc)
+        self.use('http://a.example/', 8)
+        self.assertEqual(self.refresher.refresh(), 0)
+        with patch('time.time', return_value=time.time() + 160):
+            self.assertEqual(self.refresher.refresh(), 1)
+        self.assertEqual(len(RenewingConsumer.negotiated), 1)
+
+    def test_coalesced(self):
+        # A renewal waits for the association being negotiated for a
+        # consumer.
+        self.use('http://a.example/', 2)
+        negotiation = consumer_module._Negotiation()
+        negotiation.assoc = association.Association.fromExpiresIn(3600, 'begin', 'secret', 'HMAC-SHA1')
+        negotiation.done.set()
+        key = (id(self.store), 'http://a.example/', tuple(self.consumer.negotiator.allowed_types))
+        with patch.dict(consumer_module._negotiations, {key: negotiation}):
+            self.assertEqual(self.refresher.refresh(), 1)
+        self.assertEqual(RenewingConsumer.negotiated, [])
+
+    def test_stop(self):
+        self.refresher.interval = 0.01
+        self.use('http://a.example/')
+        thread = self.refresher._thread
+        self.assertTrue(thread.is_alive())
+        setAssociationRefresher(self.refresher)
+        setAssociationRefresher(None)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.use('http://a.example/')
+        self.assertIsNone(self.refresher._thread)
+
+    def test_fork(self):
+        self.use('http://a.example/', 2)
+        # Another thread held the locks when the process forked.
+        locks = [self.refresher._lock, self.refresher._refreshing]
+        for lock in locks:
+            lock.acquire()
+            self.addCleanup(lock.release)
+        # Stop the thread of the parent process.
+        self.addCleanup(self.refresher._stopped.set)
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            with patch.object(AssociationRefresher, '_startThread') as start_thread:
+                self.use('http://a.example/')
+            self.assertEqual(self.refresher.refresh(), 1)
+        self.assertIsNone(self.refresher._thread)
+        self.assertEqual(start_thread.call_count, 1)
+
+    def test_begin(self):
+        setAssociationRefresher(self.refresher)
+        self.assertEqual(getAssociationRefresher(), self.refresher)
+        with patch.object(AssociationRefresher, '_startThread') as start_thread:
+            self.consumer.begin(self.endpoint('http://a.example/'))
+        self.assertEqual(start_thread.call_count, 1)
+        self.assertEqual(self.refresher.getStats()['servers'], 1)
+
+
 class TestSuccessResponse(unittest.TestCase):
     def setUp(self):
         self.endpoint = OpenIDServiceEndpoint()
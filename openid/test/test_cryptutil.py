@@ -4,7 +4,10 @@ import random
 import sys
 import unittest
 
+from mock import patch
+
 from openid import cryptutil
+from openid.dh import DiffieHellman
 
 # Most of the purpose of this test is to make sure that cryptutil can
 # find a good source of randomness on this machine.
@@ -91,3 +94,120 @@ class TestBase64ToLong(unittest.TestCase):
                 assert long(parts[1]) == cryptutil.base64ToLong(parts[0])
         finally:
             f.close()
+
+
+class TestBackends(unittest.TestCase):
+    """Test the implementations of the primitives."""
+
+    def test_selected(self):
+        self.assertEqual(cryptutil.const_eq, cryptutil.getBackends('const_eq')[0][1])
+        self.assertEqual(cryptutil.strxor, cryptutil.getBackends('strxor')[0][1])
+        self.assertEqual([name for name, function in cryptutil.getBackends('strxor')], ['int', 'python'])
+
+    def test_const_eq(self):
+        cases = [
+            ('', '', True),
+            ('abc', 'abc', True),
+            (u'abc', 'abc', True),
+            ('abc', 'abd', False),
+            ('abc', 'ab', False),
+            (u'\u010d', u'\u010d', True),
+        ]
+        for name, const_eq in cryptutil.getBackends('const_eq'):
+            for s1, s2, expected in cases:
+                self.assertEqual(const_eq(s1, s2), expected, (name, s1, s2))
+
+    def test_strxor(self):
+        cases = [
+            ('', ''),
+            ('\x00', '\xff'),
+            ('\x00\x01', '\x00\x01'),
+            (cryptutil.getBytes(20), cryptutil.getBytes(20)),
+            (cryptutil.getBytes(32), cryptutil.getBytes(32)),
+        ]
+        for name, strxor in cryptutil.getBackends('strxor'):
+            for x, y in cases:
+                self.assertEqual(strxor(x, y), ''.join(chr(ord(a) ^ ord(b)) for a, b in zip(x, y)), name)
+            self.assertRaises(ValueError, strxor, 'ab', 'a')
+
+    def test_randomString(self):
+        for name, randomString in cryptutil.getBackends('randomString'):
+            self.assertEqual(len(randomString(20)), 20)
+            for chrs in ('ab', 'abcdefghijklmnopqrstuvwxyz0123456789', ''.join(map(chr, range(256))) * 2):
+                s = randomString(100, chrs)
+                self.assertEqual(len(s), 100)
+                self.assertTrue(set(s) <= set(chrs))
+            self.assertEqual(randomString(0, 'ab'), '')
+
+    def test_randomStringSkipsBias(self):
+        # 255 would make 'a' more likely than 'b' and 'c'.
+        with patch.object(cryptutil, 'getBytes', side_effect=['\xff\x00\xff\x04', '\x05']):
+            self.assertEqual(cryptutil.getBackends('randomString')[0][1](3, 'abc'), 'abc')
+
+    def test_powmod(self):
+        modulus = DiffieHellman.DEFAULT_MOD
+        generator = DiffieHellman.DEFAULT_GEN
+        exponents = [0, 1, 2, 63, 64, 2 ** 64 + 1, modulus - 2, modulus ** 2 + 7, cryptutil.randrange(modulus)]
+        for name, powmod in cryptutil.getBackends('powmod'):
+            for exponent in exponents:
+                self.assertEqual(powmod(generator, exponent, modulus), pow(generator, exponent, modulus))
+                self.assertEqual(powmod(3, exponent, modulus), pow(3, exponent, modulus))
+
+    def test_precomputeBase(self):
+        cryptutil.precomputeBase(5, 1009)
+        self.assertEqual([cryptutil.powmod(5, e, 1009) for e in range(2000)], [pow(5, e, 1009) for e in range(2000)])
+
+
+class TestBufferedRandom(unittest.TestCase):
+    """Test `BufferedRandom` class."""
+
+    def setUp(self):
+        self.pool = cryptutil.BufferedRandom(chunk_size=16)
+
+    def tearDown(self):
+        cryptutil.setRandomPool(None)
+
+    def test_getBytes(self):
+        with patch.object(cryptutil, '_getSystemBytes', side_effect=['a' * 10 + 'b' * 6, 'c' * 16, 'd' * 20]) as source:
+            self.assertEqual(self.pool.getBytes(10), 'a' * 10)
+            self.assertEqual(self.pool.getBytes(6), 'b' * 6)
+            self.assertEqual(self.pool.getBytes(4), 'c' * 4)
+            # The rest of the buffer is too short.
+            self.assertEqual(self.pool.getBytes(20), 'd' * 20)
+            self.assertEqual(self.pool.getBytes(12), 'c' * 12)
+        self.assertEqual([c[0] for c in source.call_args_list], [(16, ), (16, ), (20, )])
+        self.assertEqual(self.pool.getStats(), {'chunk_size': 16, 'available': 0, 'requests': 5, 'refills': 2})
+
+    def test_fork(self):
+        with patch.object(cryptutil, '_getSystemBytes', side_effect=['a' * 16, 'b' * 16]):
+            self.assertEqual(self.pool.getBytes(4), 'a' * 4)
+            with patch('os.getpid', return_value=os.getpid() + 1):
+                self.assertEqual(self.pool.getBytes(4), 'b' * 4)
+        self.assertEqual(self.pool.getStats()['refills'], 2)
+
+    def test_forkWhileLocked(self):
+        # Another thread held the lock when the process forked.
+        lock = self.pool._lock
+        lock.acquire()
+        self.addCleanup(lock.release)
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(len(self.pool.getBytes(4)), 4)
+        self.assertIsNot(self.pool._lock, lock)
+
+    def test_randrange(self):
+        for _ in range(100):
+            self.assertIn(self.pool.randrange(10), range(10))
+            self.assertIn(self.pool.randrange(5, 15, 5), (5, 10))
+        a = self.pool.randrange(2 ** 128)
+        b = self.pool.randrange(2 ** 128)
+        self.assertIsInstance(a, long)
+        self.assertNotEqual(a, b)
+        self.assertGreater(self.pool.getStats()['requests'], 200)
+
+    def test_setRandomPool(self):
+        cryptutil.setRandomPool(self.pool)
+        self.assertEqual(cryptutil.getRandomPool(), self.pool)
+        self.assertEqual(len(cryptutil.getBytes(8)), 8)
+        self.assertEqual(len(cryptutil.randomString(6, 'abc')), 6)
+        self.assertLess(cryptutil.randrange(1, 10), 10)
+        self.assertGreaterEqual(self.pool.getStats()['requests'], 3)
@@ -1,8 +1,11 @@
 """Test `openid.dh` module."""
 import os.path
+import time
 import unittest
 
-from openid.dh import DiffieHellman, strxor
+from mock import patch
+
+from openid.dh import DiffieHellman, DiffieHellmanKeyPool, setKeyPool, strxor
 
 
 class TestStrXor(unittest.TestCase):
@@ -70,3 +73,80 @@ class TestDiffieHellman(unittest.TestCase):
                 assert dh.public == long(parts[1])
         finally:
             f.close()
+
+
+class TestDiffieHellmanKeyPool(unittest.TestCase):
+    """Test `DiffieHellmanKeyPool` class."""
+
+    def setUp(self):
+        self.pool = DiffieHellmanKeyPool(size=4, low_water=2)
+        setKeyPool(self.pool)
+        self.addCleanup(setKeyPool, None)
+
+    def test_keypairs(self):
+        self.pool.fill()
+        keypairs = [self.pool.take() for _ in range(4)]
+        self.assertEqual(len(set(keypairs)), 4)
+        for private, public in keypairs:
+            self.assertEqual(pow(DiffieHellman.DEFAULT_GEN, private, DiffieHellman.DEFAULT_MOD), public)
+
+    def test_from_defaults(self):
+        self.pool.fill()
+        with patch('openid.dh.pow', create=True) as mock_pow:
+            dh = DiffieHellman.fromDefaults()
+        self.assertFalse(mock_pow.called)
+        self.assertTrue(dh.usingDefaultValues())
+        self.assertEqual(pow(dh.generator, dh.private, dh.modulus), dh.public)
+        self.assertEqual(self.pool.getStats()['hits'], 1)
+
+        other = DiffieHellman.fromDefaults()
+        self.assertEqual(dh.getSharedSecret(other.public), other.getSharedSecret(dh.public))
+
+    def test_miss(self):
+        with patch.object(self.pool, '_startThread'):
+            self.assertIsNone(self.pool.take())
+        dh = DiffieHellman.fromDefaults()
+        self.assertEqual(pow(dh.generator, dh.private, dh.modulus), dh.public)
+        self.assertEqual(self.pool.getStats()['misses'], 2)
+
+    def test_refill(self):
+        self.pool.fill()
+        self.pool.take()
+        self.pool.take()
+        self.assertIsNone(self.pool._thread)
+        self.pool.take()
+        # Below the low water mark, the pool is refilled in the background.
+        self.assertIsNotNone(self.pool._thread)
+        deadline = time.time() + 10
+        while self.pool.getStats()['available'] < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.pool.getStats(),
+                         {'size': 4, 'available': 4, 'hits': 3, 'misses': 0, 'hit_rate': 1.0})
+
+    def test_hit_rate(self):
+        self.assertEqual(self.pool.getStats()['hit_rate'], 0.0)
+        self.pool.fill()
+        with patch.object(self.pool, '_startThread'):
+            for _ in range(5):
+                self.pool.take()
+        self.assertEqual(self.pool.getStats()['hit_rate'], 0.8)
+
+    def test_fork(self):
+        self.pool.fill()
+        with patch('os.getpid', return_value=-1):
+            with patch.object(self.pool, '_startThread'):
+                # The child doesn't get the key pairs of its parent.
+                self.assertIsNone(self.pool.take())
+                self.assertEqual(self.pool.getStats()['available'], 0)
+
+    def test_forkWhileLocked(self):
+        self.pool.fill()
+        # The refill thread held the lock when the process forked.
+        lock = self.pool._lock
+        lock.acquire()
+        self.addCleanup(lock.release)
+        with patch('os.getpid', return_value=-1):
+            self.assertEqual(self.pool.getStats()['available'], 0)
+            self.pool.fill()
+            self.assertIsNotNone(self.pool.take())
+        self.assertIsNot(self.pool._lock, lock)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Test `openid.store.discocache` module."""
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch
+from testfixtures import LogCapture
+
+from openid.store.discocache import DiscoveryCache, FileDiscoveryCache, MemoryDiscoveryCache
+
+
+class TestDiscoveryCacheTTL(unittest.TestCase):
+    """Test `DiscoveryCache.getTTL` method."""
+
+    def test_default(self):
+        self.assertEqual(DiscoveryCache().getTTL(), DiscoveryCache.default_ttl)
+
+    def test_hint(self):
+        self.assertEqual(DiscoveryCache().getTTL(120), 120)
+
+    def test_max(self):
+        self.assertEqual(DiscoveryCache().getTTL(DiscoveryCache.max_ttl * 2), DiscoveryCache.max_ttl)
+
+    def test_negative(self):
+        self.assertEqual(DiscoveryCache().getTTL(-5), 0)
+
+
+class CacheTestMixin(object):
+    """Tests common to all discovery cache implementations."""
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.get('http://example.com/'))
+
+    def test_set_get(self):
+        self.cache.set('http://example.com/', ('success', 'http://example.com/', []), 60)
+        self.assertEqual(self.cache.get('http://example.com/'), ('success', 'http://example.com/', []))
+
+    def test_unicode_key(self):
+        self.cache.set(u'=žluťoučk\xfd', 'value', 60)
+        self.assertEqual(self.cache.get(u'=žluťoučk\xfd'), 'value')
+
+    def test_no_ttl(self):
+        self.cache.set('http://example.com/', 'value', 0)
+        self.assertIsNone(self.cache.get('http://example.com/'))
+
+    def test_expired(self):
+        self.cache.set('http://example.com/', 'value', 60)
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('http://example.com/'))
+        self.assertIsNone(self.cache.get('http://example.com/'))
+
+    def test_replace(self):
+        self.cache.set('http://example.com/', 'value', 60)
+        self.cache.set('http://example.com/', 'other', 60)
+        self.assertEqual(self.cache.get('http://example.com/'), 'other')
+
+    def test_remove(self):
+        self.cache.set('http://example.com/', 'value', 60)
+        self.assertTrue(self.cache.remove('http://example.com/'))
+        self.assertFalse(self.cache.remove('http://example.com/'))
+        self.assertIsNone(self.cache.get('http://example.com/'))
+
+    def test_cleanup(self):
+        self.cache.set('http://example.com/short', 'value', 10)
+        self.cache.set('http://example.com/long', 'value', 100)
+        with patch('time.time', return_value=time.time() + 50):
+            self.assertEqual(self.cache.cleanup(), 1)
+        self.assertIsNone(self.cache.get('http://example.com/short'))
+        self.assertEqual(self.cache.get('http://example.com/long'), 'value')
+
+
+class TestMemoryDiscoveryCache(CacheTestMixin, unittest.TestCase):
+    """Test `MemoryDiscoveryCache` class."""
+
+    def setUp(self):
+        self.cache = MemoryDiscoveryCache(max_entries=3)
+
+    def test_lru(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, key, 60)
+        # Use 'a', so 'b' is the least recently used.
+        self.cache.get('a')
+        self.cache.set('d', 'd', 60)
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(self.cache.get('c'), 'c')
+        self.assertEqual(self.cache.get('d'), 'd')
+
+    def test_ttl_overrides(self):
+        cache = MemoryDiscoveryCache(default_ttl=10, failure_ttl=5)
+        self.assertEqual(cache.getTTL(), 10)
+        self.assertEqual(cache.failure_ttl, 5)
+
+
+class TestFileDiscoveryCache(CacheTestMixin, unittest.TestCase):
+    """Test `FileDiscoveryCache` class."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = FileDiscoveryCache(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_shared(self):
+        self.cache.set('http://example.com/', 'value', 60)
+        other = FileDiscoveryCache(self.temp_dir)
+        self.assertEqual(other.get('http://example.com/'), 'value')
+
+    def test_corrupted(self):
+        with open(self.cache.getFilename('http://example.com/'), 'wb') as entry_file:
+            entry_file.write('garbage')
+        with LogCapture():
+            self.assertIsNone(self.cache.get('http://example.com/'))
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+import copy
 import os.path
+import pickle
+import time
 import unittest
 from urlparse import urlsplit
 
+from mock import patch
+
 from openid import fetchers, message
 from openid.consumer import discover
 from openid.fetchers import HTTPResponse
+from openid.store.discocache import MemoryDiscoveryCache
 from openid.yadis import xrires
 from openid.yadis.discover import DiscoveryFailure
+from openid.yadis.manager import YadisServiceManager
 from openid.yadis.xri import XRI
 
 # Tests for conditions that trigger DiscoveryFailure
@@ -476,6 +483,119 @@ class TestDiscovery(BaseTestDiscovery):
                           data=readDataFile('openid_1_and_2_xrds_bad_delegate.xml'), expected_services=1)
 
 
+class CachingMockFetcher(DiscoveryMockFetcher):
+    """Mock fetcher which adds extra headers to its responses."""
+    extra_headers = {}
+
+    def fetch(self, url, body=None, headers=None):
+        response = DiscoveryMockFetcher.fetch(self, url, body, headers)
+        response.headers.update(self.extra_headers)
+        return response
+
+
+XRDS_EXPIRES_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <Expires>%s</Expires>
+    <Service priority="10">
+      <Type>http://specs.openid.net/auth/2.0/signon</Type>
+      <URI>http://www.myopenid.com/server</URI>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+"""
+
+
+class TestDiscoveryCache(BaseTestDiscovery):
+    """Test discovery through a discovery cache."""
+    fetcherClass = CachingMockFetcher
+
+    def setUp(self):
+        super(TestDiscoveryCache, self).setUp()
+        self.cache = MemoryDiscoveryCache()
+        discover.setDiscoveryCache(self.cache)
+
+    def tearDown(self):
+        discover.setDiscoveryCache(None)
+        super(TestDiscoveryCache, self).tearDown()
+
+    def test_getDiscoveryCache(self):
+        self.assertEqual(discover.getDiscoveryCache(), self.cache)
+
+    def test_cached(self):
+        self.documents[self.id_url] = ('application/xrds+xml', readDataFile('openid2_xrds.xml'))
+        id_url, services = discover.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+        cached_id_url, cached_services = discover.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+        self.assertEqual(cached_id_url, id_url)
+        self.assertEqual([s.server_url for s in cached_services], [s.server_url for s in services])
+        self._checkService(cached_services[0], used_yadis=True, types=['2.0'],
+                           server_url="http://www.myopenid.com/server", claimed_id=self.id_url,
+                           local_id='http://smoker.myopenid.com/', display_identifier=self.id_url)
+
+    def test_normalized_key(self):
+        self.documents[self.id_url] = ('text/html', readDataFile('openid.html'))
+        discover.discover(self.id_url)
+        discover.discover('someuser.unittest')
+        discover.discover(self.id_url + '#fragment')
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+    def test_cached_copies(self):
+        self.documents[self.id_url] = ('text/html', readDataFile('openid.html'))
+        _, services = discover.discover(self.id_url)
+        services[0].server_url = 'http://modified.example.com/'
+        _, services = discover.discover(self.id_url)
+        self.assertEqual(services[0].server_url, 'http://www.myopenid.com/server')
+
+    def test_failure(self):
+        self.assertRaises(DiscoveryFailure, discover.discover, self.id_url)
+        self.assertRaises(DiscoveryFailure, discover.discover, self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 1)
+
+    def test_fetch_failure(self):
+        fetchers.setDefaultFetcher(ErrorRaisingFetcher(RuntimeError('Dead host')))
+        self.assertRaises(fetchers.HTTPFetchingError, discover.discover, self.id_url)
+
+        fetchers.setDefaultFetcher(self.fetcher)
+        self.assertRaises(fetchers.HTTPFetchingError, discover.discover, self.id_url)
+        self.assertEqual(self.fetcher.fetchlog, [])
+
+    def test_failure_ttl(self):
+        self.cache.failure_ttl = 0
+        self.assertRaises(DiscoveryFailure, discover.discover, self.id_url)
+        self.assertRaises(DiscoveryFailure, discover.discover, self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+
+    def test_no_cache(self):
+        self.fetcher.extra_headers = {'cache-control': 'private, no-cache'}
+        self.documents[self.id_url] = ('text/html', readDataFile('openid.html'))
+        discover.discover(self.id_url)
+        discover.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+
+    def test_max_age(self):
+        self.fetcher.extra_headers = {'cache-control': 'max-age=120'}
+        self.documents[self.id_url] = ('text/html', readDataFile('openid.html'))
+        discover.discover(self.id_url)
+        expires, _ = self.cache._entries[self.id_url]
+        self.assertAlmostEqual(expires - time.time(), 120, delta=5)
+
+    def test_xrd_expired(self):
+        self.documents[self.id_url] = ('application/xrds+xml', XRDS_EXPIRES_TEMPLATE % '2000-01-01T00:00:00Z')
+        discover.discover(self.id_url)
+        discover.discover(self.id_url)
+        self.assertEqual(len(self.fetcher.fetchlog), 2)
+
+    def test_xrd_expires(self):
+        expires = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 300))
+        self.documents[self.id_url] = ('application/xrds+xml', XRDS_EXPIRES_TEMPLATE % expires)
+        discover.discover(self.id_url)
+        expires, _ = self.cache._entries[self.id_url]
+        self.assertAlmostEqual(expires - time.time(), 300, delta=5)
+
+
 class MockFetcherForXRIProxy(object):
 
     def __init__(self, documents, proxy_url=xrires.DEFAULT_PROXY):
@@ -757,3 +877,158 @@ class TestEndpointDisplayIdentifier(unittest.TestCase):
         endpoint = discover.OpenIDServiceEndpoint()
         endpoint.claimed_id = 'http://recycled.invalid/#123'
         self.assertEqual(endpoint.getDisplayIdentifier(), 'http://recycled.invalid/')
+
+
+class ExtendedEndpoint(discover.OpenIDServiceEndpoint):
+    """An endpoint with attributes of its own."""
+
+
+class TestEndpointEncoding(unittest.TestCase):
+    def setUp(self):
+        self.endpoint = discover.OpenIDServiceEndpoint()
+        self.endpoint.claimed_id = 'http://example.com/user'
+        self.endpoint.server_url = 'http://example.com/server'
+        self.endpoint.type_uris = [discover.OPENID_2_0_TYPE, 'http://example.com/extension']
+        self.endpoint.used_yadis = True
+
+    def assertEndpointsEqual(self, endpoint, other):
+        self.assertEqual(type(endpoint), type(other))
+        for name in discover.OpenIDServiceEndpoint.__slots__:
+            self.assertEqual(getattr(endpoint, name), getattr(other, name))
+            self.assertEqual(type(getattr(endpoint, name)), type(getattr(other, name)), name)
+        self.assertEqual(map(type, endpoint.type_uris), map(type, other.type_uris))
+
+    def test_roundTrip(self):
+        data = self.endpoint.toBytes()
+        self.assertEqual(data, '1["http://example.com/server",[1,"http://example.com/extension"],1,'
+                               '"http://example.com/user"]')
+        decoded = discover.OpenIDServiceEndpoint.fromBytes(data)
+        self.assertEndpointsEqual(decoded, self.endpoint)
+        self.assertIsInstance(decoded.server_url, str)
+        self.assertIsInstance(decoded.type_uris[1], str)
+
+    def test_allFields(self):
+        self.endpoint.local_id = 'http://example.com/local'
+        self.endpoint.display_identifier = u'http://example.com/\u00fcser'
+        self.endpoint.canonicalID = '=!1000'
+        decoded = discover.OpenIDServiceEndpoint.fromBytes(self.endpoint.toBytes())
+        self.assertEndpointsEqual(decoded, self.endpoint)
+        self.assertIsInstance(decoded.display_identifier, unicode)
+
+    def test_nonASCII(self):
+        self.endpoint.claimed_id = 'http://example.com/\xc3\xbcser'
+        self.endpoint.local_id = u'http://example.com/\u00fcser'
+        self.endpoint.type_uris = ['http://example.com/\xc3\xbc', u'http://example.com/\u00fc', u'http://example.com/',
+                                   discover.OPENID_2_0_TYPE]
+        for decoded in [discover.OpenIDServiceEndpoint.fromBytes(self.endpoint.toBytes()),
+                        pickle.loads(pickle.dumps(self.endpoint)),
+                        copy.copy(self.endpoint)]:
+            self.assertEndpointsEqual(decoded, self.endpoint)
+
+    def test_notUTF8(self):
+        self.endpoint.claimed_id = 'http://example.com/\xfcser'
+        self.endpoint.display_identifier = u'http://example.com/\xfcser'
+        self.endpoint.type_uris = ['http://example.com/\xfc', 'http://example.com/\xc3\xbc']
+        for decoded in [discover.OpenIDServiceEndpoint.fromBytes(self.endpoint.toBytes()),
+                        pickle.loads(pickle.dumps(self.endpoint))]:
+            self.assertEndpointsEqual(decoded, self.endpoint)
+
+    def test_latin1HTML(self):
+        html = '<html><head><link rel="openid.server" href="http://op.example/\xe9"></head></html>'
+        endpoint, = discover.OpenIDServiceEndpoint.fromHTML('http://u.example/\xe9', html)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEndpointsEqual(pickle.loads(pickle.dumps(endpoint, protocol)), endpoint)
+
+    def test_pickleNotString(self):
+        # Fields the encoding cannot hold are pickled as they are.
+        self.endpoint.claimed_id = 42
+        self.assertRaises(ValueError, self.endpoint.toBytes)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEndpointsEqual(pickle.loads(pickle.dumps(self.endpoint, protocol)), self.endpoint)
+
+        endpoint = ExtendedEndpoint()
+        endpoint.server_url = 42
+        endpoint.extra = 'extra'
+        unpickled = pickle.loads(pickle.dumps(endpoint))
+        self.assertEndpointsEqual(unpickled, endpoint)
+        self.assertEqual(unpickled.extra, 'extra')
+
+    def test_copy(self):
+        self.endpoint.display_identifier = 'http://example.com/\xfcser'
+        with patch.object(discover.OpenIDServiceEndpoint, 'toBytes') as toBytes:
+            copied = copy.copy(self.endpoint)
+        self.assertFalse(toBytes.called)
+        self.assertEndpointsEqual(copied, self.endpoint)
+        self.assertIs(copied.type_uris, self.endpoint.type_uris)
+
+        endpoint = ExtendedEndpoint()
+        endpoint.extra = 'extra'
+        self.assertEqual(copy.copy(endpoint).extra, 'extra')
+
+    def test_empty(self):
+        endpoint = discover.OpenIDServiceEndpoint()
+        self.assertEqual(endpoint.toBytes(), '1[null,[],0]')
+        self.assertEndpointsEqual(discover.OpenIDServiceEndpoint.fromBytes(endpoint.toBytes()), endpoint)
+
+    def test_noXML(self):
+        self.assertFalse(hasattr(self.endpoint, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.endpoint.service_element = object()
+
+    def test_invalid(self):
+        for data in ['', '2[null,[],0]', '1', '1{}', '1[null,[]]', '1[null,[99],0]', '1[null,null,0]',
+                     '1[null,[[]],0]', '1[null,[[1]],0]', '1[null,[],null]', '1[1,[],0]', '1[null,[["x",2]],0]',
+                     '1[null,[[1,1]],0]']:
+            self.assertRaises(ValueError, discover.OpenIDServiceEndpoint.fromBytes, data)
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(self.endpoint, protocol)
+            self.assertIn(self.endpoint.toBytes(), data)
+            self.assertEndpointsEqual(pickle.loads(data), self.endpoint)
+
+    def test_pickleSubclass(self):
+        endpoint = ExtendedEndpoint()
+        endpoint.server_url = 'http://example.com/server'
+        endpoint.extra = 'extra'
+        unpickled = pickle.loads(pickle.dumps(endpoint))
+        self.assertEndpointsEqual(unpickled, endpoint)
+        self.assertEqual(unpickled.extra, 'extra')
+
+    def test_legacyPickle(self):
+        # Pickled before the endpoints had slots
+        data = ("ccopy_reg\n_reconstructor\np0\n(copenid.consumer.discover\nOpenIDServiceEndpoint\np1\n"
+                "c__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'claimed_id'\np6\nS'http://example.com/user'\n"
+                "p7\nsS'display_identifier'\np8\nNsS'server_url'\np9\nS'http://example.com/server'\np10\n"
+                "sS'canonicalID'\np11\nNsS'local_id'\np12\nNsS'type_uris'\np13\n(lp14\n"
+                "S'http://specs.openid.net/auth/2.0/signon'\np15\nasS'used_yadis'\np16\nI01\nsb.")
+        self.endpoint.type_uris = [discover.OPENID_2_0_TYPE]
+        self.assertEndpointsEqual(pickle.loads(data), self.endpoint)
+
+    def test_manager(self):
+        manager = YadisServiceManager('http://example.com/', 'http://example.com/user', [self.endpoint] * 2, 'key')
+        manager.next()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(manager, protocol))
+            self.assertEqual(unpickled.starting_url, 'http://example.com/')
+            self.assertEqual(unpickled.yadis_url, 'http://example.com/user')
+            self.assertEqual(unpickled.session_key, 'key')
+            self.assertEqual(len(unpickled), 1)
+            self.assertEndpointsEqual(unpickled.current(), self.endpoint)
+            self.assertEndpointsEqual(unpickled.next(), self.endpoint)
+
+    def test_legacyManagerPickle(self):
+        # Pickled before the managers had slots
+        data = ("\x80\x02copenid.yadis.manager\nYadisServiceManager\nq\x00)\x81q\x01}q\x02(U\x08servicesq\x03]"
+                "q\x04copenid.consumer.discover\nOpenIDServiceEndpoint\nq\x05)\x81q\x06}q\x07(U\nclaimed_idq\x08U"
+                "\x17http://example.com/userq\tU\x12display_identifierq\nNU\nserver_urlq\x0bU\x19"
+                "http://example.com/serverq\x0cU\x0bcanonicalIDq\rNU\x08local_idq\x0eNU\ttype_urisq\x0f]q\x10U'"
+                "http://specs.openid.net/auth/2.0/signonq\x11aU\nused_yadisq\x12\x88ubaU\tyadis_urlq\x13h\tU"
+                "\x0cstarting_urlq\x14U\x13http://example.com/q\x15U\x0bsession_keyq\x16U\x03keyq\x17U\x08"
+                "_currentq\x18Nub.")
+        manager = pickle.loads(data)
+        self.assertTrue(manager.forURL('http://example.com/user'))
+        self.assertEqual(manager.session_key, 'key')
+        self.assertIsNone(manager.current())
+        self.endpoint.type_uris = [discover.OPENID_2_0_TYPE]
+        self.assertEndpointsEqual(manager.next(), self.endpoint)
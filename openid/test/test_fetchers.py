@@ -1,12 +1,15 @@
 import socket
+import threading
+import time
 import unittest
 import urllib2
 import warnings
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from cStringIO import StringIO
+from SocketServer import ThreadingMixIn
 from urllib import addinfourl
 
-from mock import Mock
+from mock import Mock, patch
 
 from openid import fetchers
 
@@ -85,7 +88,7 @@ def test_fetcher(fetcher, exc, server):
 
 
 def run_fetcher_tests(server):
-    exc_fetchers = []
+    exc_fetchers = [fetchers.PooledHTTPFetcher()]
     for klass, library_name in [
         (fetchers.CurlHTTPFetcher, 'pycurl'),
         (fetchers.HTTPLib2Fetcher, 'httplib2'),
@@ -199,7 +202,6 @@ class TestFetchers(unittest.TestCase):
     def test(self):
         server = HTTPServer(("", 0), FetcherTestHandler)
 
-        import threading
         server_thread = threading.Thread(target=server.serve_forever)
         server_thread.setDaemon(True)
         server_thread.start()
@@ -207,6 +209,178 @@ class TestFetchers(unittest.TestCase):
         run_fetcher_tests(server)
 
 
+class KeepAliveTestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 handler which keeps connections open."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self._respond(302, [('Location', '/success')], '')
+        elif self.path == '/close':
+            self._respond(200, [('Connection', 'close')], self.path)
+        elif self.path == '/drop':
+            # Close the connection without telling the client, as
+            # servers do when their keep-alive timeout passes.
+            self._respond(200, [], self.path)
+            self.close_connection = 1
+        else:
+            self._respond(200, [], self.path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        self._respond(200, [], body)
+
+    def _respond(self, http_code, extra_headers, body):
+        self.send_response(http_code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in extra_headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestPooledHTTPFetcher(unittest.TestCase):
+    """Test `PooledHTTPFetcher` class."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveTestHandler)
+        server_thread = threading.Thread(target=cls.server.serve_forever)
+        server_thread.setDaemon(True)
+        server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.fetcher = fetchers.PooledHTTPFetcher()
+
+    def tearDown(self):
+        self.fetcher.close()
+
+    def geturl(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server.server_address[1], path)
+
+    def test_reuse(self):
+        for path in ('/first', '/second', '/third'):
+            response = self.fetcher.fetch(self.geturl(path))
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, path)
+            self.assertEqual(response.final_url, self.geturl(path))
+            self.assertEqual(response.headers['content-type'], 'text/plain')
+        self.assertEqual(self.fetcher.getStats(), {'hits': 2, 'misses': 1, 'idle': 1})
+
+    def test_post(self):
+        response = self.fetcher.fetch(self.geturl('/post'), body='openid.mode=associate')
+        self.assertEqual(response.body, 'openid.mode=associate')
+        response = self.fetcher.fetch(self.geturl('/post'), body='openid.mode=check_authentication')
+        self.assertEqual(response.body, 'openid.mode=check_authentication')
+        self.assertEqual(self.fetcher.hits, 1)
+
+    def test_redirect(self):
+        response = self.fetcher.fetch(self.geturl('/redirect'))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.final_url, self.geturl('/success'))
+        self.assertEqual(response.body, '/success')
+        self.assertEqual(self.fetcher.getStats(), {'hits': 1, 'misses': 1, 'idle': 1})
+
+    def test_connection_close(self):
+        self.fetcher.fetch(self.geturl('/close'))
+        self.fetcher.fetch(self.geturl('/close'))
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 0})
+
+    def test_max_requests(self):
+        self.fetcher.max_requests = 2
+        for _ in range(4):
+            self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.getStats(), {'hits': 2, 'misses': 2, 'idle': 0})
+
+    def test_idle_timeout(self):
+        self.fetcher.idle_timeout = -1
+        self.fetcher.fetch(self.geturl('/success'))
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 1})
+
+    def test_pool_size(self):
+        self.fetcher.pool_size = 0
+        self.fetcher.fetch(self.geturl('/success'))
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 0})
+
+    def test_stale_connection(self):
+        self.fetcher.fetch(self.geturl('/success'))
+        # Simulate the server dropping the idle connection.
+        pooled = self.fetcher._pools.values()[0][0]
+        pooled.connection.sock.shutdown(socket.SHUT_RDWR)
+        response = self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(response.body, '/success')
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 1})
+
+    def test_stale_post(self):
+        # The request could not be sent, so it is sent again.
+        self.fetcher.fetch(self.geturl('/success'))
+        pooled = self.fetcher._pools.values()[0][0]
+        pooled.connection.sock.shutdown(socket.SHUT_RDWR)
+        response = self.fetcher.fetch(self.geturl('/post'), body='openid.mode=check_authentication')
+        self.assertEqual(response.body, 'openid.mode=check_authentication')
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 1})
+
+    def test_post_server_closed(self):
+        self.fetcher.post_idle_timeout = 60
+        self.fetcher.fetch(self.geturl('/drop'))
+        time.sleep(0.05)
+        response = self.fetcher.fetch(self.geturl('/post'), body='openid.mode=associate')
+        self.assertEqual(response.body, 'openid.mode=associate')
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 1})
+
+    def test_post_idle_timeout(self):
+        self.fetcher.post_idle_timeout = -1
+        self.fetcher.fetch(self.geturl('/success'))
+        self.fetcher.fetch(self.geturl('/post'), body='openid.mode=associate')
+        # The idle connection is left for other requests.
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 2})
+        self.fetcher.fetch(self.geturl('/success'))
+        self.assertEqual(self.fetcher.hits, 1)
+
+    def test_timeout_not_resent(self):
+        for body in (None, 'openid.mode=check_authentication'):
+            self.fetcher.fetch(self.geturl('/success'))
+            pooled = self.fetcher._pools.values()[0][0]
+            with patch.object(pooled.connection, 'getresponse', side_effect=socket.timeout('timed out')):
+                with self.assertRaises(socket.timeout):
+                    self.fetcher.fetch(self.geturl('/post'), body=body)
+            self.assertEqual(self.fetcher.getStats()['idle'], 0)
+        self.assertEqual(self.fetcher.getStats(), {'hits': 0, 'misses': 2, 'idle': 0})
+
+    def test_threads(self):
+        results = []
+
+        def worker():
+            for _ in range(10):
+                results.append(self.fetcher.fetch(self.geturl('/success')).body)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['/success'] * 40)
+        stats = self.fetcher.getStats()
+        self.assertEqual(stats['hits'] + stats['misses'], 40)
+        self.assertLessEqual(stats['idle'], self.fetcher.pool_size)
+
+
 class FakeFetcher(object):
     sentinel = object()
 
@@ -133,6 +133,27 @@ class KVExcTest(unittest.TestCase):
             self.assertRaises(ValueError, kvform.seqToKV, kv_data)
 
 
+class FastSeqToKVTest(unittest.TestCase):
+
+    def test_same(self):
+        for kv_data, result, expected_warnings in kvseq_cases:
+            with LogCapture() as logbook:
+                actual = kvform.fastSeqToKV(kv_data)
+            self.assertEqual(actual, result)
+            self.assertIsInstance(actual, str)
+            self.assertEqual(logbook.records, [])
+
+    def test_invalid(self):
+        for kv_data in kvexc_cases:
+            self.assertRaises(ValueError, kvform.fastSeqToKV, kv_data)
+
+    def test_convert(self):
+        with LogCapture() as logbook:
+            result = kvform.fastSeqToKV([(1, 1)])
+        self.assertEqual(result, '1:1\n')
+        self.assertEqual(len(logbook.records), 2)
+
+
 class GeneralTest(unittest.TestCase):
     kvform = '<None>'
 
@@ -4,13 +4,14 @@ import urllib
 import warnings
 from urlparse import parse_qs
 
+from mock import patch
 from testfixtures import ShouldWarn
 
 from openid import oidutil
 from openid.extensions import sreg
 from openid.message import (BARE_NS, NULL_NAMESPACE, OPENID1_NS, OPENID2_NS, OPENID_NS, OPENID_PROTOCOL_FIELDS,
-                            THE_OTHER_OPENID1_NS, InvalidNamespace, InvalidOpenIDNamespace, Message, NamespaceMap,
-                            UndefinedOpenIDNamespace, no_default)
+                            SREG_URI, THE_OTHER_OPENID1_NS, FrozenMessage, InvalidNamespace, InvalidOpenIDNamespace,
+                            LazyMessage, Message, NamespaceMap, UndefinedOpenIDNamespace, no_default)
 
 
 def mkGetArgTest(ns, key, expected=None):
@@ -698,6 +699,206 @@ class OpenID2MessageTest(unittest.TestCase):
         self.assertTrue(self.msg.isOpenID2())
 
 
+class CopyTest(unittest.TestCase):
+    def test_copy(self):
+        message = Message.fromPostArgs({'openid.ns': OPENID2_NS, 'openid.mode': 'id_res', 'xey': 'value'})
+        message.namespaces.addAlias(SREG_URI, 'sreg', implicit=True)
+        copy = message.copy()
+        self.assertEqual(copy, message)
+        self.assertEqual(copy.toPostArgs(), message.toPostArgs())
+
+        copy.setArg(OPENID2_NS, 'mode', 'cancel')
+        copy.namespaces.addAlias('http://example.com/ext', 'ext')
+        self.assertEqual(message.getArg(OPENID2_NS, 'mode'), 'id_res')
+        self.assertFalse(message.namespaces.isDefined('http://example.com/ext'))
+        self.assertTrue(copy.namespaces.isImplicit(SREG_URI))
+
+
+class NamespaceArgsTest(unittest.TestCase):
+    def setUp(self):
+        self.message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'id_res',
+            'openid.ns.sreg': SREG_URI,
+            'openid.sreg.nickname': 'alice',
+            'xey': 'value',
+        })
+
+    def test_nsArgs(self):
+        self.assertEqual(self.message.ns_args, {
+            OPENID2_NS: {'mode': 'id_res'},
+            SREG_URI: {'nickname': 'alice'},
+            BARE_NS: {'xey': 'value'},
+        })
+        self.assertEqual(self.message.args, {
+            (OPENID2_NS, 'mode'): 'id_res',
+            (SREG_URI, 'nickname'): 'alice',
+            (BARE_NS, 'xey'): 'value',
+        })
+
+    def test_getArgs(self):
+        args = self.message.getArgs(SREG_URI)
+        self.assertEqual(args, {'nickname': 'alice'})
+        # The result is a copy
+        args['email'] = 'alice@example.com'
+        self.assertFalse(self.message.hasKey(SREG_URI, 'email'))
+
+    def test_delArg(self):
+        self.message.delArg(SREG_URI, 'nickname')
+        self.assertNotIn(SREG_URI, self.message.ns_args)
+        self.assertEqual(self.message, Message.fromPostArgs({
+            'openid.ns': OPENID2_NS, 'openid.mode': 'id_res', 'openid.ns.sreg': SREG_URI, 'xey': 'value'}))
+        with self.assertRaises(KeyError) as catcher:
+            self.message.delArg(SREG_URI, 'nickname')
+        self.assertEqual(catcher.exception.args, ((SREG_URI, 'nickname'),))
+
+    def test_updateArgs(self):
+        self.message.updateArgs('http://example.com/ext', {'one': '1', 'two': '2'})
+        self.assertEqual(self.message.getArgs('http://example.com/ext'), {'one': '1', 'two': '2'})
+        self.assertEqual(self.message.toPostArgs()['openid.ext0.one'], '1')
+
+
+class EncodingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'id_res',
+            'openid.return_to': 'http://example.com/return',
+        })
+
+    def test_encodedOnce(self):
+        with patch('openid.oidutil.toUnicode', wraps=oidutil.toUnicode) as to_unicode:
+            post_args = self.message.toPostArgs()
+            self.message.toKVForm()
+            self.message.toURLEncoded()
+            self.message.toURL('http://example.com/')
+            self.assertEqual(self.message.toPostArgs(), post_args)
+        # The namespace and the two arguments
+        self.assertEqual(to_unicode.call_count, 3)
+
+    def test_resultCopied(self):
+        self.message.toPostArgs()['openid.mode'] = 'cancel'
+        self.message.toArgs()['mode'] = 'cancel'
+        self.assertEqual(self.message.toPostArgs()['openid.mode'], 'id_res')
+        self.assertEqual(self.message.toArgs()['mode'], 'id_res')
+
+    def test_setArg(self):
+        self.message.toKVForm()
+        self.message.setArg(OPENID_NS, 'mode', 'cancel')
+        self.assertIn('mode:cancel\n', self.message.toKVForm())
+
+    def test_updateArgs(self):
+        self.message.toURLEncoded()
+        self.message.updateArgs(OPENID_NS, {'mode': 'cancel'})
+        self.assertIn('openid.mode=cancel', self.message.toURLEncoded())
+
+    def test_delArg(self):
+        self.message.toPostArgs()
+        self.message.delArg(OPENID_NS, 'mode')
+        self.assertNotIn('openid.mode', self.message.toPostArgs())
+
+    def test_namespaces(self):
+        self.message.setArg(SREG_URI, 'nickname', 'alice')
+        self.assertIn('openid.ext0.nickname', self.message.toPostArgs())
+        message = self.message.copy()
+        self.assertIn('openid.ext0.nickname', message.toPostArgs())
+
+        self.message = Message(OPENID2_NS)
+        self.message.toPostArgs()
+        self.message.namespaces.addAlias(SREG_URI, 'sreg')
+        self.assertEqual(self.message.toPostArgs()['openid.ns.sreg'], SREG_URI)
+
+    def test_toURL(self):
+        for base_url in ('http://example.com/', 'http://example.com/?a=b', u'http://example.com/'):
+            self.assertEqual(self.message.toURL(base_url),
+                             oidutil.appendArgs(base_url, self.message.toPostArgs()))
+        self.assertEqual(Message().toURL('http://example.com/'), 'http://example.com/')
+
+    def test_frozen(self):
+        frozen = self.message.freeze()
+        self.assertIsInstance(frozen, FrozenMessage)
+        self.assertEqual(frozen, self.message)
+        self.assertIs(frozen.freeze(), frozen)
+        self.assertRaises(TypeError, frozen.setArg, OPENID_NS, 'mode', 'cancel')
+        self.assertRaises(TypeError, frozen.updateArgs, OPENID_NS, {'mode': 'cancel'})
+        self.assertRaises(TypeError, frozen.delArg, OPENID_NS, 'mode')
+        self.assertEqual(frozen.getArg(OPENID_NS, 'mode'), 'id_res')
+
+        # Changing the original doesn't change the frozen copy.
+        self.message.setArg(OPENID_NS, 'mode', 'cancel')
+        self.assertEqual(frozen.getArg(OPENID_NS, 'mode'), 'id_res')
+
+        message = frozen.copy()
+        self.assertIs(type(message), Message)
+        message.setArg(OPENID_NS, 'mode', 'cancel')
+        self.assertEqual(frozen.toPostArgs()['openid.mode'], 'id_res')
+
+    def test_frozenFromPostArgs(self):
+        frozen = FrozenMessage.fromPostArgs(self.message.toPostArgs())
+        self.assertEqual(frozen, self.message)
+        self.assertEqual(frozen.toKVForm(), self.message.toKVForm())
+
+
+class LazyMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.args = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'checkid_setup',
+            'openid.ns.sreg': SREG_URI,
+            'openid.sreg.nickname': 'alice',
+            'xey': 'value',
+        }
+        self.message = LazyMessage(self.args)
+
+    def test_openIDArgs(self):
+        self.assertEqual(self.message.getOpenIDNamespace(), OPENID2_NS)
+        self.assertEqual(self.message.getArg(OPENID_NS, 'mode'), 'checkid_setup')
+        self.assertEqual(self.message.getArg(OPENID2_NS, 'mode'), 'checkid_setup')
+        self.assertIsNone(self.message.getArg(OPENID_NS, 'return_to'))
+        self.assertRaises(KeyError, self.message.getArg, OPENID_NS, 'return_to', no_default)
+        self.assertTrue(self.message.hasKey(OPENID_NS, 'mode'))
+        self.assertFalse(self.message.hasKey(OPENID_NS, 'return_to'))
+        self.assertIn("'openid.mode': 'checkid_setup'", repr(self.message))
+        self.assertFalse(self.message.isParsed())
+
+    def test_bareArgs(self):
+        self.assertEqual(self.message.getArg(BARE_NS, 'xey'), 'value')
+        self.assertIsNone(self.message.getArg(BARE_NS, 'missing'))
+        self.assertRaises(KeyError, self.message.getArg, BARE_NS, 'missing', no_default)
+        self.assertTrue(self.message.hasKey(BARE_NS, 'xey'))
+        self.assertFalse(self.message.isParsed())
+        # OpenID arguments are not bare.
+        self.assertIsNone(self.message.getArg(BARE_NS, 'openid.mode'))
+        self.assertTrue(self.message.isParsed())
+
+    def test_parse(self):
+        self.assertEqual(self.message.getArg(SREG_URI, 'nickname'), 'alice')
+        self.assertTrue(self.message.isParsed())
+        self.assertEqual(self.message, Message.fromPostArgs(self.args))
+        self.assertEqual(self.message.toPostArgs(), self.args)
+        self.assertEqual(self.message.getArg(OPENID_NS, 'mode'), 'checkid_setup')
+
+    def test_openID1(self):
+        message = LazyMessage({'openid.mode': 'id_res', 'openid.ns.sreg': SREG_URI, 'openid.sreg.nickname': 'alice'})
+        self.assertTrue(message.isOpenID1())
+        self.assertEqual(message.getArg(OPENID1_NS, 'mode'), 'id_res')
+        self.assertFalse(message.isParsed())
+        self.assertEqual(message.getArg(SREG_URI, 'nickname'), 'alice')
+
+    def test_copy(self):
+        message = self.message.copy()
+        self.assertIs(type(message), Message)
+        message.setArg(OPENID_NS, 'mode', 'id_res')
+        self.assertEqual(self.message.getArg(OPENID_NS, 'mode'), 'checkid_setup')
+        self.assertRaises(TypeError, self.message.setArg, OPENID_NS, 'mode', 'id_res')
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, LazyMessage, {'openid.mode': ['id_res']})
+        self.assertRaises(InvalidOpenIDNamespace, LazyMessage, {'openid.ns': 'Tuesday'})
+        message = LazyMessage({'openid.ns': OPENID2_NS, 'openid.ns.a': SREG_URI, 'openid.ns.b': SREG_URI})
+        self.assertRaises(InvalidNamespace, message.parse)
+
+
 class MessageTest(unittest.TestCase):
     def setUp(self):
         self.postargs = {
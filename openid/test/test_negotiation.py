@@ -1,11 +1,14 @@
+import time
 import unittest
 
+from mock import patch
 from testfixtures import LogCapture, StringComparison
 
 from openid import association
 from openid.consumer.consumer import GenericConsumer, ServerError
 from openid.consumer.discover import OPENID_2_0_TYPE, OpenIDServiceEndpoint
 from openid.message import OPENID1_NS, OPENID_NS, Message
+from openid.store import memstore
 
 
 class ErrorRaisingConsumer(GenericConsumer):
@@ -260,6 +263,78 @@ class TestOpenID1SessionNegotiation(unittest.TestCase):
         self.assertEqual(logbook.records, [])
 
 
+class RecordingConsumer(ErrorRaisingConsumer):
+    """Records the types of the association requests."""
+
+    def _requestAssociation(self, endpoint, assoc_type, session_type):
+        self.requested.append((assoc_type, session_type))
+        return ErrorRaisingConsumer._requestAssociation(self, endpoint, assoc_type, session_type)
+
+
+class TestNegotiationMemory(unittest.TestCase):
+    """Test that the types a server suggested are requested first."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.consumer = RecordingConsumer(self.store)
+        self.consumer.requested = []
+
+        self.endpoint = OpenIDServiceEndpoint()
+        self.endpoint.type_uris = [OPENID_2_0_TYPE]
+        self.endpoint.server_url = 'http://server.example/'
+
+        self.unsupported = Message(self.endpoint.preferredNamespace())
+        self.unsupported.setArg(OPENID_NS, 'error', 'Unsupported type')
+        self.unsupported.setArg(OPENID_NS, 'error_code', 'unsupported-type')
+        self.unsupported.setArg(OPENID_NS, 'assoc_type', 'HMAC-SHA256')
+        self.unsupported.setArg(OPENID_NS, 'session_type', 'DH-SHA256')
+
+    def makeAssoc(self):
+        return association.Association.fromExpiresIn(3600, 'handle', 'secret', 'HMAC-SHA256')
+
+    def test_remembered(self):
+        self.consumer.return_messages = [self.unsupported, self.makeAssoc(), self.makeAssoc()]
+        with LogCapture():
+            self.assertIsNotNone(self.consumer._negotiateAssociation(self.endpoint))
+        self.assertIsNotNone(self.consumer._negotiateAssociation(self.endpoint))
+        self.assertEqual(self.consumer.requested,
+                         [('HMAC-SHA1', 'DH-SHA1'), ('HMAC-SHA256', 'DH-SHA256'), ('HMAC-SHA256', 'DH-SHA256')])
+        # The memory is not an association with the server.
+        self.assertIsNone(self.store.getAssociation(self.endpoint.server_url))
+
+        # Another consumer of the store remembers it too.
+        consumer = RecordingConsumer(self.store)
+        consumer.requested = []
+        consumer.return_messages = [self.makeAssoc()]
+        consumer._negotiateAssociation(self.endpoint)
+        self.assertEqual(consumer.requested, [('HMAC-SHA256', 'DH-SHA256')])
+
+    def test_expired(self):
+        self.consumer.return_messages = [self.unsupported, self.makeAssoc(), self.makeAssoc()]
+        with LogCapture():
+            self.consumer._negotiateAssociation(self.endpoint)
+        with patch('time.time', return_value=time.time() + self.consumer.negotiation_memory + 10):
+            self.consumer._negotiateAssociation(self.endpoint)
+        self.assertEqual(self.consumer.requested[-1], ('HMAC-SHA1', 'DH-SHA1'))
+
+    def test_notAllowed(self):
+        self.consumer.return_messages = [self.unsupported, self.makeAssoc(), self.makeAssoc()]
+        with LogCapture():
+            self.consumer._negotiateAssociation(self.endpoint)
+        self.consumer.negotiator = association.SessionNegotiator([('HMAC-SHA1', 'DH-SHA1')])
+        self.consumer._negotiateAssociation(self.endpoint)
+        self.assertEqual(self.consumer.requested[-1], ('HMAC-SHA1', 'DH-SHA1'))
+
+    def test_disabled(self):
+        self.consumer.negotiation_memory = 0
+        self.consumer.return_messages = [self.unsupported, self.makeAssoc(), self.makeAssoc()]
+        with LogCapture():
+            self.consumer._negotiateAssociation(self.endpoint)
+        self.consumer._negotiateAssociation(self.endpoint)
+        self.assertEqual(self.consumer.requested[-1], ('HMAC-SHA1', 'DH-SHA1'))
+        self.assertIsNone(self.store.getAssociation('negotiation:' + self.endpoint.server_url))
+
+
 class TestNegotiatorBehaviors(unittest.TestCase):
     def setUp(self):
         self.allowed_types = [
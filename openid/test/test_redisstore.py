@@ -0,0 +1,263 @@
+"""Test `openid.store.redisstore` module."""
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+from mock import patch
+
+from openid.association import Association
+from openid.store import nonce
+from openid.store.redisstore import RedisConnectionPool, RedisError, RedisStore
+
+
+class FakeRedisHandler(SocketServer.StreamRequestHandler):
+    """Serves the subset of the Redis protocol used by the store."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def readCommand(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[0] == '*', line
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def encodeReply(self, reply):
+        if reply is None:
+            return '$-1\r\n'
+        elif isinstance(reply, RedisError):
+            return '-%s\r\n' % reply
+        elif isinstance(reply, bool):
+            return '+OK\r\n'
+        elif isinstance(reply, int):
+            return ':%d\r\n' % reply
+        elif isinstance(reply, list):
+            return '*%d\r\n%s' % (len(reply), ''.join(self.encodeReply(item) for item in reply))
+        else:
+            return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+    def handle(self):
+        while True:
+            command = self.readCommand()
+            if command is None:
+                return
+            with self.server.lock:
+                self.server.commands.append(command)
+                self.wfile.write(self.encodeReply(self.server.execute(command)))
+
+
+class FakeRedisServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.commands = []
+        # Maps keys to (value, expiration time)
+        self.data = {}
+
+    def _get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, command):
+        name, args = command[0].upper(), command[1:]
+        if name == 'PING':
+            return True
+        elif name == 'GET':
+            return self._get(args[0])
+        elif name == 'SET':
+            key, value, options = args[0], args[1], [o.upper() for o in args[2:]]
+            if 'NX' in options and self._get(key) is not None:
+                return None
+            expires = None
+            if 'EX' in options:
+                expires = time.time() + int(options[options.index('EX') + 1])
+            self.data[key] = (value, expires)
+            return True
+        elif name == 'DEL':
+            return int(self.data.pop(args[0], None) is not None)
+        elif name == 'EXPIRE':
+            if self._get(args[0]) is None:
+                return 0
+            self.data[args[0]] = (self.data[args[0]][0], time.time() + int(args[1]))
+            return 1
+        elif name == 'TTL':
+            if self._get(args[0]) is None:
+                return -2
+            expires = self.data[args[0]][1]
+            if expires is None:
+                return -1
+            return int(expires - time.time())
+        elif name == 'ZADD':
+            zset = self._get(args[0])
+            if zset is None:
+                zset = {}
+                self.data[args[0]] = (zset, None)
+            added = args[2] not in zset
+            zset[args[2]] = float(args[1])
+            return int(added)
+        elif name == 'ZREM':
+            zset = self._get(args[0]) or {}
+            return int(zset.pop(args[1], None) is not None)
+        elif name == 'ZREVRANGE':
+            zset = self._get(args[0]) or {}
+            members = sorted(zset, key=zset.get, reverse=True)
+            return members[int(args[1]):int(args[2]) + 1]
+        else:
+            return RedisError("ERR unknown command '%s'" % command[0])
+
+
+class TestRedisStore(unittest.TestCase):
+    """Test `RedisStore` class against a fake server."""
+
+    server_url = 'http://www.myopenid.com/openid'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer()
+        server_thread = threading.Thread(target=cls.server.serve_forever, args=(0.01,))
+        server_thread.setDaemon(True)
+        server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.data.clear()
+        del self.server.commands[:]
+        self.pool = RedisConnectionPool('127.0.0.1', self.server.server_address[1])
+        self.store = RedisStore(self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def genAssoc(self, handle, issued=0, lifetime=600):
+        return Association(handle, 'secret', int(time.time()) + issued, lifetime, 'HMAC-SHA1')
+
+    def test_associations(self):
+        assoc = self.genAssoc('first')
+        self.assertIsNone(self.store.getAssociation(self.server_url))
+
+        self.store.storeAssociation(self.server_url, assoc)
+        self.assertEqual(self.store.getAssociation(self.server_url), assoc)
+        self.assertEqual(self.store.getAssociation(self.server_url, 'first'), assoc)
+        self.assertIsNone(self.store.getAssociation(self.server_url + 'x', 'first'))
+
+        assoc2 = self.genAssoc('second', issued=1)
+        self.store.storeAssociation(self.server_url, assoc2)
+        self.assertEqual(self.store.getAssociation(self.server_url), assoc2)
+        self.assertEqual(self.store.getAssociation(self.server_url, 'first'), assoc)
+
+        # Latest issued, not latest expiring.
+        assoc3 = self.genAssoc('third', issued=2, lifetime=100)
+        self.store.storeAssociation(self.server_url, assoc3)
+        self.assertEqual(self.store.getAssociation(self.server_url), assoc3)
+
+        self.assertTrue(self.store.removeAssociation(self.server_url, 'third'))
+        self.assertFalse(self.store.removeAssociation(self.server_url, 'third'))
+        self.assertEqual(self.store.getAssociation(self.server_url), assoc2)
+        self.assertIsNone(self.store.getAssociation(self.server_url, 'third'))
+
+    def test_store_pipelined(self):
+        with patch.object(self.pool, 'execute', wraps=self.pool.execute) as execute:
+            self.store.storeAssociation(self.server_url, self.genAssoc('first'))
+            self.store.storeAssociation(self.server_url, self.genAssoc('second', lifetime=100))
+        # The index expires with the first association
+        self.assertEqual(execute.call_count, 3)
+        self.assertEqual([c[0] for c in self.server.commands], ['SET', 'ZADD', 'TTL', 'EXPIRE', 'SET', 'ZADD', 'TTL'])
+
+    def test_expired_association(self):
+        # Not stored at all
+        self.store.storeAssociation(self.server_url, self.genAssoc('old', issued=-7200, lifetime=3600))
+        self.assertEqual(self.server.data, {})
+
+        self.store.storeAssociation(self.server_url, self.genAssoc('long', lifetime=1000))
+        self.store.storeAssociation(self.server_url, self.genAssoc('short', issued=1, lifetime=100))
+        with patch('time.time', return_value=time.time() + 200):
+            self.assertEqual(self.store.getAssociation(self.server_url).handle, 'long')
+            self.assertIsNone(self.store.getAssociation(self.server_url, 'short'))
+        # The expired association was removed from the index.
+        self.assertIn(['ZREM', 'openid:assocs:' + self.server_url, 'short'], self.server.commands)
+
+    def test_nonce(self):
+        now = int(time.time())
+        self.assertTrue(self.store.useNonce(self.server_url, now, 'salt'))
+        self.assertFalse(self.store.useNonce(self.server_url, now, 'salt'))
+        self.assertTrue(self.store.useNonce('', now, 'salt'))
+        self.assertTrue(self.store.useNonce(self.server_url, now, 'pepper'))
+        self.assertFalse(self.store.useNonce(self.server_url, now - nonce.SKEW - 5, 'salt'))
+        self.assertFalse(self.store.useNonce(self.server_url, now + nonce.SKEW + 5, 'salt'))
+        self.assertEqual(len([c for c in self.server.commands if c[0] == 'SET']), 4)
+
+    def test_nonce_expires(self):
+        now = int(time.time())
+        self.assertTrue(self.store.useNonce(self.server_url, now, 'salt'))
+        key = 'openid:nonce:%d:4:salt%s' % (now, self.server_url)
+        value, expires = self.server.data[key]
+        self.assertAlmostEqual(expires, now + nonce.SKEW + 1, delta=2)
+        with patch('time.time', return_value=time.time() + nonce.SKEW + 2):
+            self.assertIsNone(self.server._get(key))
+
+    def test_cleanup(self):
+        self.assertEqual(self.store.cleanupNonces(), 0)
+        self.assertEqual(self.store.cleanupAssociations(), 0)
+        self.assertEqual(self.server.commands, [])
+
+    def test_pool(self):
+        for i in range(5):
+            self.store.useNonce(self.server_url, int(time.time()), str(i))
+        self.assertEqual(self.pool.getStats(), {'connections': 1, 'idle': 1})
+
+    def test_pool_threads(self):
+        results = []
+        now = int(time.time())
+
+        def worker():
+            used = 0
+            for i in range(50):
+                used += self.store.useNonce(self.server_url, now, str(i))
+            results.append(used)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(results), 50)
+        self.assertLessEqual(self.pool.getStats()['connections'], 4)
+
+    def test_error_reply(self):
+        with self.assertRaisesRegexp(RedisError, 'unknown command'):
+            self.pool.execute(('PING',), ('BOGUS',))
+        # The connection is still usable.
+        self.assertEqual(self.pool.execute(('PING',)), ['OK'])
+        self.assertEqual(self.pool.getStats()['connections'], 1)
+
+    def test_connection_setup(self):
+        pool = RedisConnectionPool('127.0.0.1', self.server.server_address[1], db=1, password='secret')
+        with self.assertRaisesRegexp(RedisError, "unknown command 'AUTH'"):
+            pool.execute(('PING',))
+        self.assertEqual(self.server.commands, [['AUTH', 'secret'], ['SELECT', '1']])
+        self.assertEqual(pool.getStats()['idle'], 0)
+
+    def test_key_prefix(self):
+        store = RedisStore(self.pool, key_prefix='other:')
+        store.storeAssociation(self.server_url, self.genAssoc('first'))
+        self.assertIsNone(self.store.getAssociation(self.server_url))
+        self.assertEqual(store.getAssociation(self.server_url).handle, 'first')
@@ -1,18 +1,22 @@
 """Tests for openid.server.
 """
+import pickle
+import time
 import unittest
 import warnings
 from functools import partial
 from urlparse import parse_qs, parse_qsl, urlparse
 
-from mock import sentinel
+from mock import Mock, patch, sentinel
 from testfixtures import LogCapture, ShouldWarn, StringComparison
 
 from openid import association, cryptutil, oidutil
 from openid.consumer.consumer import DiffieHellmanSHA256ConsumerSession
+from openid.dh import DiffieHellman, DiffieHellmanKeyPool, setKeyPool
 from openid.message import IDENTIFIER_SELECT, OPENID1_NS, OPENID1_URL_LIMIT, OPENID2_NS, OPENID_NS, Message, no_default
 from openid.server import server
 from openid.store import memstore
+from openid.store.nonce import mkNonce
 
 # In general, if you edit or add tests here, try to move in the direction
 # of testing smaller units.  For testing the external interfaces, we'll be
@@ -189,6 +193,25 @@ class TestDecode(unittest.TestCase):
         }
         self.assertRaises(server.ProtocolError, self.decode, args)
 
+    def test_rejectedNotParsed(self):
+        with patch.object(Message, 'fromPostArgs') as from_post_args:
+            for args in ({'pony': 'spotted'}, {'openid.mode': 'twos-compliment', 'openid.pants': 'zippered'}):
+                with self.assertRaises(server.ProtocolError) as catcher:
+                    self.decode(args)
+                self.assertFalse(catcher.exception.openid_message.isParsed())
+        self.assertEqual(from_post_args.call_count, 0)
+
+    def test_invalidAlias(self):
+        args = {
+            'openid.ns': OPENID2_NS,
+            'openid.mode': 'checkid_setup',
+            'openid.ns.a': 'http://example.com/ext',
+            'openid.ns.b': 'http://example.com/ext',
+        }
+        with self.assertRaises(server.ProtocolError) as catcher:
+            self.decode(args)
+        self.assertEqual(catcher.exception.openid_message.getArg(OPENID_NS, 'mode'), 'checkid_setup')
+
     def test_dictOfLists(self):
         args = {
             'openid.mode': ['checkid_setup'],
@@ -440,6 +463,23 @@ class TestDecode(unittest.TestCase):
         self.assertEqual(r.session.dh.generator, ALT_GEN)
         self.assertTrue(r.session.consumer_pubkey)
 
+    def test_associateDHDefaultModGen(self):
+        # Explicit default values use the key pool too
+        pool = DiffieHellmanKeyPool(size=1)
+        pool.fill()
+        setKeyPool(pool)
+        self.addCleanup(setKeyPool, None)
+        args = {
+            'openid.mode': 'associate',
+            'openid.session_type': 'DH-SHA1',
+            'openid.dh_consumer_public': "Rzup9265tw==",
+            'openid.dh_modulus': cryptutil.longToBase64(DiffieHellman.DEFAULT_MOD),
+            'openid.dh_gen': cryptutil.longToBase64(DiffieHellman.DEFAULT_GEN),
+        }
+        r = self.decode(args)
+        self.assertTrue(r.session.dh.usingDefaultValues())
+        self.assertEqual(pool.getStats()['hits'], 1)
+
     def test_associateDHCorruptModGen(self):
         # test dh with non-default but valid values for dh_modulus and dh_gen
         args = {
@@ -1224,6 +1264,10 @@ class MockSignatory(object):
         if (dumb, assoc_handle) in self.assocs:
             self.assocs.remove((dumb, assoc_handle))
 
+    def useResponse(self, assoc_handle, message):
+        self.invalidate(assoc_handle, dumb=True)
+        return True
+
 
 class TestCheckAuth(unittest.TestCase):
     def setUp(self):
@@ -1257,9 +1301,10 @@ class TestCheckAuth(unittest.TestCase):
             assertion has not yet been accepted with the same value for
             "openid.response_nonce".
 
-        In this implementation, the assoc_handle is only valid once.  And
-        nonces are a signed component of the message, so they can't be used
-        with another handle without breaking the sig.
+        In this implementation, the assoc_handle is only valid once, unless
+        it is shared and the nonce is used instead.  And nonces are a signed
+        component of the message, so they can't be used with another handle
+        without breaking the sig.
         """
         r = self.request.answer(self.signatory)
         r = self.request.answer(self.signatory)
@@ -1619,6 +1664,83 @@ class TestServer(unittest.TestCase):
         response = self.server.openid_associate(request)
         self.assertTrue(response.fields.hasKey(OPENID_NS, "assoc_handle"))
 
+    def _associateDH(self):
+        """Associate with a DH-SHA1 session and return the secret the
+        consumer decrypts and the association stored by the server."""
+        consumer_dh = DiffieHellman.fromDefaults()
+        message = Message.fromPostArgs({
+            'openid.ns': OPENID2_NS,
+            'openid.session_type': 'DH-SHA1',
+            'openid.assoc_type': 'HMAC-SHA1',
+            'openid.dh_consumer_public': cryptutil.longToBase64(consumer_dh.public),
+        })
+        request = server.AssociateRequest.fromMessage(message)
+        response = self.server.openid_associate(request)
+
+        spub = cryptutil.base64ToLong(response.fields.getArg(OPENID_NS, 'dh_server_public'))
+        enc_key = response.fields.getArg(OPENID_NS, 'enc_mac_key').decode('base64')
+        assoc = self.server.signatory.getAssociation(response.fields.getArg(OPENID_NS, 'assoc_handle'), dumb=False)
+        return consumer_dh.xorSecret(spub, enc_key, cryptutil.sha1), assoc
+
+    def test_associate_executor(self):
+        calls = []
+
+        class Executor(object):
+            def submit(self, func, *args):
+                # The arguments must make it to another process
+                func, args = pickle.loads(pickle.dumps((func, args)))
+                calls.append(func)
+                return Future(func(*args))
+
+        class Future(object):
+            def __init__(self, result):
+                self._result = result
+
+            def result(self, timeout=None):
+                return self._result
+
+        self.server = server.Server(self.store, "http://server.unittest/endpt", dh_executor=Executor())
+        secret, assoc = self._associateDH()
+        self.assertEqual(secret, assoc.secret)
+        self.assertEqual(len(calls), 1)
+
+    def test_associate_executor_fails(self):
+        executor = Mock()
+        executor.submit.side_effect = RuntimeError('cannot schedule new futures after shutdown')
+        self.server = server.Server(self.store, "http://server.unittest/endpt", dh_executor=executor)
+        with LogCapture() as logger:
+            secret, assoc = self._associateDH()
+        self.assertEqual(secret, assoc.secret)
+        logger.check(('openid.server.server', 'ERROR',
+                      StringComparison('Error computing the Diffie-Hellman secret in .*, computing it inline')))
+
+    def test_associate_executor_hangs(self):
+        try:
+            from concurrent.futures import Future
+        except ImportError:
+            raise unittest.SkipTest('concurrent.futures is not available')
+        executor = Mock()
+        executor.submit.return_value = future = Future()
+        self.server = server.Server(self.store, "http://server.unittest/endpt", dh_executor=executor)
+        with patch.object(server.DiffieHellmanSHA1ServerSession, 'executor_timeout', 0.01):
+            with LogCapture() as logger:
+                secret, assoc = self._associateDH()
+        self.assertEqual(secret, assoc.secret)
+        self.assertTrue(future.cancelled())
+        logger.check(('openid.server.server', 'ERROR',
+                      StringComparison('Error computing the Diffie-Hellman secret in .*, computing it inline')))
+
+    def test_associate_process_pool(self):
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            raise unittest.SkipTest('concurrent.futures is not available')
+        executor = ProcessPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.server = server.Server(self.store, "http://server.unittest/endpt", dh_executor=executor)
+        secret, assoc = self._associateDH()
+        self.assertEqual(secret, assoc.secret)
+
     def test_missingSessionTypeOpenID2(self):
         """Make sure session_type is required in OpenID 2"""
         msg = Message.fromPostArgs({
@@ -1670,6 +1792,22 @@ class TestSignatory(unittest.TestCase):
         self.assertTrue(sresponse.fields.getArg(OPENID_NS, 'sig'))
         self.assertEqual(logbook.records, [])
 
+    def test_sign_copy(self):
+        request = server.OpenIDRequest(Message(OPENID2_NS))
+        request.assoc_handle = '{assoc}{lookatme}'
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'ns': OPENID2_NS, 'foo': 'amsigned'})
+        original = response.fields.toPostArgs()
+
+        sresponse = self.signatory.sign(response)
+
+        # The fields of the original response are left alone, even
+        # when the handle is invalidated.
+        self.assertEqual(response.fields.toPostArgs(), original)
+        self.assertEqual(sresponse.fields.getArg(OPENID_NS, 'invalidate_handle'), '{assoc}{lookatme}')
+        self.assertIs(sresponse.request, request)
+        self.assertTrue(self.signatory.verify(sresponse.fields.getArg(OPENID_NS, 'assoc_handle'), sresponse.fields))
+
     def test_signDumb(self):
         request = server.OpenIDRequest()
         request.assoc_handle = None
@@ -1770,6 +1908,78 @@ class TestSignatory(unittest.TestCase):
         self.assertFalse(self.store.getAssociation(self._normal_key, new_assoc_handle))
         self.assertEqual(logbook.records, [])
 
+    def _signDumb(self, fields):
+        request = server.OpenIDRequest()
+        request.assoc_handle = None
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs(fields)
+        return self.signatory.sign(response).fields
+
+    def _checkAuth(self, signed):
+        message = signed.copy()
+        message.setArg(OPENID_NS, 'mode', 'check_authentication')
+        request = server.CheckAuthRequest.fromMessage(message)
+        return request.answer(self.signatory).fields.getArg(OPENID_NS, 'is_valid')
+
+    def test_signDumbShared(self):
+        with patch.object(self.store, 'storeAssociation', wraps=self.store.storeAssociation) as store:
+            signed = [self._signDumb({'ns': OPENID2_NS, 'mode': 'id_res', 'response_nonce': mkNonce()})
+                      for _ in range(5)]
+        self.assertEqual(store.call_count, 1)
+        assoc_handle = signed[0].getArg(OPENID_NS, 'assoc_handle')
+        self.assertTrue(assoc_handle.endswith('{shared}'))
+        self.assertEqual(set(m.getArg(OPENID_NS, 'assoc_handle') for m in signed), set([assoc_handle]))
+
+        with LogCapture() as logbook:
+            self.assertEqual([self._checkAuth(m) for m in signed], ['true'] * 5)
+            # Each response can only be checked once, but the association
+            # stays valid for the others.
+            self.assertEqual(self._checkAuth(signed[0]), 'false')
+        self.assertTrue(self.store.getAssociation(self._dumb_key, assoc_handle))
+        logbook.check(('openid.server.server', 'ERROR', StringComparison('response with nonce .* was checked before')))
+
+    def test_signDumbSharedRotation(self):
+        fields = {'ns': OPENID2_NS, 'mode': 'id_res', 'response_nonce': mkNonce()}
+        first = self._signDumb(fields).getArg(OPENID_NS, 'assoc_handle')
+        self.assertEqual(self._signDumb(fields).getArg(OPENID_NS, 'assoc_handle'), first)
+        with patch('time.time', return_value=time.time() + self.signatory.DUMB_ASSOCIATION_REUSE + 10):
+            self.assertNotEqual(self._signDumb(fields).getArg(OPENID_NS, 'assoc_handle'), first)
+
+    def test_signDumbNotShared(self):
+        # Responses without a nonce get an association of their own.
+        first = self._signDumb({'mode': 'id_res'})
+        second = self._signDumb({'mode': 'id_res'})
+        assoc_handle = first.getArg(OPENID_NS, 'assoc_handle')
+        self.assertNotEqual(assoc_handle, second.getArg(OPENID_NS, 'assoc_handle'))
+        self.assertFalse(assoc_handle.endswith('{shared}'))
+
+        self.assertEqual(self._checkAuth(first), 'true')
+        self.assertIsNone(self.store.getAssociation(self._dumb_key, assoc_handle))
+        with LogCapture():
+            self.assertEqual(self._checkAuth(first), 'false')
+
+    def test_signDumbSharedDisabled(self):
+        self.signatory.DUMB_ASSOCIATION_REUSE = 0
+        fields = {'ns': OPENID2_NS, 'mode': 'id_res', 'response_nonce': mkNonce()}
+        self.assertNotEqual(self._signDumb(fields).getArg(OPENID_NS, 'assoc_handle'),
+                            self._signDumb(fields).getArg(OPENID_NS, 'assoc_handle'))
+
+    def test_useResponseUnsignedNonce(self):
+        signed = self._signDumb({'ns': OPENID2_NS, 'mode': 'id_res', 'response_nonce': mkNonce()})
+        assoc_handle = signed.getArg(OPENID_NS, 'assoc_handle')
+        signed.setArg(OPENID_NS, 'signed', 'assoc_handle,mode,ns,signed')
+        with LogCapture() as logbook:
+            self.assertFalse(self.signatory.useResponse(assoc_handle, signed))
+        logbook.check(('openid.server.server', 'ERROR', StringComparison('.* has no signed nonce')))
+
+    def test_useResponseBadNonce(self):
+        signed = self._signDumb({'ns': OPENID2_NS, 'mode': 'id_res', 'response_nonce': mkNonce()})
+        assoc_handle = signed.getArg(OPENID_NS, 'assoc_handle')
+        signed.setArg(OPENID_NS, 'response_nonce', 'bogus')
+        with LogCapture() as logbook:
+            self.assertFalse(self.signatory.useResponse(assoc_handle, signed))
+        logbook.check(('openid.server.server', 'ERROR', StringComparison('.* has a bad nonce: .*')))
+
     def test_verify(self):
         assoc_handle = '{vroom}{zoom}'
         assoc = association.Association.fromExpiresIn(
@@ -1914,5 +2124,226 @@ class TestSignatory(unittest.TestCase):
         self.assertEqual(logbook.records, [])
 
 
+class TestAssociationCache(unittest.TestCase):
+    """Test `Signatory` with an `AssociationCache`."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.cache = server.AssociationCache(max_size=2)
+        self.signatory = server.Signatory(self.store, association_cache=self.cache)
+
+    def test_read_through(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        with patch.object(self.store, 'getAssociation') as get_association:
+            self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+            self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        self.assertFalse(get_association.called)
+        # Not mixed with dumb mode
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+        self.assertEqual(self.cache.getStats(),
+                         {'size': 2, 'hits': 2, 'negative_hits': 0, 'misses': 1, 'evictions': 0})
+
+    def test_stored_by_other_process(self):
+        assoc = server.Signatory(self.store).createAssociation(dumb=False)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        with patch.object(self.store, 'getAssociation') as get_association:
+            self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        self.assertFalse(get_association.called)
+
+    def test_negative(self):
+        with patch.object(self.store, 'getAssociation', wraps=self.store.getAssociation) as get_association:
+            self.assertIsNone(self.signatory.getAssociation('{forged}', dumb=True))
+            self.assertIsNone(self.signatory.getAssociation('{forged}', dumb=True))
+            self.assertEqual(get_association.call_count, 1)
+            with patch('time.time', return_value=time.time() + self.cache.negative_ttl):
+                self.assertIsNone(self.signatory.getAssociation('{forged}', dumb=True))
+            self.assertEqual(get_association.call_count, 2)
+        self.assertEqual(self.cache.getStats()['negative_hits'], 1)
+
+    def test_dumb_not_cached(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        self.assertEqual(self.cache.getStats()['size'], 0)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=True), assoc)
+        self.assertEqual(self.cache.getStats()['size'], 0)
+
+        # Invalidated by another process
+        server.Signatory(self.store).invalidate(assoc.handle, dumb=True)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+
+    def test_invalidate(self):
+        hook = Mock()
+        self.cache.on_invalidate = hook
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.signatory.invalidate(assoc.handle, dumb=False)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+        hook.assert_called_once_with(False, assoc.handle)
+
+    def test_discard(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        # Invalidated by another process, which notifies this one.
+        server.Signatory(self.store).invalidate(assoc.handle, dumb=False)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        self.cache.discard(False, assoc.handle)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+
+    def test_expired(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        with patch('time.time', return_value=time.time() + self.signatory.SECRET_LIFETIME):
+            with LogCapture():
+                self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=False))
+        self.assertIsNone(self.store.getAssociation(self.signatory._normal_key, assoc.handle))
+        self.assertEqual(self.cache.getStats()['size'], 0)
+
+    def test_eviction(self):
+        assocs = [self.signatory.createAssociation(dumb=False) for _ in range(3)]
+        self.assertEqual(self.cache.getStats()['evictions'], 1)
+        with patch.object(self.store, 'getAssociation', wraps=self.store.getAssociation) as get_association:
+            self.signatory.getAssociation(assocs[2].handle, dumb=False)
+            self.signatory.getAssociation(assocs[1].handle, dumb=False)
+            self.assertFalse(get_association.called)
+            self.signatory.getAssociation(assocs[0].handle, dumb=False)
+            self.assertEqual(get_association.call_count, 1)
+        self.assertEqual(self.cache.getStats()['evictions'], 2)
+
+    def test_server(self):
+        oserver = server.Server(self.store, "http://server.unittest/endpt", association_cache=self.cache)
+        self.assertIs(oserver.signatory.association_cache, self.cache)
+
+
+class TestStatelessSignatory(unittest.TestCase):
+    """Test `StatelessSignatory` class."""
+
+    def setUp(self):
+        self.store = memstore.MemoryStore()
+        self.signatory = server.StatelessSignatory(self.store)
+
+    def signDumb(self, signatory=None):
+        request = server.OpenIDRequest()
+        request.assoc_handle = None
+        response = server.OpenIDResponse(request)
+        response.fields = Message.fromOpenIDArgs({'foo': 'amsigned', 'ns': OPENID2_NS})
+        signed = (signatory or self.signatory).sign(response).fields
+        signed.setArg(OPENID_NS, 'mode', 'id_res')
+        return signed
+
+    def test_sign_dumb(self):
+        self.signDumb()
+        with patch.object(self.store, 'storeAssociation') as store_association:
+            with patch.object(self.store, 'getAssociation') as get_association:
+                signed = self.signDumb()
+                assoc_handle = signed.getArg(OPENID_NS, 'assoc_handle')
+                assoc = self.signatory.getAssociation(assoc_handle, dumb=True)
+        # No store access
+        self.assertFalse(store_association.called)
+        self.assertFalse(get_association.called)
+
+        self.assertRegexpMatches(assoc_handle, r'^\{HMAC-SHA1\}\{[0-9a-f]+\}\{[^{}]+\}\{[^{}]+\}\{[^{}]+\}$')
+        self.assertEqual(assoc.handle, assoc_handle)
+        self.assertEqual(len(assoc.secret), 20)
+        self.assertTrue(assoc.checkMessageSignature(signed))
+        # Only the master key is stored
+        self.assertEqual(self.store.getStats()['associations'], 1)
+
+    def test_create_sha256(self):
+        assoc = self.signatory.createAssociation(dumb=True, assoc_type='HMAC-SHA256')
+        self.assertEqual(len(assoc.secret), 32)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=True).secret, assoc.secret)
+        self.assertRaises(ValueError, self.signatory.createAssociation, dumb=True, assoc_type='HMAC-MD5')
+
+    def test_verify(self):
+        signed = self.signDumb()
+        assoc_handle = signed.getArg(OPENID_NS, 'assoc_handle')
+        self.assertTrue(self.signatory.verify(assoc_handle, signed))
+        # The handle can't be replayed
+        with LogCapture() as logbook:
+            self.assertFalse(self.signatory.verify(assoc_handle, signed))
+        logbook.check(('openid.server.server', 'ERROR', StringComparison('association with handle .* was revoked.*')))
+
+    def test_verify_other_process(self):
+        signed = self.signDumb()
+        assoc_handle = signed.getArg(OPENID_NS, 'assoc_handle')
+        other = server.StatelessSignatory(self.store)
+        self.assertTrue(other.verify(assoc_handle, signed))
+        # Revoked in the store
+        with LogCapture():
+            self.assertFalse(self.signatory.verify(assoc_handle, signed))
+
+    def test_verify_bad_sig(self):
+        signed = self.signDumb()
+        signed.setArg(OPENID_NS, 'foo', 'changed')
+        self.assertFalse(self.signatory.verify(signed.getArg(OPENID_NS, 'assoc_handle'), signed))
+
+    def test_tampered_handle(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        parts = assoc.handle.split('}{')
+        parts[1] = '%x' % (int(parts[1], 16) + 1)
+        with LogCapture() as logbook:
+            self.assertIsNone(self.signatory.getAssociation('}{'.join(parts), dumb=True))
+        logbook.check(('openid.server.server', 'INFO', StringComparison('Association handle .* has a bad tag')))
+
+        parts = assoc.handle.split('}{')
+        parts[2] = 'unknown'
+        self.assertIsNone(self.signatory.getAssociation('}{'.join(parts), dumb=True))
+
+    def test_invalidate(self):
+        assoc = self.signatory.createAssociation(dumb=True)
+        self.signatory.invalidate(assoc.handle, dumb=True)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+        with patch.object(self.store, 'useNonce') as use_nonce:
+            self.signatory.invalidate(assoc.handle, dumb=True)
+        self.assertFalse(use_nonce.called)
+
+    def test_old_association(self):
+        # Associations can only be checked within the nonce skew.
+        signed = self.signDumb()
+        with patch('time.time', return_value=time.time() + 6 * 60 * 60):
+            with LogCapture():
+                self.assertFalse(self.signatory.verify(signed.getArg(OPENID_NS, 'assoc_handle'), signed))
+
+    def test_rotation(self):
+        old = self.signatory.createAssociation(dumb=True)
+        with patch('time.time', return_value=time.time() + self.signatory.MASTER_KEY_ROTATION):
+            new = self.signatory.createAssociation(dumb=True)
+            self.assertNotEqual(old.handle.split('}{')[2], new.handle.split('}{')[2])
+            # Other servers pick the new key from the store
+            other = server.StatelessSignatory(self.store)
+            self.assertEqual(other.createAssociation(dumb=True).handle.split('}{')[2], new.handle.split('}{')[2])
+            self.assertEqual(other.getAssociation(old.handle, dumb=True).secret, old.secret)
+
+    def test_master_key_refresh(self):
+        self.signatory.createAssociation(dumb=True)
+        with patch.object(self.store, 'getAssociation', wraps=self.store.getAssociation) as get_association:
+            self.signatory.createAssociation(dumb=True)
+            self.assertFalse(get_association.called)
+            with patch('time.time', return_value=time.time() + self.signatory.MASTER_KEY_REFRESH):
+                self.signatory.createAssociation(dumb=True)
+            self.assertEqual(get_association.call_count, 1)
+
+    def test_normal_mode(self):
+        assoc = self.signatory.createAssociation(dumb=False)
+        self.assertEqual(self.store.getAssociation(self.signatory._normal_key, assoc.handle), assoc)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=False), assoc)
+        self.assertIsNone(self.signatory.getAssociation(assoc.handle, dumb=True))
+
+    def test_stored_dumb_association(self):
+        # Associations stored by Signatory are still valid.
+        assoc = server.Signatory(self.store).createAssociation(dumb=True)
+        self.assertEqual(self.signatory.getAssociation(assoc.handle, dumb=True), assoc)
+        self.signatory.invalidate(assoc.handle, dumb=True)
+        self.assertIsNone(self.store.getAssociation(self.signatory._dumb_key, assoc.handle))
+
+    def test_check_authentication(self):
+        oserver = server.Server(self.store, "http://server.unittest/endpt", signatoryClass=server.StatelessSignatory)
+        signed = self.signDumb(oserver.signatory)
+        query = signed.toPostArgs()
+        query['openid.mode'] = 'check_authentication'
+
+        response = oserver.handleRequest(oserver.decodeRequest(query))
+        self.assertEqual(response.fields.getArg(OPENID_NS, 'is_valid'), 'true')
+        with LogCapture():
+            response = oserver.handleRequest(oserver.decodeRequest(query))
+        self.assertEqual(response.fields.getArg(OPENID_NS, 'is_valid'), 'false')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,18 @@
 """Test `openid.store` module."""
 import os
 import random
+import shutil
 import socket
+import sqlite3
 import string
+import tempfile
+import threading
 import time
 import unittest
 
+from mock import patch
+from testfixtures import LogCapture
+
 from openid.association import Association
 from openid.cryptutil import randomString
 from openid.store.nonce import mkNonce, split
@@ -247,6 +254,108 @@ class TestFileOpenIDStore(unittest.TestCase):
             shutil.rmtree(temp_dir)
 
 
+class TestShardedFileOpenIDStore(unittest.TestCase):
+    """Test `ShardedFileOpenIDStore` class."""
+
+    server_url = 'http://www.myopenid.com/openid'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def genAssoc(self, handle, issued=0, lifetime=600):
+        return Association(handle, 'secret', int(time.time()) + issued, lifetime, 'HMAC-SHA1')
+
+    def test_store(self):
+        from openid.store import filestore
+        testStore(filestore.ShardedFileOpenIDStore(self.temp_dir))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['associations-v2', 'nonces-v2', 'temp'])
+
+    def test_latest(self):
+        from openid.store import filestore
+        store = filestore.ShardedFileOpenIDStore(self.temp_dir)
+        store.storeAssociation(self.server_url, self.genAssoc('new', issued=10))
+        store.storeAssociation(self.server_url, self.genAssoc('old'))
+
+        server_dir = store.getServerDirectory(self.server_url)
+        with open(os.path.join(server_dir, 'latest')) as latest_file:
+            self.assertEqual(latest_file.read(), filestore._safe64('new'))
+
+        # The association directory is not listed
+        with patch('os.listdir', side_effect=AssertionError):
+            self.assertEqual(store.getAssociation(self.server_url).handle, 'new')
+
+        store.removeAssociation(self.server_url, 'new')
+        self.assertEqual(store.getAssociation(self.server_url).handle, 'old')
+        with open(os.path.join(server_dir, 'latest')) as latest_file:
+            self.assertEqual(latest_file.read(), filestore._safe64('old'))
+
+    def test_expired_latest(self):
+        from openid.store import filestore
+        store = filestore.ShardedFileOpenIDStore(self.temp_dir)
+        store.storeAssociation(self.server_url, self.genAssoc('long', lifetime=1000))
+        store.storeAssociation(self.server_url, self.genAssoc('short', issued=10, lifetime=100))
+        with patch('time.time', return_value=time.time() + 200):
+            self.assertEqual(store.getAssociation(self.server_url).handle, 'long')
+            self.assertEqual(store.cleanupAssociations(), 0)
+        with patch('time.time', return_value=time.time() + 2000):
+            self.assertEqual(store.cleanupAssociations(), 1)
+        self.assertEqual(os.listdir(store.association_dir), [])
+
+    def test_nonce_buckets(self):
+        from openid.store import filestore, nonce
+        store = filestore.ShardedFileOpenIDStore(self.temp_dir)
+        now = int(time.time())
+        for offset in range(0, 3000, 100):
+            self.assertTrue(store.useNonce(self.server_url, now - offset, 'salt'))
+        self.assertFalse(store.useNonce(self.server_url, now, 'salt'))
+        self.assertGreater(len(os.listdir(store.nonce_dir)), 1)
+
+        orig_skew = nonce.SKEW
+        try:
+            nonce.SKEW = 1500
+            self.assertEqual(store.cleanupNonces(), 15)
+        finally:
+            nonce.SKEW = orig_skew
+        self.assertFalse(store.useNonce(self.server_url, now - 1400, 'salt'))
+        # Whole buckets were removed
+        buckets = [int(bucket, 16) for bucket in os.listdir(store.nonce_dir)]
+        self.assertGreaterEqual(min(buckets), now - 1500 - store.nonce_bucket_size)
+
+    def test_migrate(self):
+        from openid.store import filestore
+        old_store = filestore.FileOpenIDStore(self.temp_dir)
+        now = int(time.time())
+        old_store.storeAssociation(self.server_url, self.genAssoc('first'))
+        old_store.storeAssociation(self.server_url, self.genAssoc('second', issued=10))
+        old_store.storeAssociation(self.server_url, self.genAssoc('expired', issued=-7200, lifetime=3600))
+        old_store.storeAssociation('http://example.com/', self.genAssoc('other'))
+        old_store.useNonce(self.server_url, now, 'salt')
+        old_store.useNonce('', now - 100, 'salt')
+
+        # The stores in the new layout use the old one until it is migrated.
+        store = filestore.ShardedFileOpenIDStore(self.temp_dir)
+        self.assertEqual(store.getAssociation(self.server_url).handle, 'second')
+        self.assertEqual(store.getAssociation(self.server_url, 'first').handle, 'first')
+        self.assertFalse(store.useNonce(self.server_url, now, 'salt'))
+
+        self.assertEqual(filestore.migrateFileStore(self.temp_dir), (3, 2))
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['associations-v2', 'nonces-v2', 'temp'])
+
+        for current in (store, filestore.ShardedFileOpenIDStore(self.temp_dir)):
+            self.assertEqual(current.getAssociation(self.server_url).handle, 'second')
+            self.assertEqual(current.getAssociation(self.server_url, 'first').handle, 'first')
+            self.assertEqual(current.getAssociation('http://example.com/').handle, 'other')
+            self.assertIsNone(current.getAssociation(self.server_url, 'expired'))
+            self.assertFalse(current.useNonce(self.server_url, now, 'salt'))
+            self.assertFalse(current.useNonce('', now - 100, 'salt'))
+        self.assertIsNone(store.legacy)
+
+        self.assertEqual(filestore.migrateFileStore(self.temp_dir), (0, 0))
+
+
 class TestSQLiteStore(unittest.TestCase):
     """Test `SQLiteStore` class."""
 
@@ -263,6 +372,201 @@ class TestSQLiteStore(unittest.TestCase):
             testStore(store)
 
 
+class TestStdlibSQLiteStore(unittest.TestCase):
+    """Test `SQLiteStore` class with the `sqlite3` module."""
+
+    server_url = 'http://www.myopenid.com/openid'
+
+    def setUp(self):
+        from openid.store import sqlstore
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.store = sqlstore.SQLiteStore(self.conn, nonce_batch_size=50)
+        self.store.createTables()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_store(self):
+        testStore(self.store)
+
+    def test_use_nonces(self):
+        now = int(time.time())
+        self.assertTrue(self.store.useNonce(self.server_url, now, 'used'))
+        nonces = [(self.server_url, now, 'new'), (self.server_url, now, 'used'), (self.server_url, now, 'new'),
+                  (self.server_url, now - 6 * 60 * 60, 'old'), ('', now, 'new')]
+        self.assertEqual(self.store.useNonces(nonces), [True, False, False, False, True])
+        self.assertEqual(self.store.useNonces(nonces), [False] * 5)
+        self.assertEqual(self.store.useNonces([]), [])
+
+    def test_use_nonces_chunked(self):
+        now = int(time.time())
+        self.store.nonce_insert_rows = 7
+        nonces = [(self.server_url, now, str(i)) for i in range(30)]
+        self.assertEqual(self.store.useNonces(nonces), [True] * 30)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM oid_nonces').fetchone(), (30, ))
+
+    def test_batched_use_nonce(self):
+        now = int(time.time())
+        results = []
+
+        def worker(salt):
+            results.append(self.store.useNonce(self.server_url, now, salt))
+
+        salts = ['first'] + [str(i % 20) for i in range(40)]
+        with patch.object(self.store, 'useNonces', wraps=self.store.useNonces) as use_nonces:
+            # Keep the connection busy until every thread is waiting.
+            with self.store._conn_lock:
+                threads = [threading.Thread(target=worker, args=(salt, )) for salt in salts]
+                threads[0].start()
+                while self.store._nonce_batches or not self.store._inserting_nonces:
+                    time.sleep(0.001)
+                for thread in threads[1:]:
+                    thread.start()
+                while len(self.store._nonce_batches) < 1 or len(self.store._nonce_batches[0].nonces) < 40:
+                    time.sleep(0.001)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results.count(True), 21)
+        self.assertEqual(len(results), 41)
+        self.assertEqual(use_nonces.call_count, 2)
+
+    def test_batched_use_nonce_error(self):
+        self.conn.execute('DROP TABLE oid_nonces')
+        with self.assertRaises(sqlite3.OperationalError):
+            self.store.useNonce(self.server_url, int(time.time()), 'salt')
+        self.assertFalse(self.store._inserting_nonces)
+
+    def test_cleanup_nonces_batches(self):
+        self.conn.executemany('INSERT INTO oid_nonces VALUES (?, ?, ?)',
+                              [(self.server_url, 1000, str(i)) for i in range(25)])
+        self.conn.commit()
+        self.assertTrue(self.store.useNonce(self.server_url, int(time.time()), 'salt'))
+
+        with patch.object(self.store, 'txn_cleanupNonces', wraps=self.store.txn_cleanupNonces) as cleanup:
+            self.assertEqual(self.store.cleanupNonces(batch_size=10), 25)
+        self.assertEqual(cleanup.call_count, 3)
+        self.assertEqual(self.store.cleanupNonces(batch_size=10), 0)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM oid_nonces').fetchone(), (1, ))
+
+
+class TestSQLConnectionPool(unittest.TestCase):
+    """Test `SQLStore` with a `SQLConnectionPool`."""
+
+    server_url = 'http://www.myopenid.com/openid'
+
+    def setUp(self):
+        from openid.store import sqlstore
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'store.db')
+        self.pool = sqlstore.SQLConnectionPool(self.connect, max_connections=3)
+        self.store = sqlstore.SQLiteStore(self.pool)
+        self.store.createTables()
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.temp_dir)
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+
+    def test_store(self):
+        testStore(self.store)
+        self.assertEqual(self.pool.getStats()['connections'], 1)
+
+    def test_threads(self):
+        now = int(time.time())
+        results = []
+        errors = []
+
+        def worker(index):
+            try:
+                handle = 'handle%d' % index
+                assoc = Association(handle, 'secret', now, 600, 'HMAC-SHA1')
+                self.store.storeAssociation(self.server_url, assoc)
+                results.append(self.store.getAssociation(self.server_url, handle) == assoc)
+                for i in range(10):
+                    results.append(self.store.useNonce(self.server_url, now, str(i)))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker, args=(i, )) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results.count(True), 8 + 10)
+        stats = self.pool.getStats()
+        self.assertLessEqual(stats['connections'], 3)
+        self.assertEqual(stats['in_use'], 0)
+        # The store checks out a connection when it is created.
+        self.assertEqual(stats['checkouts'], 2 + 8 * 12)
+
+    def test_retry(self):
+        attempts = []
+
+        def txn_fail_once():
+            attempts.append(self.store.cur)
+            if len(attempts) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return 'done'
+
+        with patch('time.sleep') as sleep:
+            with LogCapture() as logger:
+                self.assertEqual(self.store._callInTransaction(txn_fail_once), 'done')
+        sleep.assert_called_once_with(0.05)
+        logger.check(('openid.store.sqlstore', 'WARNING',
+                      'Retrying the transaction after an error: database is locked'))
+        self.assertIsNone(self.store.cur)
+        stats = self.pool.getStats()
+        self.assertEqual((stats['retried'], stats['discarded'], stats['connections']), (1, 1, 1))
+
+    def test_retries_exhausted(self):
+        def txn_fail():
+            raise sqlite3.OperationalError('disk I/O error')
+
+        with patch('time.sleep') as sleep:
+            with LogCapture():
+                self.assertRaises(sqlite3.OperationalError, self.store._callInTransaction, txn_fail)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.05, 0.1, 0.2])
+        self.assertEqual(self.pool.getStats()['discarded'], 4)
+
+    def test_not_retried(self):
+        def txn_fail():
+            raise sqlite3.IntegrityError('constraint failed')
+
+        self.assertRaises(sqlite3.IntegrityError, self.store._callInTransaction, txn_fail)
+        stats = self.pool.getStats()
+        self.assertEqual((stats['retried'], stats['discarded'], stats['idle']), (0, 0, 1))
+
+    def test_timeout(self):
+        from openid.store import sqlstore
+        pool = sqlstore.SQLConnectionPool(self.connect, max_connections=1, timeout=0.01)
+        conn = pool.checkout()
+        self.assertRaises(sqlstore.PoolTimeout, pool.checkout)
+        pool.checkin(conn)
+        self.assertIs(pool.checkout(), conn)
+        stats = pool.getStats()
+        self.assertEqual((stats['checkouts'], stats['waits'], stats['timeouts'], stats['in_use']), (3, 1, 1, 1))
+        conn.close()
+
+    def test_wait(self):
+        from openid.store import sqlstore
+        pool = sqlstore.SQLConnectionPool(self.connect, max_connections=1)
+        conn = pool.checkout()
+        checked_out = []
+        thread = threading.Thread(target=lambda: checked_out.append(pool.checkout()))
+        thread.start()
+        while not pool.getStats()['waits']:
+            time.sleep(0.001)
+        pool.checkin(conn)
+        thread.join()
+        self.assertEqual(checked_out, [conn])
+        conn.close()
+
+
 class TestMySQLStore(unittest.TestCase):
     """Test `MySQLStore` class."""
 
@@ -389,3 +693,90 @@ class TestMemoryStore(unittest.TestCase):
     def test_memstore(self):
         from openid.store import memstore
         testStore(memstore.MemoryStore())
+
+    def test_newest_association(self):
+        from openid.store import memstore
+        store = memstore.MemoryStore()
+        now = int(time.time())
+        old = Association('old', 'secret', now - 10, 600, 'HMAC-SHA1')
+        new = Association('new', 'secret', now, 600, 'HMAC-SHA1')
+        store.storeAssociation('http://example.com/', new)
+        store.storeAssociation('http://example.com/', old)
+        self.assertEqual(store.getAssociation('http://example.com/').handle, 'new')
+
+        store.removeAssociation('http://example.com/', 'new')
+        self.assertEqual(store.getAssociation('http://example.com/').handle, 'old')
+        store.removeAssociation('http://example.com/', 'old')
+        self.assertIsNone(store.getAssociation('http://example.com/'))
+        self.assertEqual(store.getStats()['servers'], 0)
+
+    def test_max_associations(self):
+        from openid.store import memstore
+        store = memstore.MemoryStore(max_associations=2)
+        now = int(time.time())
+        for handle in ('a', 'b', 'c'):
+            store.storeAssociation('http://example.com/', Association(handle, 'secret', now, 600, 'HMAC-SHA1'))
+
+        self.assertIsNone(store.getAssociation('http://example.com/', 'a'))
+        self.assertEqual(store.getAssociation('http://example.com/', 'b').handle, 'b')
+        self.assertEqual(store.getAssociation('http://example.com/').handle, 'c')
+        stats = store.getStats()
+        self.assertEqual(stats['associations'], 2)
+        self.assertEqual(stats['evicted_associations'], 1)
+
+    def test_nonce_buckets(self):
+        from openid.store import memstore, nonce
+        store = memstore.MemoryStore()
+        now = int(time.time())
+        for offset in range(0, 300, 10):
+            self.assertTrue(store.useNonce('http://example.com/', now - offset, 'salt'))
+        self.assertEqual(store.getStats()['nonces'], 30)
+        self.assertGreater(store.getStats()['nonce_buckets'], 1)
+
+        orig_skew = nonce.SKEW
+        try:
+            nonce.SKEW = 150
+            self.assertEqual(store.cleanupNonces(), 15)
+        finally:
+            nonce.SKEW = orig_skew
+        self.assertEqual(store.getStats()['nonces'], 15)
+        self.assertFalse(store.useNonce('http://example.com/', now - 100, 'salt'))
+
+    def test_max_nonces(self):
+        from openid.store import memstore
+        store = memstore.MemoryStore(max_nonces=2)
+        now = int(time.time())
+        self.assertTrue(store.useNonce('http://example.com/', now, 'a'))
+        self.assertTrue(store.useNonce('http://example.com/', now, 'b'))
+        with LogCapture() as logger:
+            self.assertFalse(store.useNonce('http://example.com/', now, 'c'))
+        logger.check(('openid.store.memstore', 'WARNING', 'Rejecting nonce, the store is full with 2 nonces'))
+        self.assertEqual(store.getStats()['rejected_nonces'], 1)
+
+    def test_threads(self):
+        from openid.store import memstore
+        store = memstore.MemoryStore(max_associations=50)
+        now = int(time.time())
+        results = []
+
+        def worker(index):
+            used = 0
+            for i in range(200):
+                handle = '%d-%d' % (index, i)
+                store.storeAssociation('http://example.com/', Association(handle, 'secret', now, 600, 'HMAC-SHA1'))
+                store.getAssociation('http://example.com/')
+                used += store.useNonce('http://example.com/', now, str(i))
+            results.append(used)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every salt was used by each thread, only one of them succeeded.
+        self.assertEqual(sum(results), 200)
+        stats = store.getStats()
+        self.assertEqual(stats['associations'], 50)
+        self.assertEqual(stats['evicted_associations'], 750)
+        self.assertEqual(stats['nonces'], 200)
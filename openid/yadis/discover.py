@@ -36,6 +36,9 @@ class DiscoveryResult(object):
     # The document returned from the xrds_uri
     response_text = None
 
+    # The HTTP headers returned with the response_text
+    headers = None
+
     def __init__(self, request_uri):
         """Initialize the state of the object
 
@@ -96,6 +99,7 @@ def discover(uri):
         result.content_type = resp.headers.get('content-type')
 
     result.response_text = resp.body
+    result.headers = resp.headers
     return result
 
 
@@ -2,6 +2,8 @@ class YadisServiceManager(object):
     """Holds the state of a list of selected Yadis services, managing
     storing it in a session and iterating over the services in order."""
 
+    __slots__ = ('starting_url', 'yadis_url', 'services', 'session_key', '_current')
+
     def __init__(self, starting_url, yadis_url, services, session_key):
         # The URL that was used to initiate the Yadis protocol
         self.starting_url = starting_url
@@ -17,6 +19,19 @@ class YadisServiceManager(object):
         # Reference to the current service object
         self._current = None
 
+    def __getstate__(self):
+        # The services are pickled by themselves, the OpenID service
+        # endpoints in their compact encoding.
+        return (self.starting_url, self.yadis_url, self.services, self.session_key, self._current)
+
+    def __setstate__(self, state):
+        # Managers pickled before they had slots have their attributes
+        # in a dictionary.
+        if isinstance(state, dict):
+            state = (state['starting_url'], state['yadis_url'], state['services'], state['session_key'],
+                     state['_current'])
+        (self.starting_url, self.yadis_url, self.services, self.session_key, self._current) = state
+
     def __len__(self):
         """How many untried services remain?"""
         return len(self.services)
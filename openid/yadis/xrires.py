@@ -72,17 +72,48 @@ class ProxyResolver(object):
         @returns: tuple of (CanonicalID, Service elements)
         @returntype: (unicode, list of C{ElementTree.Element}s)
         """
+        canonicalID, services, _ = self.queryWithExpiration(xri, service_types)
+        return canonicalID, services
+
+    def queryWithExpiration(self, xri, service_types):
+        """Resolve some services for an XRI, like L{query}, and report
+        when the resolved information expires.
+
+        @returns: tuple of (CanonicalID, Service elements, expiration).
+            The expiration is the earliest C{xrd:Expires} of the XRDs
+            the services were taken from, or None if none of them had
+            one.
+        @returntype: (unicode, list of C{ElementTree.Element}s,
+            C{datetime.datetime} or NoneType)
+        """
         # FIXME: No test coverage!
-        services = []
         # Make a seperate request to the proxy resolver for each service
         # type, as, if it is following Refs, it could return a different
         # XRDS for each.
+        responses = [fetchers.fetch(self.queryURL(xri, service_type)) for service_type in service_types]
+        return self.parseResponses(xri, responses)
+
+    def parseResponses(self, xri, responses):
+        """Combine the responses of the proxy resolver to the queries
+        for each service type into the result of
+        L{queryWithExpiration}.
+
+        [non-blocking]
 
+        May raise L{etxrd.XRDSError} if the responses don't parse.
+
+        @param xri: The resolved XRI.
+        @type xri: unicode
+
+        @param responses: The responses to the URLs built by
+            L{queryURL}.
+        @type responses: list of L{fetchers.HTTPResponse}
+        """
+        services = []
         canonicalID = None
+        expires = None
 
-        for service_type in service_types:
-            url = self.queryURL(xri, service_type)
-            response = fetchers.fetch(url)
+        for response in responses:
             if response.status not in (200, 206):
                 # XXX: sucks to fail silently.
                 # print "response not OK:", response
@@ -91,11 +122,18 @@ class ProxyResolver(object):
             canonicalID = etxrd.getCanonicalID(xri, et)
             some_services = list(iterServices(et))
             services.extend(some_services)
+
+            try:
+                xrd_expires = etxrd.getXRDExpiration(etxrd.getYadisXRD(et))
+            except ValueError:
+                xrd_expires = None
+            if xrd_expires is not None and (expires is None or xrd_expires < expires):
+                expires = xrd_expires
         # TODO:
         #  * If we do get hits for multiple service_types, we're almost
         #    certainly going to have duplicated service entries and
         #    broken priority ordering.
-        return canonicalID, services
+        return canonicalID, services, expires
 
 
 def _appendArgs(url, args):